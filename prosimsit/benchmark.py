@@ -0,0 +1,216 @@
+import sys
+import json
+import shutil
+import logging
+import argparse
+from pathlib import Path
+
+import prosimsit.utils as utils
+import prosimsit.rescoring as rescoring
+import prosimsit.maxquant as maxquant
+import prosimsit.synthetic as synthetic
+import prosimsit.io as io
+from prosimsit.report import RunReport
+from prosimsit.stages import DigestCache
+from prosimsit.constants import DEFAULT_MEMORY_BUDGET_MB
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+DEFAULT_SIZES = [100_000, 1_000_000]
+BASELINE_FILE = 'benchmark_baseline.json'
+RESULTS_FILE = 'benchmark_results.json'
+METRICS = ['wall_time_s', 'peak_rss_mb']
+
+
+def run_stages(dataset: synthetic.SyntheticDataset, run_report: RunReport, threads=1,
+               memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, intermediate_format=io.DEFAULT_INTERMEDIATE_FORMAT):
+    """
+    Run the glue code between the external tools on a synthetic dataset, in workflow order, measuring each function as
+    a stage of run_report
+    :param dataset: SyntheticDataset generated by synthetic.generate_dataset()
+    :param run_report: RunReport recording the measurements
+    :param threads: Number of threads
+    :param memory_budget_mb: Memory budget in MB, as general.memory_budget_mb
+    :param intermediate_format: Format of intermediate tables, as general.intermediate_format
+    :return: None
+    """
+    cache_dir = dataset.root / '.prosimsit'
+    for leftover in [cache_dir, dataset.root / 'simsi_input', dataset.root / 'ProSIMSIt']:
+        if leftover.exists():
+            shutil.rmtree(leftover)
+    tables = maxquant.MaxQuantTables(dataset.maxquant_dir, cache_dir / 'maxquant', DigestCache(cache_dir / 'digests.json'),
+                                     memory_budget_mb)
+    simsi_msms = dataset.root / 'simsi_input' / 'msms.txt'
+    simsi_msms.parent.mkdir(parents=True)
+    dataset.percolator_dir.mkdir(parents=True)
+    dataset.picked_dir.mkdir(parents=True)
+    p10_msms = dataset.simsi_output / 'summaries' / 'p10' / 'p10_msms.txt'
+    rescore_all = io.table_path(dataset.percolator_dir / 'rescore_all', intermediate_format)
+    target_psms = dataset.percolator_dir / 'rescore_all.percolator.psms.txt'
+    decoy_psms = dataset.percolator_dir / 'rescore_all.percolator.decoy.psms.txt'
+    merged_msms = io.table_path(dataset.picked_dir / 'merged_msms', intermediate_format)
+
+    with run_report.stage('maxquant_cache', [dataset.maxquant_dir]):
+        for table in ['msms', 'summary']:
+            tables.columns(table)
+
+    with run_report.stage('prosit_to_simsi', [dataset.ok1_percolator], [simsi_msms]):
+        utils.prosit_to_simsi(tables, dataset.ok1_percolator, simsi_msms, dataset.raw_files, memory_budget_mb)
+
+    with run_report.stage('prepare_input_for_second_oktoberfest', [p10_msms]):
+        utils.prepare_input_for_second_oktoberfest(dataset.simsi_output)
+
+    with run_report.stage('merge_rescore_files', [dataset.ok1_percolator / 'rescore.tab', dataset.ok2_percolator],
+                          [rescore_all]):
+        utils.merge_rescore_files(dataset.ok1_percolator, dataset.ok2_percolator, rescore_all, threads,
+                                  memory_budget_mb)
+
+    # stands in for percolator --static, which the benchmark does not require to be installed
+    with run_report.stage('rescore_static', [rescore_all], [target_psms, decoy_psms]):
+        rescoring.rescore_static(rescore_all, dataset.ok1_percolator / 'rescore.percolator.weights.csv',
+                                 target_psms, decoy_psms,
+                                 dataset.percolator_dir / 'rescore_all.percolator.peptides.txt',
+                                 dataset.percolator_dir / 'rescore_all.percolator.decoy.peptides.txt',
+                                 memory_budget_mb=memory_budget_mb)
+
+    with run_report.stage('prepare_for_building_evidence', [target_psms, decoy_psms, p10_msms], [merged_msms]):
+        utils.prepare_for_building_evidence(target_psms, decoy_psms, p10_msms, tables, merged_msms,
+                                            dataset.raw_files)
+
+    # only importable with Picked Protein Group FDR installed
+    from prosimsit.picked_fdr_functions import add_extra_dash_for_percolator
+
+    with run_report.stage('add_extra_dash_for_percolator', [target_psms]):
+        add_extra_dash_for_percolator(target_psms, dataset.percolator_dir / 'rescore_all.percolator.psms.dash.txt')
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Find stages that got slower or need more memory than in the baseline
+    :param results: Dictionary mapping the number of PSMs to a dictionary of stage metrics, see METRICS
+    :param baseline: Baseline results in the same format
+    :param tolerance: Allowed relative increase of each metric, e.g. 0.25 for 25%
+    :return: List of regression messages
+    """
+    regressions = []
+    for size, stage_results in results.items():
+        for stage_name, metrics in stage_results.items():
+            reference = baseline.get(size, {}).get(stage_name)
+            if reference is None:
+                continue
+            for metric in METRICS:
+                if metrics.get(metric) is None or not reference.get(metric):
+                    continue
+                if metrics[metric] > reference[metric] * (1 + tolerance):
+                    regressions.append(f'{stage_name} at {size} PSMs: {metric} {metrics[metric]} > '
+                                       f'baseline {reference[metric]}')
+    return regressions
+
+
+def run_benchmark(work_dir: Path, sizes, n_raw_files=10, hyphenated_fraction=0.25, decoy_ratio=0.1, threads=1,
+                  memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, intermediate_format=io.DEFAULT_INTERMEDIATE_FORMAT,
+                  regenerate=False, seed=0):
+    """
+    Generate a synthetic dataset per size, unless it already exists, and measure each glue code stage on it
+    :param work_dir: Directory for datasets, run reports and results
+    :param sizes: List of numbers of PSMs
+    :param n_raw_files: Number of raw files per dataset
+    :param hyphenated_fraction: Fraction of raw file names containing '-<digits>-'
+    :param decoy_ratio: Fraction of decoy PSMs
+    :param threads: Number of threads
+    :param memory_budget_mb: Memory budget in MB, as general.memory_budget_mb
+    :param intermediate_format: Format of intermediate tables, as general.intermediate_format
+    :param regenerate: Generate the datasets even if they exist
+    :param seed: Seed of the random generator
+    :return: Dictionary mapping the number of PSMs to a dictionary of stage metrics
+    """
+    results = {}
+    for size in sizes:
+        dataset_dir = work_dir / (f'psms_{size}_raw_{n_raw_files}_hyphenated_{hyphenated_fraction}_'
+                                  f'decoys_{decoy_ratio}_seed_{seed}')
+        complete_marker = dataset_dir / '.complete'
+        if regenerate or not complete_marker.is_file():
+            logger.info(f'Generating synthetic dataset with {size} PSMs')
+            dataset = synthetic.generate_dataset(dataset_dir, n_psms=size, n_raw_files=n_raw_files,
+                                                 hyphenated_fraction=hyphenated_fraction, decoy_ratio=decoy_ratio,
+                                                 seed=seed)
+            complete_marker.touch()
+        else:
+            dataset = synthetic.SyntheticDataset(
+                dataset_dir, synthetic.raw_file_names(n_raw_files, hyphenated_fraction), size)
+
+        logger.info(f'Benchmarking {size} PSMs')
+        run_report = RunReport(dataset_dir / 'run_report.json', metadata={'n_psms': size})
+        run_stages(dataset, run_report, threads, memory_budget_mb, intermediate_format)
+        run_report.finish()
+        results[str(size)] = {stage['name']: {metric: stage.get(metric) for metric in METRICS}
+                              for stage in run_report.report['stages']}
+    return results
+
+
+def parse_args(argv):
+    apars = argparse.ArgumentParser(
+        description='Measure time and memory of the ProSIMSIt glue code on synthetic datasets',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    apars.add_argument('--work_dir', required=True, metavar='DIR',
+                       help='Directory for synthetic datasets, run reports and results.')
+    apars.add_argument('--sizes', nargs='+', type=float, default=DEFAULT_SIZES, metavar='N',
+                       help='Numbers of PSMs to benchmark, e.g. 1e5 1e6 1e7.')
+    apars.add_argument('--raw_files', type=int, default=10, help='Number of raw files per dataset.')
+    apars.add_argument('--hyphenated_fraction', type=float, default=0.25,
+                       help='Fraction of raw file names containing hyphens.')
+    apars.add_argument('--decoy_ratio', type=float, default=0.1, help='Fraction of decoy PSMs.')
+    apars.add_argument('--threads', type=int, default=1, help='Number of threads.')
+    apars.add_argument('--memory_budget_mb', type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                       help='Memory budget in MB, as general.memory_budget_mb.')
+    apars.add_argument('--intermediate_format', default=io.DEFAULT_INTERMEDIATE_FORMAT,
+                       choices=list(io.INTERMEDIATE_FORMATS), help='Format of intermediate tables.')
+    apars.add_argument('--baseline', default=None, metavar='FILE',
+                       help=f'Baseline to compare to; defaults to {BASELINE_FILE} in the work directory.')
+    apars.add_argument('--tolerance', type=float, default=0.25,
+                       help='Allowed relative increase of time and peak memory over the baseline.')
+    apars.add_argument('--update_baseline', action='store_true',
+                       help='Store the results as new baseline instead of comparing to it.')
+    apars.add_argument('--regenerate', action='store_true', help='Generate the datasets even if they exist.')
+    apars.add_argument('--seed', type=int, default=0, help='Seed of the random generator.')
+    return apars.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    work_dir = Path(args.work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    baseline_path = Path(args.baseline) if args.baseline is not None else work_dir / BASELINE_FILE
+
+    results = run_benchmark(work_dir, [int(size) for size in args.sizes], args.raw_files, args.hyphenated_fraction,
+                            args.decoy_ratio, args.threads, args.memory_budget_mb, args.intermediate_format,
+                            args.regenerate, args.seed)
+    with open(work_dir / RESULTS_FILE, 'w') as f:
+        json.dump(results, f, indent=4)
+    for size, stage_results in results.items():
+        for stage_name, metrics in stage_results.items():
+            logger.info(f'{size} PSMs, {stage_name}: {metrics["wall_time_s"]} s, {metrics["peak_rss_mb"]} MB')
+
+    if args.update_baseline or not baseline_path.is_file():
+        baseline = {}
+        if baseline_path.is_file():
+            with open(baseline_path, 'r') as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f, indent=4)
+        logger.info(f'Saved baseline to {baseline_path}')
+        return 0
+
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        logger.error(f'Regression: {regression}')
+    if not regressions:
+        logger.info(f'No regressions compared to {baseline_path}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -29,13 +29,94 @@ def parse_args(argv):
             "Path to config file in json format."
         ),
     )
-    args = apars.parse_args()
-    return args
 
+    apars.add_argument(
+        "--from-stage",
+        default=None,
+        metavar="STAGE",
+        help=(
+            "Rerun the workflow starting from this stage, regardless of existing checkpoints. Earlier stages are "
+            "skipped."
+        ),
+    )
+
+    apars.add_argument(
+        "--until-stage",
+        default=None,
+        metavar="STAGE",
+        help=(
+            "Stop the workflow after this stage."
+        ),
+    )
+    apars.add_argument(
+        "--plan-shards",
+        default=None,
+        type=int,
+        metavar="N",
+        help=(
+            "Split the raw files into at most N shards of whole TMT batches for the stage given by --shard-stage and "
+            "do the global work that has to precede the shard workers."
+        ),
+    )
+
+    apars.add_argument(
+        "--shard",
+        default=None,
+        type=int,
+        metavar="K",
+        help=(
+            "Run the per-raw-file work of the stage given by --shard-stage for shard K of the plan written by "
+            "--plan-shards."
+        ),
+    )
+
+    apars.add_argument(
+        "--shard-stage",
+        default=None,
+        metavar="STAGE",
+        help=(
+            "Stage to plan or run shards for."
+        ),
+    )
+
+    apars.add_argument(
+        "--launch-local",
+        default=None,
+        type=int,
+        metavar="N",
+        help=(
+            "Run the whole workflow with the per-raw-file work split into at most N shards per stage, each running "
+            "as a separate process on this machine."
+        ),
+    )
+
+    apars.add_argument(
+        "--add-batches",
+        action="store_true",
+        help=(
+            "Update the results in the output folder to a MaxQuant search with added raw files: per-raw-file results "
+            "whose search results did not change are kept and only the new and changed raw files are processed. "
+            "Stages whose config changed are recomputed completely."
+        ),
+    )
+
+    apars.add_argument(
+        "--validate",
+        "--dry-run",
+        action="store_true",
+        help=(
+            "Only check the config file and the input files it references, without running any stage."
+        ),
+    )
+    args = apars.parse_args(argv)
+    if (args.plan_shards is not None or args.shard is not None) and args.shard_stage is None:
+        apars.error("--plan-shards and --shard require --shard-stage")
+    if args.plan_shards is not None and args.shard is not None:
+        apars.error("--plan-shards and --shard cannot be combined")
+    return args
 
-def read_config(argv):
-    config_path = parse_args(argv).config_path
 
+def read_config(config_path):
     logger.info(f"Reading configuration from {config_path}")
     if isinstance(config_path, str):
         config_path = Path(config_path)
@@ -0,0 +1,283 @@
+import re
+import csv
+import copy
+import logging
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Sequence
+
+from prosimsit.constants import (DEFAULT_CHUNK_PSMS, DEFAULT_MAX_REQUESTS_IN_FLIGHT, DEFAULT_MEMORY_BUDGET_MB,
+                                 DEFAULT_PREDICTION_CACHE_MB, DEFAULT_INTERMEDIATE_FORMAT, INTERMEDIATE_FORMATS,
+                                 PREDICTION_CLIENTS, PROFILERS, STAGING_METHODS)
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+# marks options without default value
+REQUIRED = object()
+
+# MaxQuant tables read by ProSIMSIt and SIMSI-Transfer
+MAXQUANT_FILES = ['msms.txt', 'msmsScans.txt', 'evidence.txt', 'allPeptides.txt', 'summary.txt']
+SPECTRA_SUFFIXES = {'raw': '.raw', 'mzml': '.mzml'}
+# entries of general.modifications: an N-terminal or residue modification in UNIMOD notation and its notation in
+# MaxQuant, where fixed modifications map to the bare residue or, at the N-terminus, to an empty string
+UNIMOD_PATTERN = re.compile(r'\[UNIMOD:\d+\]-|[A-Z]\[UNIMOD:\d+\]')
+MAXQUANT_PATTERN = re.compile(r'(\([^_]*\)|[A-Z](\([^_]*\))?)?')
+
+
+class ConfigError(ValueError):
+    """
+    Invalid config.toml; the message lists all problems that were found, not only the first one.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('Invalid configuration:\n' + '\n'.join(f'  - {error}' for error in errors))
+
+
+def _integer(value):
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError
+    return int(value)
+
+
+def _number(value):
+    if isinstance(value, bool):
+        raise ValueError
+    return float(value)
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    raise ValueError
+
+
+def _string(value):
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise ValueError
+    return str(value)
+
+
+def _strings(value):
+    """
+    :return: A single string or a non-empty list of strings, as the fasta option accepts both
+    """
+    if isinstance(value, list):
+        if not value or not all(isinstance(v, str) for v in value):
+            raise ValueError
+        return value
+    return _string(value)
+
+
+def _string_table(value):
+    if not isinstance(value, dict) or not all(isinstance(v, str) for v in value.values()):
+        raise ValueError
+    return value
+
+
+TYPE_NAMES = {_integer: 'an integer', _number: 'a number', _boolean: 'true or false', _string: 'a string',
+              _strings: 'a string or a list of strings', _string_table: 'a table of strings'}
+
+
+def _check_stringencies(value):
+    try:
+        [int(s) for s in value.split(',')]
+    except ValueError:
+        return f'expected comma-separated integers, got {value!r}'
+    return None
+
+
+def _check_max_pep(value):
+    try:
+        max_pep = int(value)
+    except ValueError:
+        return f'expected an integer percentage, got {value!r}'
+    if not 0 <= max_pep <= 100:
+        return f'expected a percentage between 0 and 100, got {max_pep}'
+    return None
+
+
+def _check_modifications(value):
+    """
+    :param value: Dictionary mapping UNIMOD to MaxQuant notation, see modifications.DEFAULT_MODIFICATIONS
+    :return: Error message for the first invalid entry, or None
+    """
+    for unimod, maxquant in value.items():
+        if not UNIMOD_PATTERN.fullmatch(unimod):
+            return f'expected modifications like "[UNIMOD:1]-" or "K[UNIMOD:121]", got {unimod!r}'
+        if not MAXQUANT_PATTERN.fullmatch(maxquant):
+            return f'expected MaxQuant modifications like "(Acetyl (Protein N-term))" or "K(GlyGly (K))", ' \
+                   f'got {maxquant!r}'
+        if unimod.endswith('-') != (maxquant[:1] in ('', '(')):
+            return f'{unimod!r} and {maxquant!r} have to be both N-terminal or both on a residue'
+        if not unimod.endswith('-') and unimod[0] != maxquant[0]:
+            return f'{unimod!r} and {maxquant!r} modify different residues'
+    return None
+
+
+def _check_output(value):
+    if Path(value).is_file():
+        return f'{value} is a file, not a directory'
+    return None
+
+
+@dataclass
+class Option:
+    """
+    A parameter of config.toml.
+    :param key: Dotted key, e.g. 'general.threads'
+    :param type: Function converting the value; the converted value replaces the value in the config
+    :param default: Value used if the option is missing; REQUIRED if it has to be set
+    :param choices: Allowed values
+    :param minimum: Smallest allowed value of numeric options
+    :param path: 'file' or 'dir' if the value is a path that has to exist
+    :param check: Function returning an error message for an invalid converted value, or None
+    """
+    key: str
+    type: Callable = _string
+    default: Any = REQUIRED
+    choices: Optional[Sequence] = None
+    minimum: Optional[float] = None
+    path: Optional[str] = None
+    check: Optional[Callable[[Any], Optional[str]]] = None
+
+
+CONFIG_SCHEMA = [
+    Option('general.output', check=_check_output),
+    Option('general.threads', _integer, minimum=1),
+    Option('general.memory_budget_mb', _integer, DEFAULT_MEMORY_BUDGET_MB, minimum=1),
+    Option('general.max_memory_mb', _number, 0, minimum=0),
+    Option('general.intermediate_format', default=DEFAULT_INTERMEDIATE_FORMAT, choices=list(INTERMEDIATE_FORMATS)),
+    Option('general.prediction_cache', default=''),
+    Option('general.prediction_cache_mb', _number, DEFAULT_PREDICTION_CACHE_MB, minimum=0),
+    Option('general.prediction_client', default='koinapy', choices=PREDICTION_CLIENTS),
+    Option('general.max_requests_in_flight', _integer, DEFAULT_MAX_REQUESTS_IN_FLIGHT, minimum=1),
+    Option('general.profiler', default='', choices=[''] + PROFILERS),
+    Option('general.staging', default='auto', choices=['auto'] + STAGING_METHODS),
+    Option('general.spectrum_store', _boolean, False),
+    Option('general.chunk_psms', _integer, DEFAULT_CHUNK_PSMS, minimum=0),
+    Option('general.tmt_ms_level', choices=['ms2', 'ms3']),
+    Option('general.modifications', _string_table, {}, check=_check_modifications),
+    Option('general.debug_mode', _boolean, False),
+    Option('inputs.maxquant_results', path='dir'),
+    Option('inputs.spectra', path='dir'),
+    Option('inputs.spectra_type', choices=list(SPECTRA_SUFFIXES)),
+    Option('prosit.intensity_model'),
+    Option('prosit.irt_model'),
+    Option('prosit.prediction_server', default='koina.wilhelmlab.org:443'),
+    Option('prosit.ssl', _boolean, True),
+    Option('prosit.ms_analyzer', choices=['ot', 'it']),
+    Option('simsi.stringency', check=_check_stringencies),
+    Option('simsi.max_pep', check=_check_max_pep),
+    Option('picked_protein_group_fdr.fasta', _strings),
+    Option('picked_protein_group_fdr.enzyme'),
+    Option('picked_protein_group_fdr.peptide_index', default=''),
+]
+
+
+def _validate_option(option: Option, value):
+    """
+    :return: Tuple of the converted value and an error message, which is None if the value is valid
+    """
+    try:
+        value = option.type(value)
+    except (TypeError, ValueError):
+        return value, f'{option.key}: expected {TYPE_NAMES.get(option.type, option.type.__name__)}, got {value!r}'
+    if option.choices is not None and value not in option.choices:
+        return value, f'{option.key}: expected one of {", ".join(map(repr, option.choices))}, got {value!r}'
+    if option.minimum is not None and value < option.minimum:
+        return value, f'{option.key}: expected at least {option.minimum}, got {value}'
+    if option.path is not None:
+        for path in (value if isinstance(value, list) else [value]):
+            if option.path == 'dir' and not Path(path).is_dir():
+                return value, f'{option.key}: directory {path} does not exist'
+            if option.path == 'file' and not Path(path).is_file():
+                return value, f'{option.key}: file {path} does not exist'
+    if option.check is not None:
+        error = option.check(value)
+        if error is not None:
+            return value, f'{option.key}: {error}'
+    return value, None
+
+
+def _summary_raw_files(summary_path: Path):
+    with open(summary_path, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        if reader.fieldnames is None or 'Raw file' not in reader.fieldnames:
+            return None
+        # the last row of summary.txt sums up all raw files
+        return [row['Raw file'] for row in reader if row['Raw file'] and row['Raw file'] != 'Total']
+
+
+def _check_input_files(config):
+    """
+    Check that all files the workflow reads exist: the MaxQuant tables, one spectra file per raw file of the
+    MaxQuant search and the fasta files
+    :param config: Dictionary of converted and otherwise valid config parameters
+    :return: List of error messages
+    """
+    errors = []
+    maxquant_dir = Path(config['inputs']['maxquant_results'])
+    missing = [f for f in MAXQUANT_FILES if not (maxquant_dir / f).is_file()]
+    raw_files = None if missing else _summary_raw_files(maxquant_dir / 'summary.txt')
+    if missing:
+        errors.append(f'inputs.maxquant_results: {", ".join(missing)} not found in {maxquant_dir}')
+    elif raw_files is None:
+        errors.append(f'inputs.maxquant_results: {maxquant_dir / "summary.txt"} has no "Raw file" column')
+    else:
+        spectra_dir = Path(config['inputs']['spectra'])
+        suffix = SPECTRA_SUFFIXES[config['inputs']['spectra_type']]
+        available = {p.stem for p in spectra_dir.iterdir() if p.suffix.lower() == suffix}
+        missing = sorted(set(raw_files) - available)
+        if missing:
+            errors.append(f'inputs.spectra: {len(missing)} {suffix} files of the MaxQuant search not found in '
+                          f'{spectra_dir}, e.g. {", ".join(missing[:3])}')
+
+    fasta = config['picked_protein_group_fdr']['fasta']
+    for fasta_file in (fasta if isinstance(fasta, list) else [fasta]):
+        if not Path(fasta_file).is_file():
+            errors.append(f'picked_protein_group_fdr.fasta: file {fasta_file} does not exist')
+    return errors
+
+
+def validate_config(config):
+    """
+    Check all parameters of config.toml before any work is done: types, allowed values, numeric ranges and the input
+    files they reference. Values are converted to their types, e.g. threads = "8" to 8, and missing optional values
+    are set to their defaults, so that the rest of the workflow can rely on them.
+    :param config: Dictionary of all config parameters generated from config.toml
+    :return: Validated copy of the config
+    :raise ConfigError: If any parameter is missing or invalid
+    """
+    config = copy.deepcopy(config)
+    errors = []
+    for option in CONFIG_SCHEMA:
+        section_name, name = option.key.split('.')
+        section = config.setdefault(section_name, {})
+        if not isinstance(section, dict):
+            errors.append(f'{section_name}: expected a [{section_name}] section')
+            continue
+        if name not in section:
+            if option.default is REQUIRED:
+                errors.append(f'{option.key}: missing')
+            else:
+                section[name] = option.default
+            continue
+        section[name], error = _validate_option(option, section[name])
+        if error is not None:
+            errors.append(error)
+
+    known = {option.key for option in CONFIG_SCHEMA}
+    sections = {key.split('.')[0] for key in known}
+    for section_name in sections:
+        if isinstance(config.get(section_name), dict):
+            for name in config[section_name]:
+                if f'{section_name}.{name}' not in known:
+                    logger.warning(f'Unknown config parameter {section_name}.{name} is ignored')
+
+    if not errors:
+        errors = _check_input_files(config)
+    if errors:
+        raise ConfigError(errors)
+    return config
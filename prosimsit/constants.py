@@ -1,3 +1,22 @@
+DEFAULT_MEMORY_BUDGET_MB = 4096
+# file suffix of intermediate tables per general.intermediate_format; TSV is kept for files read by external tools
+INTERMEDIATE_FORMATS = {'tsv': '.txt', 'parquet': '.parquet', 'feather': '.feather'}
+DEFAULT_INTERMEDIATE_FORMAT = 'parquet'
+# 'koinapy' for the synchronous client of Oktoberfest, 'async' for prediction_client.AsyncKoina; the asynchronous
+# client is opt-in until its predictions have been compared to koinapy against the public Koina server
+PREDICTION_CLIENTS = ['koinapy', 'async']
+PROFILERS = ['cprofile', 'py-spy']
+# ways to make an input file available in the output folder, cheapest first, see staging.stage_file
+STAGING_METHODS = ['reflink', 'hardlink', 'symlink', 'copy']
+DEFAULT_PREDICTION_CACHE_MB = 10240
+# requests to the prediction server waiting for their response at the same time, per worker process
+DEFAULT_MAX_REQUESTS_IN_FLIGHT = 8
+# maximum number of PSMs of a spectra file annotated in one task if the file has a spectrum store
+DEFAULT_CHUNK_PSMS = 20000
+# estimated peak memory of a single task, i.e. one spectra file in an Oktoberfest worker or one SIMSI-Transfer thread
+OKTOBERFEST_TASK_MEMORY_MB = 4096
+SIMSI_TASK_MEMORY_MB = 2048
+
 PROSIT_CONFIG = {
     "type": "Rescoring",
     "tag": "tmt",
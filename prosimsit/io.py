@@ -1,8 +1,169 @@
-import pandas as pd
+import os
+from contextlib import contextmanager
 from pathlib import Path
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from prosimsit.constants import INTERMEDIATE_FORMATS, DEFAULT_INTERMEDIATE_FORMAT
+
+# dtypes of columns that are shared between the intermediate tables
+TABLE_SCHEMA = {
+    'Scan number': 'int64',
+    'scanID': 'int64',
+    'Charge': 'int64',
+    'summary_ID': 'int64',
+    'posterior_error_prob': 'float64',
+    'PEP': 'float64',
+    'Score': 'float64',
+}
+
+
+def estimate_chunksize(path, memory_budget_mb, usecols=None, overhead_factor=4, sample_rows=1000):
+    """
+    Estimate how many rows of a tab-separated file can be held in memory at once within the given budget
+    :param path: Path to tab-separated file
+    :param memory_budget_mb: Memory budget in MB for a single chunk including parsing and merging overhead
+    :param usecols: Columns that will be read; None for all columns
+    :param overhead_factor: Ratio between peak memory while processing a chunk and the size of the parsed chunk
+    :param sample_rows: Number of rows used to estimate the in-memory size of a row
+    :return: Number of rows per chunk
+    """
+    sample = pd.read_csv(path, sep='\t', usecols=usecols, nrows=sample_rows)
+    bytes_per_row = max(sample.memory_usage(index=True, deep=True).sum() / max(len(sample), 1), 1)
+    return max(int(memory_budget_mb * 1024 ** 2 / (bytes_per_row * overhead_factor)), sample_rows)
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yield a temporary path next to path that is renamed to path only if the body finishes without error. Readers
+    therefore never see a partially written file, e.g. after a crashed or OOM-killed run.
+    :param path: Final path of the file
+    :return: Temporary path to write to
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def table_path(path, intermediate_format=DEFAULT_INTERMEDIATE_FORMAT):
+    """
+    Path of an intermediate table in the given format
+    :param path: Path of the table without suffix
+    :param intermediate_format: One of INTERMEDIATE_FORMATS
+    :return: Path with the suffix belonging to the format
+    """
+    if intermediate_format not in INTERMEDIATE_FORMATS:
+        raise ValueError(f'Unknown intermediate format: {intermediate_format}. '
+                         f'Use one of {", ".join(INTERMEDIATE_FORMATS)}.')
+    path = Path(path)
+    return path.with_name(path.name + INTERMEDIATE_FORMATS[intermediate_format])
+
+
+def _apply_schema(df: pd.DataFrame, schema):
+    schema = TABLE_SCHEMA if schema is None else schema
+    return df.astype({c: t for c, t in schema.items()
+                      if c in df.columns and not (t.startswith('int') and df[c].isna().any())})
+
+
+def write_table(df: pd.DataFrame, path, schema=None, **kwargs):
+    """
+    Atomically write a table; the format is chosen by the suffix of path, see INTERMEDIATE_FORMATS
+    :param df: Dataframe to write
+    :param path: Output path
+    :param schema: Dictionary of column dtypes to enforce; defaults to TABLE_SCHEMA, columns not in df are ignored
+    :param kwargs: Additional arguments passed to DataFrame.to_csv for tab-separated output
+    :return: None
+    """
+    path = Path(path)
+    df = _apply_schema(df, schema)
+    with atomic_path(path) as tmp_path:
+        if path.suffix == INTERMEDIATE_FORMATS['parquet']:
+            df.to_parquet(tmp_path, index=False, compression='zstd')
+        elif path.suffix == INTERMEDIATE_FORMATS['feather']:
+            df.reset_index(drop=True).to_feather(tmp_path, compression='zstd')
+        else:
+            df.to_csv(tmp_path, sep='\t', index=False, **kwargs)
+
+
+def read_table(path, columns=None, **kwargs):
+    """
+    Read a table written by write_table or a tab-separated text file, loading only the requested columns
+    :param path: Path to the table
+    :param columns: Columns to read; None for all columns
+    :param kwargs: Additional arguments passed to pandas.read_csv for tab-separated input
+    :return: Dataframe
+    """
+    path = Path(path)
+    if path.suffix == INTERMEDIATE_FORMATS['parquet']:
+        return pd.read_parquet(path, columns=columns)
+    if path.suffix == INTERMEDIATE_FORMATS['feather']:
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, sep='\t', usecols=columns, **kwargs)
+
+
+@contextmanager
+def table_writer(path, schema=None):
+    """
+    Atomically write a table chunk by chunk; the format is chosen by the suffix of path, see INTERMEDIATE_FORMATS.
+    Columnar chunks are cast to the column types of the first chunk.
+    :param path: Output path
+    :param schema: Dictionary of column dtypes to enforce; defaults to TABLE_SCHEMA, columns not in df are ignored
+    :return: Function that appends a dataframe to the table
+    """
+    path = Path(path)
+    with atomic_path(path) as tmp_path:
+        if path.suffix in (INTERMEDIATE_FORMATS['parquet'], INTERMEDIATE_FORMATS['feather']):
+            writers = []
+
+            def append(df: pd.DataFrame):
+                table = pa.Table.from_pandas(_apply_schema(df, schema), preserve_index=False)
+                if not writers:
+                    if path.suffix == INTERMEDIATE_FORMATS['parquet']:
+                        writer = pq.ParquetWriter(tmp_path, table.schema, compression='zstd')
+                    else:
+                        writer = pa.ipc.new_file(str(tmp_path), table.schema,
+                                                 options=pa.ipc.IpcWriteOptions(compression='zstd'))
+                    writers.append((writer, table.schema))
+                writer, table_schema = writers[0]
+                writer.write_table(table.cast(table_schema))
+
+            try:
+                yield append
+            finally:
+                for writer, _ in writers:
+                    writer.close()
+            if not writers and path.suffix == INTERMEDIATE_FORMATS['parquet']:
+                pd.DataFrame().to_parquet(tmp_path, index=False)
+            elif not writers:
+                pd.DataFrame().to_feather(tmp_path)
+        else:
+            with open(tmp_path, 'w', newline='') as f:
+                yield lambda df: _apply_schema(df, schema).to_csv(f, sep='\t', index=False, header=(f.tell() == 0))
+
 
-def read_msms_singlecol(msms_path: Path, onlycolumn):
-    if msms_path.is_dir():
-        msms_path = msms_path / 'msms.txt'
-    return pd.read_csv(msms_path, sep='\t', usecols=[onlycolumn])
\ No newline at end of file
+def iter_table(path, columns=None, chunksize=100_000):
+    """
+    Read a table written by write_table or table_writer, or a tab-separated text file, in chunks
+    :param path: Path to the table
+    :param columns: Columns to read; None for all columns
+    :param chunksize: Maximum number of rows per chunk
+    :return: Generator of dataframes
+    """
+    path = Path(path)
+    if path.suffix == INTERMEDIATE_FORMATS['parquet']:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    elif path.suffix == INTERMEDIATE_FORMATS['feather']:
+        for batch in feather.read_table(path, columns=columns, memory_map=True).to_batches(max_chunksize=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, sep='\t', usecols=columns, chunksize=chunksize)
@@ -0,0 +1,175 @@
+import sys
+import zlib
+import random
+import asyncio
+import logging
+import argparse
+
+import numpy as np
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+# fragment ions of the intensity models: y and b ions 1-29 in charges 1-3
+ANNOTATION = [f'{ion}{number}+{charge}' for number in range(1, 30) for ion in 'yb' for charge in range(1, 4)]
+
+
+def _model_inputs(model_name):
+    if 'irt' in model_name.lower():
+        return [('peptide_sequences', 'BYTES')]
+    inputs = [('peptide_sequences', 'BYTES'), ('precursor_charges', 'INT32'), ('collision_energies', 'FP32')]
+    if 'tmt' in model_name.lower():
+        inputs.append(('fragmentation_types', 'BYTES'))
+    return inputs
+
+
+def _model_outputs(model_name):
+    if 'irt' in model_name.lower():
+        return [('irt', 'FP32', [-1, 1])]
+    return [('intensities', 'FP32', [-1, len(ANNOTATION)]), ('mz', 'FP32', [-1, len(ANNOTATION)]),
+            ('annotation', 'BYTES', [-1, len(ANNOTATION)])]
+
+
+def predict(model_name, inputs):
+    """
+    Deterministic stand-in predictions that only depend on the model inputs of each peptide
+    :param model_name: Name of the model; models with 'irt' in their name predict iRT, all others intensities
+    :param inputs: Dictionary of model inputs with one row per peptide
+    :return: Dictionary of model outputs in the shapes and types of the Koina models
+    """
+    rows = len(inputs['peptide_sequences'])
+    keys = [b'\x1f'.join(str(inputs[name][i][0]).encode() for name in sorted(inputs)) for i in range(rows)]
+    seeds = np.array([zlib.crc32(key) for key in keys], dtype=np.float64).reshape(-1, 1)
+    if 'irt' in model_name.lower():
+        return {'irt': (seeds % 10000 / 100).astype(np.float32)}
+    ions = np.arange(1, len(ANNOTATION) + 1)
+    return {'intensities': ((np.sin(seeds * ions) + 1) / 2).astype(np.float32),
+            'mz': (100 + (seeds % 997) + 10 * ions).astype(np.float32),
+            'annotation': np.tile(np.array(ANNOTATION, dtype=object), (rows, 1))}
+
+
+def create_service(latency_seconds=0.0, failure_rate=0.0, max_batch_size=1000, seed=0):
+    """
+    :param latency_seconds: Delay of every response, e.g. the round-trip time to a remote server
+    :param failure_rate: Fraction of inference requests that fail with UNAVAILABLE
+    :param max_batch_size: Maximum batch size reported in the model configs
+    :param seed: Seed of the random generator deciding which requests fail
+    :return: gRPC servicer speaking the KServe v2 protocol of Koina for any model name
+    """
+    import grpc
+    from tritonclient.grpc import service_pb2, service_pb2_grpc, model_config_pb2
+    from tritonclient.utils import deserialize_bytes_tensor, serialize_byte_tensor, triton_to_np_dtype
+
+    class StandInService(service_pb2_grpc.GRPCInferenceServiceServicer):
+        def __init__(self):
+            self.random = random.Random(seed)
+            self.requests = 0
+            self.peptides = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        async def ServerLive(self, request, context):
+            return service_pb2.ServerLiveResponse(live=True)
+
+        async def ServerReady(self, request, context):
+            return service_pb2.ServerReadyResponse(ready=True)
+
+        async def ModelReady(self, request, context):
+            return service_pb2.ModelReadyResponse(ready=True)
+
+        async def ModelMetadata(self, request, context):
+            tensor = service_pb2.ModelMetadataResponse.TensorMetadata
+            return service_pb2.ModelMetadataResponse(
+                name=request.name, versions=['1'], platform='ensemble',
+                inputs=[tensor(name=name, datatype=datatype, shape=[-1, 1])
+                        for name, datatype in _model_inputs(request.name)],
+                outputs=[tensor(name=name, datatype=datatype, shape=shape)
+                         for name, datatype, shape in _model_outputs(request.name)])
+
+        async def ModelConfig(self, request, context):
+            return service_pb2.ModelConfigResponse(
+                config=model_config_pb2.ModelConfig(name=request.name, max_batch_size=max_batch_size))
+
+        async def ModelInfer(self, request, context):
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(latency_seconds)
+                if self.random.random() < failure_rate:
+                    await context.abort(grpc.StatusCode.UNAVAILABLE, 'Injected failure')
+                inputs = {}
+                for tensor, content in zip(request.inputs, request.raw_input_contents):
+                    if tensor.datatype == 'BYTES':
+                        array = deserialize_bytes_tensor(content).astype(str)
+                    else:
+                        array = np.frombuffer(content, dtype=triton_to_np_dtype(tensor.datatype))
+                    inputs[tensor.name] = array.reshape(list(tensor.shape))
+                rows = len(inputs['peptide_sequences'])
+                if rows > max_batch_size:
+                    await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                        f'Batch of {rows} exceeds the maximum batch size {max_batch_size}')
+                self.peptides += rows
+                outputs = predict(request.model_name, inputs)
+                requested = [o.name for o in request.outputs] or list(outputs)
+                response = service_pb2.ModelInferResponse(model_name=request.model_name, id=request.id)
+                for name, datatype, _ in _model_outputs(request.model_name):
+                    if name not in requested:
+                        continue
+                    array = outputs[name]
+                    response.outputs.add(name=name, datatype=datatype, shape=list(array.shape))
+                    if datatype == 'BYTES':
+                        response.raw_output_contents.append(serialize_byte_tensor(array).item())
+                    else:
+                        response.raw_output_contents.append(np.ascontiguousarray(array).tobytes())
+                return response
+            finally:
+                self.in_flight -= 1
+
+    return StandInService()
+
+
+async def start_server(port=0, **kwargs):
+    """
+    Start a local stand-in for a Koina server, e.g. to test or benchmark prediction clients without network access
+    :param port: Port to listen on; 0 for any free port
+    :param kwargs: Arguments of create_service(), e.g. latency_seconds
+    :return: Tuple of the started grpc.aio server, its servicer and the address of the server
+    """
+    import grpc
+    from tritonclient.grpc import service_pb2_grpc
+
+    server = grpc.aio.server()
+    service = create_service(**kwargs)
+    service_pb2_grpc.add_GRPCInferenceServiceServicer_to_server(service, server)
+    port = server.add_insecure_port(f'localhost:{port}')
+    await server.start()
+    logger.info(f'Koina stand-in server listening on localhost:{port}')
+    return server, service, f'localhost:{port}'
+
+
+def parse_args(argv):
+    apars = argparse.ArgumentParser(
+        description='Local stand-in for a Koina prediction server with deterministic predictions',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    apars.add_argument('--port', type=int, default=8500, help='Port to listen on.')
+    apars.add_argument('--latency', type=float, default=0.0, help='Delay of every response in seconds.')
+    apars.add_argument('--failure_rate', type=float, default=0.0,
+                       help='Fraction of inference requests that fail with UNAVAILABLE.')
+    apars.add_argument('--max_batch_size', type=int, default=1000, help='Maximum batch size of the models.')
+    apars.add_argument('--seed', type=int, default=0, help='Seed of the random generator.')
+    return apars.parse_args(argv)
+
+
+async def serve(args):
+    server, _, _ = await start_server(args.port, latency_seconds=args.latency, failure_rate=args.failure_rate,
+                                      max_batch_size=args.max_batch_size, seed=args.seed)
+    await server.wait_for_termination()
+
+
+def main(argv):
+    asyncio.run(serve(parse_args(argv)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -7,40 +7,393 @@ import logging
 from pathlib import Path
 from datetime import datetime
 
-from oktoberfest import runner as oktoberfest_runner
-from simsi_transfer import main as simsi_main
-
-import prosimsit.oktoberfest_functions as oktoberfest
-import prosimsit.simsi_functions as simsi
-import prosimsit.picked_fdr_functions as picked
-import prosimsit.raw as raw
-import prosimsit.utils as utils
 import prosimsit.command_line_interface as cli
-import prosimsit.io as io
+from prosimsit.config import ConfigError, validate_config
+from prosimsit.constants import OKTOBERFEST_TASK_MEMORY_MB, SIMSI_TASK_MEMORY_MB
 
 from . import __version__, __copyright__
 
 logger = logging.getLogger(__name__)
 
 
+def build_pipeline(config, output_dir: Path, run_report=None, incremental=False):
+    """
+    Declare all ProSIMSIt stages with their inputs, outputs and the config values they depend on
+    :param config: Dictionary of all config parameters returned by config.validate_config()
+    :param output_dir: ProSIMSIt output directory
+    :param run_report: RunReport recording the resource usage of each stage; None to not write a report
+    :param incremental: Update the results of a previous run to added raw files instead of recomputing them, see
+        Stage.refresh
+    :return: Tuple of the Pipeline containing all stages and the MaxQuantTables of the MaxQuant search
+    """
+    # imported here so that --help and --validate do not wait for Oktoberfest, SIMSI-Transfer, Picked Protein Group FDR
+    # and pandas to be imported
+    import prosimsit.oktoberfest_functions as oktoberfest
+    import prosimsit.simsi_functions as simsi
+    import prosimsit.picked_fdr_functions as picked
+    import prosimsit.raw as raw
+    import prosimsit.utils as utils
+    import prosimsit.io as io
+    import prosimsit.maxquant as maxquant
+    import prosimsit.stages as stages
+    import prosimsit.scheduler as scheduler
+    from prosimsit.scheduler import Footprint
+    from prosimsit.prediction_cache import PredictionCache
+    from prosimsit.modifications import ModificationTable
+
+    threads = config['general']['threads']
+    memory_budget_mb = config['general']['memory_budget_mb']
+    max_memory_mb = config['general']['max_memory_mb'] or scheduler.available_memory_mb()
+    intermediate_format = config['general']['intermediate_format']
+    staging = config['general']['staging']
+    spectrum_store_dir = output_dir / 'spectrum_store' if config['general']['spectrum_store'] else None
+    chunk_psms = config['general']['chunk_psms']
+    modifications = ModificationTable(config['general']['modifications'])
+    prediction_cache_mb = config['general']['prediction_cache_mb']
+    prediction_cache = None
+    if prediction_cache_mb > 0:
+        prediction_cache = PredictionCache(
+            config['general']['prediction_cache'] or output_dir / 'prediction_cache.sqlite', prediction_cache_mb)
+
+    maxquant_dir = Path(config['inputs']['maxquant_results'])
+    raw_dir = Path(config['inputs']['spectra'])
+    raw_type = config['inputs']['spectra_type']
+
+    pipeline = stages.Pipeline(output_dir, run_report, scheduler.ResourceBudget(threads, max_memory_mb), incremental)
+    logger.info(f'Resource budget: {threads} cores, '
+                + ('no memory limit' if max_memory_mb is None else f'{max_memory_mb:.0f} MB'))
+
+    maxquant_tables = maxquant.MaxQuantTables(maxquant_dir, pipeline.state_dir / 'maxquant', pipeline.digests,
+                                              memory_budget_mb)
+
+    logger.info(f'Retrieving .raw files')
+    raw_files = sorted(set(maxquant_tables.read('msms', columns=['Raw file'])['Raw file']))
+    mzml_dir, spectra_files = raw.get_spectra_files(raw_type, raw_dir, raw_files, output_dir)
+
+    oktoberfest_config_path = output_dir / 'config_oktoberfest.json'
+    ok1_out = output_dir / 'oktoberfest_1_out'
+    ok1_percolator = ok1_out / 'results' / 'percolator'
+    # chunked annotation keeps more workers busy than there are spectra files
+    oktoberfest_max_tasks = None if spectrum_store_dir is not None and chunk_psms > 0 else len(spectra_files)
+
+    def prepare_first_oktoberfest():
+        logger.info(f'Building config.json for first Oktoberfest run')
+        mzml_dir.mkdir(parents=True, exist_ok=True)
+        oktoberfest.generate_oktoberfest_config(config, mzml_dir, oktoberfest_config_path)
+        return oktoberfest.load_first_oktoberfest_run(oktoberfest_config_path, spectra_files)
+
+    def refresh_first_oktoberfest():
+        conf, _ = prepare_first_oktoberfest()
+        oktoberfest.refresh_search_results(conf, spectra_files)
+
+    def run_first_oktoberfest_shard(shard_raw_files, allocation):
+        conf, ok1_spectra_files = oktoberfest.load_first_oktoberfest_run(oktoberfest_config_path, spectra_files)
+        conf.data['numThreads'] = allocation.tasks
+        oktoberfest.process_first_oktoberfest_files(conf, [f for f in ok1_spectra_files if f.stem in shard_raw_files],
+                                                    raw_dir=raw_dir if raw_type == 'raw' else None,
+                                                    prediction_cache=prediction_cache,
+                                                    spectrum_store_dir=spectrum_store_dir, chunk_psms=chunk_psms)
+
+    def run_first_oktoberfest(allocation):
+        conf, ok1_spectra_files = prepare_first_oktoberfest()
+        # Oktoberfest sizes its worker pools and Percolator by numThreads
+        conf.data['numThreads'] = allocation.tasks
+        logger.info(f'Executing first Oktoberfest run')
+        oktoberfest.process_first_oktoberfest_files(conf, ok1_spectra_files,
+                                                    raw_dir=raw_dir if raw_type == 'raw' else None,
+                                                    prediction_cache=prediction_cache,
+                                                    spectrum_store_dir=spectrum_store_dir, chunk_psms=chunk_psms)
+        oktoberfest.rescore_first_oktoberfest(conf, ok1_spectra_files)
+
+    pipeline.add(stages.Stage(
+        name='oktoberfest_1',
+        run=run_first_oktoberfest,
+        inputs=([raw_dir / f'{f}.raw' for f in raw_files] if raw_type == 'raw' else [mzml_dir]) + [
+            maxquant_dir / 'msms.txt'],
+        outputs=[mzml_dir, oktoberfest_config_path, ok1_percolator / 'rescore.tab',
+                 ok1_percolator / 'rescore.percolator.psms.txt', ok1_percolator / 'rescore.percolator.decoy.psms.txt',
+                 ok1_percolator / 'rescore.percolator.weights.csv'],
+        config=stages.config_slice(config, 'prosit', 'inputs.spectra_type'),
+        workdir=ok1_out,
+        refresh=refresh_first_oktoberfest,
+        prepare_shards=prepare_first_oktoberfest,
+        run_shard=run_first_oktoberfest_shard,
+        footprint=Footprint(cores=1, memory_mb=OKTOBERFEST_TASK_MEMORY_MB, max_tasks=oktoberfest_max_tasks)))
+
+    simsi_input = output_dir / 'simsi_input'
+
+    def run_simsi_file_preparation(allocation):
+        logger.info(f'Staging MaxQuant tables for SIMSI-Transfer')
+        os.makedirs(simsi_input, exist_ok=True)
+        simsi.prepare_simsi_files(maxquant_dir, output_dir, threads=allocation.tasks, staging=staging)
+
+    # staging only depends on the MaxQuant search, so it runs while the first Oktoberfest run is busy
+    pipeline.add(stages.Stage(
+        name='simsi_files',
+        run=run_simsi_file_preparation,
+        inputs=[maxquant_dir / f for f in simsi.SIMSI_INPUT_FILES],
+        outputs=[simsi_input / f for f in simsi.SIMSI_INPUT_FILES],
+        footprint=Footprint(cores=0, max_tasks=len(simsi.SIMSI_INPUT_FILES))))
+
+    def run_simsi_input_preparation(allocation):
+        logger.info(f'Preparing input file for SIMSI-Transfer')
+        os.makedirs(simsi_input, exist_ok=True)
+        utils.prosit_to_simsi(
+            maxquant_tables,
+            ok1_percolator,
+            simsi_input / 'msms.txt',
+            raw_files,
+            memory_budget_mb=memory_budget_mb)
+
+    pipeline.add(stages.Stage(
+        name='simsi_input',
+        run=run_simsi_input_preparation,
+        inputs=[maxquant_dir / 'msms.txt', ok1_percolator / 'rescore.percolator.psms.txt',
+                ok1_percolator / 'rescore.percolator.decoy.psms.txt'],
+        outputs=[simsi_input / 'msms.txt'],
+        depends_on=['oktoberfest_1'],
+        footprint=Footprint(memory_mb=memory_budget_mb)))
+
+    simsi_output = output_dir / 'simsi_output'
+    simsi_p10_msms = simsi_output / 'summaries/p10/p10_msms.txt'
+
+    def run_simsi(allocation):
+        from simsi_transfer import main as simsi_main
+
+        logger.info(f'Starting SIMSI-Transfer')
+        simsi_args = [
+            '--mq_txt_folder', str(simsi_input),
+            '--raw_folder', str(mzml_dir),
+            '--output_folder', str(simsi_output),
+            '--cache_folder', str(simsi_output),
+            '--stringencies', str(config['simsi']['stringency']),
+            '--maximum_pep', str(config['simsi']['max_pep']),
+            '--num_threads', str(allocation.tasks),
+            '--tmt_ms_level', str(config['general']['tmt_ms_level']),
+            '--ambiguity_decision', 'keep_all',
+            '--skip_evidence', '--skip_msmsscans'
+        ]
+        simsi_main.main(simsi_args)
+        logger.info(f'Finished SIMSI-Transfer!')
+
+    pipeline.add(stages.Stage(
+        name='simsi',
+        run=run_simsi,
+        inputs=[simsi_input, mzml_dir],
+        outputs=[simsi_p10_msms],
+        config=stages.config_slice(config, 'simsi', 'general.tmt_ms_level'),
+        depends_on=['simsi_input', 'simsi_files'],
+        workdir=simsi_output,
+        refresh=lambda: simsi.refresh_simsi_output(simsi_output),
+        footprint=Footprint(cores=1, memory_mb=SIMSI_TASK_MEMORY_MB, max_tasks=None)))
+
+    ok2_out = output_dir / 'oktoberfest_2_out'
+    ok2_percolator = ok2_out / 'results' / 'percolator'
+
+    def prepare_second_oktoberfest():
+        msms_for_prosit_2 = utils.prepare_input_for_second_oktoberfest(simsi_output)
+
+        conf = oktoberfest.prepare_second_oktoberfest_run(mzml_dir, oktoberfest_config_path, msms_for_prosit_2,
+                                                          output_dir, staging)
+        return conf, oktoberfest.preprocess_spectra_files(conf)
+
+    def refresh_second_oktoberfest():
+        # the collision energies of the previous run are overwritten when the new ones are staged
+        if (oktoberfest_config_path.parent / oktoberfest.SECOND_RUN_CONFIG).is_file():
+            oktoberfest.save_split_digests(oktoberfest.load_second_oktoberfest_run(oktoberfest_config_path))
+        conf, _ = prepare_second_oktoberfest()
+        oktoberfest.refresh_search_results(conf, oktoberfest.list_spectra_files(conf), keep_ce_calibration=True)
+
+    def run_second_oktoberfest_shard(shard_raw_files, allocation):
+        conf = oktoberfest.load_second_oktoberfest_run(oktoberfest_config_path)
+        conf.data['numThreads'] = allocation.tasks
+        ok2_spectra_files = oktoberfest.preprocess_spectra_files(conf)
+        oktoberfest.process_spectra_files([f for f in ok2_spectra_files if f.stem in shard_raw_files], conf,
+                                          prediction_cache, spectrum_store_dir, chunk_psms)
+
+    def run_second_oktoberfest(allocation):
+        logger.info(f'Starting second Oktoberfest run')
+        conf, ok2_spectra_files = prepare_second_oktoberfest()
+        conf.data['numThreads'] = allocation.tasks
+        oktoberfest.process_spectra_files(ok2_spectra_files, conf, prediction_cache, spectrum_store_dir, chunk_psms)
+        logger.info(f'Finished second Oktoberfest run')
+
+    pipeline.add(stages.Stage(
+        name='oktoberfest_2',
+        run=run_second_oktoberfest,
+        inputs=[simsi_p10_msms, mzml_dir, oktoberfest_config_path, ok1_out / 'results'],
+        outputs=[ok2_percolator],
+        config=stages.config_slice(config, 'prosit'),
+        depends_on=['simsi'],
+        workdir=ok2_out,
+        refresh=refresh_second_oktoberfest,
+        prepare_shards=prepare_second_oktoberfest,
+        run_shard=run_second_oktoberfest_shard,
+        footprint=Footprint(cores=1, memory_mb=OKTOBERFEST_TASK_MEMORY_MB, max_tasks=oktoberfest_max_tasks)))
+
+    percolator_dir = output_dir / 'ProSIMSIt/percolator'
+    input_file = percolator_dir / 'rescore_all.tab'
+
+    def run_merge_rescore_files(allocation):
+        logger.info(f'Preparing for percolator run')
+        os.makedirs(percolator_dir, exist_ok=True)
+        utils.merge_rescore_files(ok1_dir=ok1_percolator, ok2_dir=ok2_percolator, output_file=input_file,
+                                  threads=allocation.tasks, memory_budget_mb=memory_budget_mb)
+
+    # every reading thread holds one rescore file of the second run
+    pipeline.add(stages.Stage(
+        name='merge_rescore',
+        run=run_merge_rescore_files,
+        inputs=[ok1_percolator / 'rescore.tab', ok2_percolator],
+        outputs=[input_file],
+        depends_on=['oktoberfest_2'],
+        footprint=Footprint(cores=1, memory_mb=memory_budget_mb, max_tasks=len(spectra_files))))
+
+    target_psms = percolator_dir / 'rescore_all.percolator.psms.txt'
+    decoy_psms = percolator_dir / 'rescore_all.percolator.decoy.psms.txt'
+    target_peptides = percolator_dir / 'rescore_all.percolator.peptides.txt'
+    decoy_peptides = percolator_dir / 'rescore_all.percolator.decoy.peptides.txt'
+    log_file = percolator_dir / 'rescore_all.log'
+    weights_file = ok1_percolator / 'rescore.percolator.weights.csv'
+
+    def run_percolator(allocation):
+        logger.info(f'Starting Percolator run')
+        cmd = ['percolator', '--init-weights', str(weights_file),
+               '--static',
+               '--num-threads', str(allocation.tasks),
+               '--subset-max-train', '500000',
+               '--post-processing-tdc',
+               '--testFDR', '0.01',
+               '--trainFDR', '0.01',
+               '--results-psms', str(target_psms),
+               '--decoy-results-psms', str(decoy_psms),
+               '--results-peptides', str(target_peptides),
+               '--decoy-results-peptides', str(decoy_peptides),
+               str(input_file)]
+        with open(log_file, 'w') as log:
+            subprocess.run(cmd, stderr=log, check=True)
+        logger.info(f'Finished Percolator run')
+
+    pipeline.add(stages.Stage(
+        name='percolator',
+        run=run_percolator,
+        inputs=[input_file, weights_file],
+        outputs=[target_psms, decoy_psms, target_peptides, decoy_peptides],
+        depends_on=['merge_rescore'],
+        footprint=Footprint(cores=1, memory_mb=memory_budget_mb, max_tasks=None)))
+
+    picked_dir = output_dir / 'ProSIMSIt/PickedProteinGroupFDR'
+    merged_msms = io.table_path(picked_dir / 'merged_msms', intermediate_format)
+
+    def run_evidence_assembly(allocation):
+        logger.info(f'Assembling evidence file for Picked Protein Group FDR')
+        os.makedirs(picked_dir, exist_ok=True)
+        utils.prepare_for_building_evidence(
+            target_psms,
+            decoy_psms,
+            simsi_p10_msms,
+            maxquant_tables,
+            merged_msms,
+            raw_files,
+            modifications)
+
+        simsi.build_evidence(merged_msms, maxquant_tables, picked_dir, threads=allocation.tasks)
+        logger.info(f'Evidence assembly finished!')
+
+    pipeline.add(stages.Stage(
+        name='evidence',
+        run=run_evidence_assembly,
+        inputs=[target_psms, decoy_psms, simsi_p10_msms] + [
+            maxquant_dir / f for f in ['msms.txt', 'summary.txt', 'evidence.txt', 'allPeptides.txt']],
+        outputs=[merged_msms, picked_dir / 'evidence.txt'],
+        config=stages.config_slice(config, 'general.modifications'),
+        depends_on=['percolator'],
+        # every worker process builds the evidence of one experiment and fraction at a time
+        footprint=Footprint(memory_mb=memory_budget_mb, max_tasks=None)))
+
+    target_psms_dash = percolator_dir / 'rescore_all.percolator.psms.dash.txt'
+    decoy_psms_dash = percolator_dir / 'rescore_all.percolator.decoy.psms.dash.txt'
+
+    def run_picked_fdr_input_preparation(allocation):
+        logger.info(f'Preparing Percolator results for Picked Protein Group FDR')
+        picked.prepare_picked_fdr_input(percolator_dir, threads=allocation.tasks)
+
+    pipeline.add(stages.Stage(
+        name='picked_input',
+        run=run_picked_fdr_input_preparation,
+        inputs=[target_psms, decoy_psms],
+        outputs=[target_psms_dash, decoy_psms_dash],
+        depends_on=['percolator'],
+        footprint=Footprint(memory_mb=memory_budget_mb, max_tasks=2)))
+
+    fasta = config['picked_protein_group_fdr']['fasta']
+    fasta_files = [Path(f) for f in (fasta if type(fasta) == list else [fasta])]
+    peptide_index_dir = Path(config['picked_protein_group_fdr']['peptide_index'] or output_dir / 'peptide_index')
+
+    def run_peptide_index(allocation):
+        logger.info(f'Building peptide index for Picked Protein Group FDR')
+        picked.build_peptide_index(fasta, config['picked_protein_group_fdr']['enzyme'], peptide_index_dir,
+                                   pipeline.digests)
+
+    # the digestion of the fasta files only depends on the config, so it runs concurrently with the
+    # earlier stages and is usually done before the PSMs are rescored
+    pipeline.add(stages.Stage(
+        name='peptide_index',
+        run=run_peptide_index,
+        inputs=fasta_files,
+        config=stages.config_slice(config, 'picked_protein_group_fdr'),
+        footprint=Footprint(cores=1, memory_mb=memory_budget_mb)))
+
+    def run_picked_fdr(allocation):
+        logger.info(f'Applying Picked Protein Group FDR')
+        picked.run_picked_protein_group_fdr(percolator_dir, picked_dir, fasta,
+                                            config['picked_protein_group_fdr']['enzyme'],
+                                            index_dir=peptide_index_dir, digests=pipeline.digests)
+        logger.info(f'Picked Protein Group FDR application finished!')
+
+    pipeline.add(stages.Stage(
+        name='picked_fdr',
+        run=run_picked_fdr,
+        inputs=[target_psms_dash, decoy_psms_dash, picked_dir / 'evidence.txt'] + fasta_files,
+        outputs=[picked_dir / 'group_results.txt'],
+        config=stages.config_slice(config, 'picked_protein_group_fdr.enzyme'),
+        depends_on=['evidence', 'picked_input', 'peptide_index'],
+        footprint=Footprint(memory_mb=memory_budget_mb)))
+
+    return pipeline, maxquant_tables
+
+
 def main(argv):
-    config = cli.read_config(argv)
+    args = cli.parse_args(argv)
+    config = cli.read_config(args.config_path)
     print(config)
+    try:
+        config = validate_config(config)
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if args.validate:
+        logger.info(f'Configuration {args.config_path} is valid')
+        return
+
+    import prosimsit.report as report
+    import prosimsit.shards as shards
 
     if config['general']['debug_mode']:
         logging.basicConfig(level=logging.DEBUG)
 
     output_dir = Path(config['general']['output'])
-    threads = int(config['general']['threads'])
-
-    maxquant_dir = Path(config['inputs']['maxquant_results'])
-    raw_dir = Path(config['inputs']['spectra'])
-    raw_type = config['inputs']['spectra_type']
-
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    # shard workers may run concurrently with each other and write their own log and report
+    run_name = 'ProSIMSIt'
+    if args.plan_shards is not None or args.shard is not None:
+        run_name = f'{shards.SHARD_DIR}/{args.shard_stage}.' + (
+            'prepare' if args.shard is None else f'shard_{args.shard}')
+        (output_dir / shards.SHARD_DIR).mkdir(parents=True, exist_ok=True)
+
     module_name = ".".join(__name__.split(".")[:-1])
-    file_logger = logging.FileHandler(output_dir / Path('ProSIMSIt.log'))
+    file_logger = logging.FileHandler(output_dir / Path(f'{run_name}.log'))
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
     formatter.converter = time.gmtime
     file_logger.setFormatter(formatter)
@@ -55,133 +408,25 @@ def main(argv):
     logger.info(f'Starting ProSIMSIt')
     logger.info('')
 
-    logger.info(f'Retrieving .raw files')
-    msms = io.read_msms_singlecol(maxquant_dir, 'Raw file')
-
-    mzml_dir = raw.convert_and_get_path(raw_type, threads, raw_dir, msms, output_dir)
-
-    logger.info(f'Building config.json for first Oktoberfest run')
-    oktoberfest_config_path = output_dir / 'config_oktoberfest.json'
-    oktoberfest.generate_oktoberfest_config(config, mzml_dir, oktoberfest_config_path)
-
-    logger.info(f'Executing first Oktoberfest run')
-    if (output_dir / 'oktoberfest_1_out/results/percolator/rescore.percolator.psms.txt').is_file():
-        logger.info(f'Found previous Oktoberfest run; skipping...')
-    else:
-        oktoberfest_runner.run_job(oktoberfest_config_path)
-
-    logger.info(f'Preparing input file for SIMSI-Transfer')
-    raw_file_hyphen = os.listdir(mzml_dir)[0].count('-')
-    os.makedirs(output_dir / 'simsi_input', exist_ok=True)
-
-    ok1_percolator = output_dir / 'oktoberfest_1_out' / 'results' / 'percolator'
-
-    utils.prosit_to_simsi(
-        maxquant_dir / 'msms.txt',
-        ok1_percolator,
-        output_dir / 'simsi_input' / 'msms.txt',
-        raw_file_hyphens=raw_file_hyphen)
-
-    simsi.prepare_simsi_files(maxquant_dir, output_dir)
-
-    logger.info(f'Starting SIMSI-Transfer')
-
-    simsi_stringency = config['simsi']['stringency']
-    simsi_max_pep = config['simsi']['max_pep']
-    tmt_level = config['general']['tmt_ms_level']
-    simsi_output = output_dir / 'simsi_output'
-
-    simsi_args = [
-        '--mq_txt_folder', str(output_dir / 'simsi_input'),
-        '--raw_folder', str(mzml_dir),
-        '--output_folder', str(simsi_output),
-        '--cache_folder', str(output_dir / 'simsi_output'),
-        '--stringencies', str(simsi_stringency),
-        '--maximum_pep', str(simsi_max_pep),
-        '--num_threads', str(threads),
-        '--tmt_ms_level', str(tmt_level),
-        '--ambiguity_decision', 'keep_all',
-        '--skip_evidence', '--skip_msmsscans'
-    ]
-    if (simsi_output / 'summaries/p10/p10_msms.txt').is_file():
-        logger.info(f'Found previous SIMSI-Transfer run; skipping...')
+    report_file = report.REPORT_FILE if run_name == 'ProSIMSIt' else f'{run_name}.run_report.json'
+    run_report = report.RunReport(output_dir / report_file,
+                                  profiler=config['general']['profiler'] or None,
+                                  metadata={'version': __version__, 'command': [str(a) for a in argv]})
+    pipeline, maxquant_tables = build_pipeline(config, output_dir, run_report, incremental=args.add_batches)
+    if args.launch_local is not None:
+        shards.launch_local(pipeline, args.config_path, args.launch_local)
+    elif args.plan_shards is not None:
+        shards.prepare_shards(pipeline, args.shard_stage, maxquant_tables, args.plan_shards)
+    elif args.shard is not None:
+        shards.run_shard(pipeline, args.shard_stage, args.shard)
     else:
-        simsi_main.main(simsi_args)
-    logger.info(f'Finished SIMSI-Transfer!')
-
-    logger.info(f'Starting second Oktoberfest run')
-    msms_for_prosit_2 = utils.prepare_input_for_second_oktoberfest(simsi_output)
-
-    conf = oktoberfest.prepare_second_oktoberfest_run(mzml_dir, oktoberfest_config_path, msms_for_prosit_2, output_dir)
-    spectra_files = oktoberfest.preprocess_spectra_files(conf)
-    oktoberfest.annotate_library(spectra_files, conf)
-    oktoberfest.generate_pred_files(conf)
-    oktoberfest.calculate_featuers(spectra_files, conf)
-    logger.info(f'Finished second Oktoberfest run')
-
-    #####
-
-    logger.info(f'Preparing for percolator run')
-    percolator_dir = output_dir / 'ProSIMSIt/percolator'
-    os.makedirs(percolator_dir, exist_ok=True)
-    utils.merge_rescore_files(ok1_dir=ok1_percolator, ok2_dir=conf.output / 'results/percolator', output_dir=percolator_dir)
-
-    #####
-
-    logger.info(f'Starting Percolator run')
-
-    target_psms = Path(f"{percolator_dir}/rescore_all.percolator.psms.txt")
-    decoy_psms = Path(f"{percolator_dir}/rescore_all.percolator.decoy.psms.txt")
-    target_peptides = Path(f"{percolator_dir}/rescore_all.percolator.peptides.txt")
-    decoy_peptides = Path(f"{percolator_dir}/rescore_all.percolator.decoy.peptides.txt")
-    input_file = Path(f"{percolator_dir}/rescore_all.tab")
-    log_file = Path(f"{percolator_dir}/rescore_all.log")
-
-    if target_psms.is_file():
-        logger.info(f'Percolator run already exists; reusing')
-    else:
-        cmd = f"percolator --init-weights {ok1_percolator}/rescore.percolator.weights.csv \
-                            --static \
-                            --num-threads {threads} \
-                            --subset-max-train 500000 \
-                            --post-processing-tdc \
-                            --testFDR 0.01 \
-                            --trainFDR 0.01 \
-                            --results-psms {target_psms} \
-                            --decoy-results-psms {decoy_psms} \
-                            --results-peptides {target_peptides} \
-                            --decoy-results-peptides {decoy_peptides} \
-                            {input_file} 2> {log_file}"
-
-        subprocess.run(cmd, shell=True, check=True)
-    logger.info(f'Finished Percolator run')
-
-    logger.info(f'Assembling evidence file for Picked Protein Group FDR')
-    picked_dir = output_dir / 'ProSIMSIt/PickedProteinGroupFDR'
-    os.makedirs(picked_dir, exist_ok=True)
-    utils.prepare_for_building_evidence(
-        f'{percolator_dir}/rescore_all.percolator.psms.txt',
-        f'{percolator_dir}/rescore_all.percolator.decoy.psms.txt',
-        f'{simsi_output}/summaries/p10/p10_msms.txt',
-        f'{maxquant_dir}/msms.txt',
-        f'{maxquant_dir}/summary.txt',
-        f'{picked_dir}/merged_msms.txt',
-        number_of_hyphen=raw_file_hyphen)
-
-    simsi.build_evidence(f'{picked_dir}/merged_msms.txt', maxquant_dir, picked_dir)
-    logger.info(f'Evidence assembly finished!')
-
-    logger.info(f'Applying Picked Protein Group FDR')
-    picked.run_picked_protein_group_fdr(percolator_dir, picked_dir, config['picked_protein_group_fdr']['fasta'],
-                                 config['picked_protein_group_fdr']['enzyme'])
-    # picked
-    logger.info(f'Picked Protein Group FDR application finished!')
+        pipeline.run(from_stage=args.from_stage, until_stage=args.until_stage)
+    run_report.finish()
 
     endtime = datetime.now()
     logger.info(f'ProSIMSIt finished in {endtime - starttime}!')
 
     # TODO:
-    # Filechecks to remove unnecessary re-writes
     # Plotting of Oktoberfest 2
 
 
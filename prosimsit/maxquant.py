@@ -0,0 +1,198 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Dict
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from prosimsit.io import estimate_chunksize, write_table
+from prosimsit.stages import DigestCache
+from prosimsit.constants import DEFAULT_MEMORY_BUDGET_MB
+import prosimsit.report as report
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+
+@dataclass
+class TableSchema:
+    """
+    Schema of a MaxQuant txt table.
+    :param file_name: Name of the file in the MaxQuant txt folder
+    :param dtypes: Dtypes of known columns; other columns are inferred
+    :param projection: If True, only the columns in dtypes that are present in the file are cached
+    """
+    file_name: str
+    dtypes: Dict[str, str] = field(default_factory=dict)
+    projection: bool = False
+
+
+# column dtypes follow the readers of SIMSI-Transfer so that cached tables can be passed to it directly
+MAXQUANT_TABLES = {
+    'msms': TableSchema('msms.txt', {
+        'Raw file': 'str',
+        'Scan number': 'int64',
+        'Charge': 'int64',
+    }),
+    'summary': TableSchema('summary.txt', {
+        'Raw file': 'str',
+    }),
+    'evidence': TableSchema('evidence.txt', {
+        'Sequence': 'object',
+        'Modified sequence': 'object',
+        'Leading proteins': 'object',
+        'Raw file': 'object',
+        'Experiment': 'object',
+        'Fraction': 'int8',
+        'Charge': 'int8',
+        'Calibrated retention time': 'float32',
+        'Retention time': 'float32',
+        'Retention length': 'float32',
+        'Calibrated retention time start': 'float32',
+        'Calibrated retention time finish': 'float32',
+        'Retention time calibration': 'float32',
+        'Type': 'object',
+        'Intensity': 'float32',
+        'Reverse': 'category',
+    }, projection=True),
+    'allPeptides': TableSchema('allPeptides.txt', {
+        'Raw file': 'object',
+        'Type': 'object',
+        'Charge': 'int8',
+        'm/z': 'float32',
+        'Retention time': 'float32',
+        'Retention length': 'float32',
+        'Min scan number': 'Int32',
+        'Max scan number': 'Int32',
+        'Intensity': 'float32',
+    }, projection=True),
+}
+
+
+class MaxQuantTables:
+    """
+    Access to the MaxQuant txt tables through a columnar cache. Each table is parsed from text once, in chunks sized
+    to the memory budget, and stored as parquet parts in a directory keyed by the content hash of the text file and
+    the table schema. All later reads only load the requested columns from the cache.
+    """
+    def __init__(self, txt_dir: Path, cache_dir: Path, digests: DigestCache,
+                 memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        self.txt_dir = Path(txt_dir)
+        self.cache_dir = Path(cache_dir)
+        self.digests = digests
+        self.memory_budget_mb = memory_budget_mb
+        # concurrent stages must not build the cache of the same table twice
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks cannot be shared with worker processes, which only read tables whose cache is already built
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def path(self, table):
+        """
+        :param table: Name of the table, see MAXQUANT_TABLES
+        :return: Path to the MaxQuant txt file of the table
+        """
+        return self.txt_dir / MAXQUANT_TABLES[table].file_name
+
+    def _cache_path(self, table):
+        schema = MAXQUANT_TABLES[table]
+        source_digest = self.digests.digest(self.path(table))
+        if source_digest is None:
+            raise FileNotFoundError(f'Could not find {self.path(table)}')
+        schema_digest = hashlib.sha256(
+            json.dumps([schema.dtypes, schema.projection], sort_keys=True).encode()).hexdigest()
+        return self.cache_dir / f'{table}-{source_digest[:16]}-{schema_digest[:8]}'
+
+    def _parts(self, table):
+        with self._lock:
+            cache_path = self._cache_path(table)
+            if not cache_path.is_dir():
+                self._build(table, cache_path)
+        return sorted(cache_path.glob('part-*.parquet'))
+
+    @report.step
+    def _build(self, table, cache_path: Path):
+        schema = MAXQUANT_TABLES[table]
+        source = self.path(table)
+        header = pd.read_csv(source, sep='\t', nrows=0).columns.tolist()
+        columns = [c for c in header if c in schema.dtypes] if schema.projection else header
+        # categories differ between chunks; they are only assigned when the cached table is read
+        dtypes = {c: ('object' if t == 'category' else t) for c, t in schema.dtypes.items() if c in columns}
+        chunksize = estimate_chunksize(source, self.memory_budget_mb, usecols=columns)
+        logger.info(f'Caching {source} in columnar format')
+
+        staging_path = cache_path.with_name(f'.{cache_path.name}.{os.getpid()}.tmp')
+        if staging_path.exists():
+            shutil.rmtree(staging_path)
+        staging_path.mkdir(parents=True)
+        n_parts = 0
+        for chunk in pd.read_csv(source, sep='\t', usecols=columns, dtype=dtypes, chunksize=chunksize):
+            write_table(chunk, staging_path / f'part-{n_parts:05d}.parquet', schema={})
+            report.record_rows(f'{schema.file_name} cached', len(chunk))
+            n_parts += 1
+        if n_parts == 0:
+            write_table(pd.DataFrame(columns=columns).astype(dtypes), staging_path / 'part-00000.parquet', schema={})
+
+        # outdated caches of the same table are replaced
+        for outdated in self.cache_dir.glob(f'{table}-*'):
+            shutil.rmtree(outdated)
+        os.replace(staging_path, cache_path)
+        self.digests.save()
+
+    def columns(self, table):
+        """
+        :param table: Name of the table, see MAXQUANT_TABLES
+        :return: List of cached columns in file order
+        """
+        return pq.read_schema(self._parts(table)[0]).names
+
+    def _projection(self, table, columns):
+        if columns is None:
+            return None
+        available = self.columns(table)
+        missing = set(columns) - set(available)
+        if missing:
+            raise KeyError(f'Columns {sorted(missing)} are not available in {self.path(table)}')
+        # keep the file order, as pandas.read_csv with usecols does
+        return [c for c in available if c in set(columns)]
+
+    def _apply_dtypes(self, table, df: pd.DataFrame):
+        dtypes = MAXQUANT_TABLES[table].dtypes
+        return df.astype({c: t for c, t in dtypes.items() if c in df.columns})
+
+    def iter_chunks(self, table, columns=None):
+        """
+        Read a table in chunks sized to the memory budget the cache was built with
+        :param table: Name of the table, see MAXQUANT_TABLES
+        :param columns: Columns to read; None for all cached columns
+        :return: Generator of dataframes
+        """
+        columns = self._projection(table, columns)
+        for part in self._parts(table):
+            yield self._apply_dtypes(table, pd.read_parquet(part, columns=columns))
+
+    def read(self, table, columns=None, raw_files=None):
+        """
+        Read a table, loading only the requested columns
+        :param table: Name of the table, see MAXQUANT_TABLES
+        :param columns: Columns to read; None for all cached columns
+        :param raw_files: Only read the rows of these raw files, in file order; None for all rows
+        :return: Dataframe
+        """
+        columns = self._projection(table, columns)
+        filters = None if raw_files is None else [('Raw file', 'in', list(raw_files))]
+        # dtypes are applied after concatenation so that e.g. categories are shared by all parts
+        return self._apply_dtypes(table, pd.concat([pd.read_parquet(part, columns=columns, filters=filters)
+                                                    for part in self._parts(table)], ignore_index=True))
@@ -0,0 +1,128 @@
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+# modified residues and N-terminal modifications in the UNIMOD notation of Oktoberfest and their notation in the
+# 'Modified sequence' column of MaxQuant; fixed modifications, which MaxQuant does not write, map to the bare residue
+# or, at the N-terminus, to an empty string
+DEFAULT_MODIFICATIONS = {
+    '[UNIMOD:737]-': '',
+    'K[UNIMOD:737]': 'K',
+    'C[UNIMOD:4]': 'C',
+    'M[UNIMOD:35]': 'M(Oxidation (M))',
+    'S[UNIMOD:21]': 'S(Phospho (STY))',
+    'T[UNIMOD:21]': 'T(Phospho (STY))',
+    'Y[UNIMOD:21]': 'Y(Phospho (STY))',
+    '[UNIMOD:1]-': '(Acetyl (Protein N-term))',
+    'K[UNIMOD:1]': 'K(Acetyl (K))',
+    'K[UNIMOD:121]': 'K(GlyGly (K))',
+    'N[UNIMOD:7]': 'N(Deamidation (NQ))',
+    'Q[UNIMOD:7]': 'Q(Deamidation (NQ))',
+}
+
+
+def _compile(replacements):
+    """
+    :param replacements: Dictionary mapping non-empty tokens to their translation
+    :return: Function translating a string in a single pass, preferring the longest token at every position
+    """
+    if not replacements:
+        return lambda sequence: sequence
+    tokens = sorted(replacements, key=len, reverse=True)
+    pattern = re.compile('|'.join(map(re.escape, tokens)))
+    lookup = replacements.__getitem__
+    return lambda sequence: pattern.sub(lambda match: lookup(match.group()), sequence)
+
+
+def _translate_unique(modified_sequences, translate, marker):
+    """
+    Translate each distinct sequence only once, since PSMs of the same peptide repeat its sequence many times
+    :param modified_sequences: Series or array of sequences; missing values stay missing
+    :param translate: Function translating a single sequence
+    :param marker: Character that only occurs in translated sequences if a modification was not translated
+    :return: Series of translated sequences with the index of modified_sequences
+    :raise ValueError: If a sequence contains a modification that was not translated
+    """
+    codes, uniques = pd.factorize(modified_sequences)
+    translated = [translate(sequence) for sequence in uniques]
+    # untranslated modifications would silently fail to match the sequences of the other notation
+    untranslated = [sequence for sequence in translated if marker in sequence]
+    if untranslated:
+        raise ValueError(f'{len(untranslated)} modified sequences contain modifications that are not in the '
+                         f'modification table, e.g. {untranslated[0]!r}; add them to general.modifications')
+    # the missing value code -1 picks the trailing nan
+    translated = np.array(translated + [np.nan], dtype=object)
+    return pd.Series(translated[codes], index=getattr(modified_sequences, 'index', None), dtype=object)
+
+
+class ModificationTable:
+    """
+    Translation of modified sequences between the UNIMOD notation of Oktoberfest, e.g.
+    '[UNIMOD:737]-AS[UNIMOD:21]K[UNIMOD:737]', and the notation of MaxQuant and SIMSI-Transfer, e.g.
+    '_AS(Phospho (STY))K_'. Each direction is compiled into a single regular expression that translates a sequence in
+    one pass.
+    """
+    def __init__(self, modifications=None):
+        """
+        :param modifications: Dictionary of additional or differing entries of DEFAULT_MODIFICATIONS, e.g. from the
+            modifications option of the [general] section, which config.validate_config() checks
+        """
+        self.modifications = {**DEFAULT_MODIFICATIONS, **(modifications or {})}
+        self._to_maxquant = _compile(self.modifications)
+        self._to_unimod = None
+
+    def __getstate__(self):
+        # compiled translators cannot be pickled for worker processes; every process compiles its own
+        return {'modifications': self.modifications}
+
+    def __setstate__(self, state):
+        self.__init__(state['modifications'])
+
+    def _compile_to_unimod(self):
+        replacements, n_terminal_fixed = {}, []
+        for unimod, maxquant in self.modifications.items():
+            if not maxquant:
+                n_terminal_fixed.append(unimod)
+            elif maxquant in replacements:
+                raise ValueError(f'{replacements[maxquant]!r} and {unimod!r} are both written as {maxquant!r} by '
+                                 f'MaxQuant; sequences cannot be translated to UNIMOD notation')
+            else:
+                replacements[maxquant] = unimod
+        if len(n_terminal_fixed) > 1:
+            raise ValueError(f'{" and ".join(map(repr, n_terminal_fixed))} are both fixed N-terminal modifications; '
+                             f'sequences cannot be translated to UNIMOD notation')
+        translate = _compile(replacements)
+        n_terminal_prefix = n_terminal_fixed[0] if n_terminal_fixed else ''
+
+        def to_unimod(sequence):
+            sequence = sequence.strip('_')
+            # variable N-terminal modifications replace the fixed one, e.g. acetylated protein N-termini are not
+            # labeled with TMT
+            prefix = '' if sequence.startswith('(') else n_terminal_prefix
+            return prefix + translate(sequence)
+
+        return to_unimod
+
+    def to_maxquant(self, modified_sequences):
+        """
+        :param modified_sequences: Series of modified sequences in UNIMOD notation, e.g. parsed from Oktoberfest PSMIds
+        :return: Series of modified sequences in MaxQuant notation, enclosed in underscores
+        :raise ValueError: If a sequence contains a modification that is not in the table
+        """
+        return _translate_unique(modified_sequences, lambda sequence: f'_{self._to_maxquant(sequence)}_', '[')
+
+    def to_unimod(self, modified_sequences):
+        """
+        :param modified_sequences: Series of modified sequences in MaxQuant notation, e.g. from msms.txt
+        :return: Series of modified sequences in UNIMOD notation with the fixed modifications of the table
+        :raise ValueError: If a sequence contains a modification that is not in the table, or the table does not map
+            MaxQuant notation back to a unique UNIMOD notation
+        """
+        if self._to_unimod is None:
+            self._to_unimod = self._compile_to_unimod()
+        return _translate_unique(modified_sequences, self._to_unimod, '(')
+
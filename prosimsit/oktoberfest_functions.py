@@ -1,14 +1,43 @@
+import csv
 import glob
 import json
 import os
-import shutil
+import hashlib
+import logging
+import functools
 from pathlib import Path
 
 from oktoberfest import runner
+from oktoberfest import plotting as pl
+from oktoberfest import rescore
 from oktoberfest.data import Spectra
-from oktoberfest.utils import Config, JobPool
+from oktoberfest.utils import Config, ProcessStep
 
+import prosimsit.report as report
 from prosimsit.constants import PROSIT_CONFIG
+from prosimsit.io import atomic_path
+from prosimsit.prediction_cache import cached_predictions
+from prosimsit.prediction_client import async_predictions
+from prosimsit.raw import convert_for_spectra_file
+from prosimsit.scheduler import FileStep, run_per_file
+from prosimsit.spectrum_store import (CHUNK_INFIX, build_for_spectra_file, chunk_file, chunk_source, is_up_to_date,
+                                      spectra_from_store, store_path)
+from prosimsit.staging import stage_file, stage_matching_files
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+SECOND_RUN_CONFIG = 'config_oktoberfest_2.json'
+# digests of the split search results before they are split again, kept until the refresh is complete
+PREVIOUS_SPLIT_FILE = 'msms/previous_split.json'
+# results Oktoberfest derives from the search results of a single spectra file
+SPECTRA_FILE_OUTPUTS = ['proc/predict.{stem}.done', 'proc/calculate_features.{stem}.done', 'data/{stem}.mzml.hdf5',
+                        'data/{stem}.mzml.pred.hdf5', 'results/{fdr}/{stem}.original.tab',
+                        'results/{fdr}/{stem}.rescore.tab']
+CE_CALIBRATION_OUTPUTS = ['proc/ce_calib.{stem}.done', 'results/{stem}_ce.txt']
+# chunks the annotation of a spectra file was split into, kept until they are assembled
+CHUNK_PLAN_FILE = 'msms/{stem}.chunks.json'
+# progress of the steps that combine all spectra files
+GLOBAL_STEPS = ['{fdr}_prepare_tab_original', '{fdr}_prepare_tab_prosit', '{fdr}_original', '{fdr}_prosit']
 
 
 def generate_oktoberfest_config(config, mzml_folder: Path, config_path: Path):
@@ -26,6 +55,9 @@ def generate_oktoberfest_config(config, mzml_folder: Path, config_path: Path):
     oktoberfest_config['models'] = {'intensity': config['prosit']['intensity_model'], 'irt': config['prosit']['irt_model']}
     oktoberfest_config['prediction_server'] = config['prosit']['prediction_server']
     oktoberfest_config['numThreads'] = config['general']['threads']
+    # read by prediction_client.async_predictions in both runs
+    oktoberfest_config['predictionClient'] = {'type': config['general']['prediction_client'],
+                                              'maxRequestsInFlight': config['general']['max_requests_in_flight']}
     oktoberfest_config['thermoExe'] = None
     if config['prosit']['ssl']:
         oktoberfest_config['ssl'] = True
@@ -43,13 +75,15 @@ def generate_oktoberfest_config(config, mzml_folder: Path, config_path: Path):
         json.dump(oktoberfest_config, outfile, indent=4, )
 
 
-def prepare_second_oktoberfest_run(mzml_dir, oktoberfest_config_path, msms_dir, output_dir):
+@report.step
+def prepare_second_oktoberfest_run(mzml_dir, oktoberfest_config_path, msms_dir, output_dir, staging='auto'):
     """
-    This function prepares the second Oktoberfest run by copying the results from the first run to the second run.
+    This function prepares the second Oktoberfest run by staging the results from the first run in the second run.
     :param mzml_dir: Folder containing mzML files
     :param oktoberfest_config_path: Path to the config.json file generated from generate_oktoberfest_config()
     :param msms_dir: Folder containing MaxQuant msms.txt file
     :param output_dir: Path to the output directory
+    :param staging: Staging method, see staging.stage_file
     :return: Oktoberfest Config object containing all oktoberfest-related configurations
     """
     conf = Config()
@@ -61,95 +95,481 @@ def prepare_second_oktoberfest_run(mzml_dir, oktoberfest_config_path, msms_dir,
     conf.inputs['spectra'] = mzml_dir
     conf.inputs['spectra_type'] = 'mzml'
 
-    def copy_files_with_pattern(source_dir, dest_dir, pattern):
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
+    # the calibrated collision energies are only read by the second run, but Oktoberfest rewrites such files in place
+    # whenever it calibrates a file again, so the two runs must not share them through links
+    stage_matching_files(Path(original_output_dir) / 'results', conf.output / 'results', '*.txt', staging,
+                         writable=True)
+
+    # stage progress files as well to indicate that CE calib is already done
+    stage_matching_files(Path(original_output_dir) / 'proc', conf.output / 'proc', 'ce_calib*', staging,
+                         writable=True)
+    with atomic_path(oktoberfest_config_path.parent / SECOND_RUN_CONFIG) as tmp_path:
+        with open(tmp_path, 'w') as outfile:
+            json.dump(conf.data, outfile, indent=4, default=str)
+    return conf
+
+
+def load_second_oktoberfest_run(oktoberfest_config_path):
+    """
+    Read the Oktoberfest config of the second run written by prepare_second_oktoberfest_run()
+    :param oktoberfest_config_path: Path to the config.json file generated from generate_oktoberfest_config()
+    :return: Oktoberfest Config object of the second run
+    """
+    conf = Config()
+    conf.read(oktoberfest_config_path.parent / SECOND_RUN_CONFIG)
+    conf.check()
+    return conf
+
+
+def load_first_oktoberfest_run(oktoberfest_config_path, spectra_files):
+    """
+    Read the Oktoberfest config of the first run and split the search results per spectra file. The split is only done
+    once; later calls only look up the spectra files with search results.
+    :param oktoberfest_config_path: Path to the config.json file generated from generate_oktoberfest_config()
+    :param spectra_files: List of mzML files; for raw input they do not need to exist yet
+    :return: Tuple of the Oktoberfest Config object and the spectra files with search results
+    """
+    conf = Config()
+    conf.read(oktoberfest_config_path)
+    conf.check()
+    (conf.output / 'proc').mkdir(parents=True, exist_ok=True)
+
+    # splitting the search results only needs the file names, not the converted files
+    return conf, runner._preprocess(spectra_files, conf)
 
-        search_pattern = os.path.join(source_dir, pattern)
 
-        files = glob.glob(search_pattern)
+def process_first_oktoberfest_files(conf, spectra_files, raw_dir=None, prediction_cache=None, spectrum_store_dir=None,
+                                    chunk_psms=0):
+    """
+    Move each spectra file of the first Oktoberfest run through conversion, CE calibration and feature calculation
+    independently. Files that were already processed, e.g. by a shard worker, are skipped by Oktoberfest.
+    :param conf: Oktoberfest Config object returned by load_first_oktoberfest_run()
+    :param spectra_files: Spectra files returned by load_first_oktoberfest_run(), or a subset of them
+    :param raw_dir: Directory containing raw files to convert; None if the spectra files are mzML input
+    :param prediction_cache: PredictionCache consulted before requesting predictions; None to disable caching
+    :param spectrum_store_dir: Directory to build the spectrum store of each spectra file in, right after its
+        conversion, see spectrum_store.build_store; None to decode the mzML files in each run
+    :param chunk_psms: Maximum number of PSMs annotated in one task, see annotation_chunks(); 0 to annotate whole files
+        as part of the CE calibration
+    :return: None
+    """
+    steps = [
+        FileStep('CE calibration', ce_calibration, (conf, prediction_cache, spectrum_store_dir)),
+        FileStep('Feature calculation', calculate_features, (conf, prediction_cache)),
+    ]
+    if spectrum_store_dir is not None:
+        if chunk_psms > 0:
+            # the CE calibration reuses the annotated library
+            steps.insert(0, annotation_step(conf, spectrum_store_dir, chunk_psms))
+        steps.insert(0, FileStep('Spectrum store', build_for_spectra_file, (spectrum_store_dir,)))
+    if raw_dir is not None:
+        steps.insert(0, FileStep('Conversion', convert_for_spectra_file, (raw_dir,), executor='thread'))
+    run_per_file(spectra_files, steps, int(conf.num_threads))
 
-        for file_path in files:
-            shutil.copy(file_path, dest_dir)
-            print(f"Copied {file_path} to {dest_dir}")
 
-    source_directory = original_output_dir + '/results/'
-    destination_directory = conf.output / 'results/'
-    file_pattern = '*.txt'
+def rescore_first_oktoberfest(conf, spectra_files):
+    """
+    Merge the tab files of all spectra files of the first Oktoberfest run and rescore them with Percolator
+    :param conf: Oktoberfest Config object returned by load_first_oktoberfest_run()
+    :param spectra_files: Spectra files returned by load_first_oktoberfest_run()
+    :return: None
+    """
+    fdr_dir = conf.output / 'results' / conf.fdr_estimation_method
+    for search_type, step_name in [('original', 'original'), ('rescore', 'prosit')]:
+        prepare_tab_step = ProcessStep(conf.output, f'{conf.fdr_estimation_method}_prepare_tab_{step_name}')
+        if not prepare_tab_step.is_done():
+            rescore.merge_input(tab_files=[fdr_dir / f.with_suffix(f'.{search_type}.tab').name for f in spectra_files],
+                           output_file=fdr_dir / f'{search_type}.tab')
+            prepare_tab_step.mark_done()
 
-    copy_files_with_pattern(source_directory, destination_directory, file_pattern)
+    report.step(runner._rescore)(fdr_dir, conf)
+    if not getattr(conf, 'ptm_localization', False):
+        pl.plot_all(fdr_dir, conf)
 
-    # copy progress files as well to indicate that CE calib is already done
-    source_directory = original_output_dir + '/proc/'
-    destination_directory = conf.output / 'proc/'
-    file_pattern = 'ce_calib*'
-    copy_files_with_pattern(source_directory, destination_directory, file_pattern)
-    with open(oktoberfest_config_path.parent / 'config_oktoberfest_2.json', 'w') as outfile:
-        try:
-            json.dump(conf.data, outfile, indent=4)
-        except:
-            pass
-    return conf
+
+def run_first_oktoberfest(oktoberfest_config_path, spectra_files, raw_dir=None, prediction_cache=None,
+                          spectrum_store_dir=None, chunk_psms=0):
+    """
+    Run the first Oktoberfest rescoring, moving each spectra file through conversion, CE calibration and feature
+    calculation independently. Only merging the tab files and rescoring wait for all files.
+    :param oktoberfest_config_path: Path to the config.json file generated from generate_oktoberfest_config()
+    :param spectra_files: List of mzML files; for raw input they are converted as part of this run
+    :param raw_dir: Directory containing raw files to convert; None if the spectra files are mzML input
+    :param prediction_cache: PredictionCache consulted before requesting predictions; None to disable caching
+    :param spectrum_store_dir: Directory of the spectrum stores; None to decode the mzML files in each run
+    :param chunk_psms: Maximum number of PSMs annotated in one task, see annotation_chunks()
+    :return: None
+    """
+    conf, spectra_files = load_first_oktoberfest_run(oktoberfest_config_path, spectra_files)
+    process_first_oktoberfest_files(conf, spectra_files, raw_dir, prediction_cache, spectrum_store_dir, chunk_psms)
+    rescore_first_oktoberfest(conf, spectra_files)
+
+
+def ce_calibration(spectra_file, conf, prediction_cache=None, spectrum_store_dir=None):
+    """
+    Wrapper for the Oktoberfest CE calibration of a single spectra file; discards the returned library so that it is
+    not sent back from worker processes.
+    :param spectra_file: Preprocessed spectra file
+    :param conf: Oktoberfest Config object
+    :param prediction_cache: PredictionCache consulted before requesting predictions; None to disable caching
+    :param spectrum_store_dir: Directory of the spectrum stores; None to decode the mzML file
+    :return: None
+    """
+    with async_predictions(conf), cached_predictions(prediction_cache), spectra_from_store(spectrum_store_dir):
+        runner._ce_calib(spectra_file, conf)
+
+
+def calculate_features(spectra_file, conf, prediction_cache=None):
+    """
+    Wrapper for the Oktoberfest prediction and feature calculation of a single spectra file.
+    :param spectra_file: Preprocessed spectra file
+    :param conf: Oktoberfest Config object
+    :param prediction_cache: PredictionCache consulted before requesting predictions; None to disable caching
+    :return: None
+    """
+    with async_predictions(conf), cached_predictions(prediction_cache):
+        runner._calculate_features(spectra_file, conf)
+
+
+def annotate_spectra_file(spectra_file, conf, spectrum_store_dir=None):
+    """
+    Wrapper for the Oktoberfest annotation of a single spectra file or chunk file; discards the returned library so
+    that it is not sent back from worker processes.
+    :param spectra_file: Preprocessed spectra file or chunk file returned by annotation_chunks()
+    :param conf: Oktoberfest Config object
+    :param spectrum_store_dir: Directory of the spectrum stores; None to decode the mzML file
+    :return: None
+    """
+    data_dir = conf.output / 'data'
+    if (data_dir / spectra_file.with_suffix('.mzml.hdf5').name).is_file():
+        return
+    if (data_dir / spectra_file.with_suffix('.mzml.pred.hdf5').name).is_file():
+        # generate_pred_file or the CE calibration already turned the annotated library into the prediction input
+        return
+    with spectra_from_store(spectrum_store_dir):
+        runner._annotate_and_get_library(spectra_file, conf)
+
+
+def annotation_step(conf, spectrum_store_dir=None, chunk_psms=0):
+    """
+    :param conf: Oktoberfest Config object
+    :param spectrum_store_dir: Directory of the spectrum stores; None to decode the mzML files
+    :param chunk_psms: Maximum number of PSMs annotated in one task, see annotation_chunks()
+    :return: FileStep annotating spectra files, split into chunks of PSMs if they have a spectrum store
+    """
+    return FileStep('Annotation', annotate_spectra_file, (conf, spectrum_store_dir),
+                    chunks=functools.partial(annotation_chunks, chunk_psms=chunk_psms),
+                    assemble=assemble_annotation_chunks)
+
+
+def annotation_chunks(spectra_file, conf, spectrum_store_dir=None, chunk_psms=0):
+    """
+    Split the annotation of a spectra file into chunks of at most chunk_psms consecutive PSMs of its search results.
+    Each chunk is a chunk file with its own search results in the msms folder, which is annotated like a spectra file
+    but reads its spectra from the spectrum store of the whole file. Only files with an up-to-date spectrum store, more
+    PSMs than chunk_psms and without annotated library are split.
+    :param spectra_file: Preprocessed spectra file
+    :param conf: Oktoberfest Config object
+    :param spectrum_store_dir: Directory of the spectrum stores; None to not split any file
+    :param chunk_psms: Maximum number of PSMs per chunk; 0 to not split any file
+    :return: List of the chunk files in the order of the search results, or only the spectra file if it is not split
+    """
+    data_dir = conf.output / 'data'
+    if (spectrum_store_dir is None or chunk_psms <= 0
+            or (data_dir / spectra_file.with_suffix('.mzml.hdf5').name).is_file()
+            or (data_dir / spectra_file.with_suffix('.mzml.pred.hdf5').name).is_file()
+            or not is_up_to_date(spectra_file, store_path(spectrum_store_dir, spectra_file))):
+        return [spectra_file]
+
+    search_file = conf.output / 'msms' / spectra_file.with_suffix('.rescore').name
+    with open(search_file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    if len(rows) <= chunk_psms:
+        return [spectra_file]
+
+    chunk_files = [chunk_file(spectra_file, number) for number in range((len(rows) - 1) // chunk_psms + 1)]
+    plan = {'chunk_psms': chunk_psms, 'chunks': [f.name for f in chunk_files]}
+    plan_file = conf.output / CHUNK_PLAN_FILE.format(stem=spectra_file.stem)
+    if plan_file.is_file():
+        with open(plan_file, 'r') as f:
+            previous_plan = json.load(f)
+        if previous_plan == plan:
+            # resume an interrupted annotation with the chunks that are already annotated
+            return chunk_files
+    _remove_chunks(spectra_file.stem, conf)
+
+    for number, chunk in enumerate(chunk_files):
+        with atomic_path(conf.output / 'msms' / chunk.with_suffix('.rescore').name) as tmp_path:
+            with open(tmp_path, 'w', newline='') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(header)
+                writer.writerows(rows[number * chunk_psms:(number + 1) * chunk_psms])
+    with atomic_path(plan_file) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(plan, f, indent=4)
+    logger.info(f'Annotating {len(rows)} PSMs of {spectra_file.name} in {len(chunk_files)} chunks')
+    return chunk_files
 
 
+def _remove_chunks(stem, conf):
+    """
+    Remove the chunk files of a spectra file, their search results and annotated libraries
+    """
+    pattern = f'{glob.escape(stem)}{CHUNK_INFIX}*'
+    for path in [*(conf.output / 'msms').glob(pattern), *(conf.output / 'data').glob(pattern)]:
+        path.unlink()
+    (conf.output / CHUNK_PLAN_FILE.format(stem=stem)).unlink(missing_ok=True)
+
+
+def _concat_libraries(libraries):
+    """
+    :param libraries: Annotated libraries of consecutive chunks of PSMs
+    :return: Annotated library of all PSMs, indexed like the library Oktoberfest annotates from all PSMs at once
+    """
+    import anndata
+
+    for library in libraries:
+        # categories differ between chunks; they are derived from all PSMs again below
+        categorical = library.obs.select_dtypes('category').columns
+        library.obs = library.obs.astype({column: object for column in categorical})
+    library = Spectra(anndata.concat(libraries, merge='same', uns_merge='same'))
+    library.obs_names = [str(i) for i in range(library.n_obs)]
+    library.strings_to_categoricals()
+    return library
+
+
+def assemble_annotation_chunks(spectra_file, conf, spectrum_store_dir=None):
+    """
+    Concatenate the annotated chunks of a spectra file planned by annotation_chunks() into the annotated library
+    Oktoberfest writes for the whole file and remove the chunks. The PSMs keep the order of the search results, so the
+    library does not depend on the number of chunks or on the order in which they were annotated.
+    :param spectra_file: Preprocessed spectra file
+    :param conf: Oktoberfest Config object
+    :param spectrum_store_dir: Directory of the spectrum stores the chunks were annotated from; not read again
+    :return: None
+    """
+    plan_file = conf.output / CHUNK_PLAN_FILE.format(stem=spectra_file.stem)
+    if not plan_file.is_file():
+        return
+    with open(plan_file, 'r') as f:
+        chunk_files = [spectra_file.with_name(name) for name in json.load(f)['chunks']]
+
+    data_dir = conf.output / 'data'
+    hdf5_path = data_dir / spectra_file.with_suffix('.mzml.hdf5').name
+    if not hdf5_path.is_file() and not hdf5_path.with_name(hdf5_path.stem + '.pred.hdf5').is_file():
+        library = _concat_libraries(
+            [Spectra.from_hdf5(data_dir / chunk.with_suffix('.mzml.hdf5').name) for chunk in chunk_files])
+        # write_as_hdf5 needs the suffix, so the file is not written via atomic_path
+        tmp_path = hdf5_path.with_name(f'.{spectra_file.stem}.{os.getpid()}.mzml.hdf5')
+        library.write_as_hdf5(tmp_path)
+        os.replace(tmp_path, hdf5_path)
+        logger.info(f'Assembled the annotated library of {spectra_file.name} from {len(chunk_files)} chunks')
+    _remove_chunks(spectra_file.stem, conf)
+
+
+def list_spectra_files(conf):
+    """
+    :param conf: Config object for Oktoberfest generated from prepare_second_oktoberfest_run()
+    :return: List of all files in the spectra folder of the Oktoberfest run
+    """
+    return [Path(f) for f in glob.iglob(str(Path(conf.inputs['spectra']) / '*'))]
+
+
+@report.step
 def preprocess_spectra_files(conf):
     """
     Wrapper to apply oktoberfest preprocessing steps to spectra files.
     :param conf: Config object for Oktoberfest generated from prepare_second_oktoberfest_run()
     :return: List of preprocessed spectra files
     """
-    spectra_files = [Path(f) for f in glob.iglob(str(conf.inputs['spectra'] / '*'))]
-    spectra_files = runner._preprocess(spectra_files, conf)
+    spectra_files = runner._preprocess(list_spectra_files(conf), conf)
     return spectra_files
 
 
-def annotate_library(spectra_files, conf):
+def _split_digests(output_dir: Path):
+    """
+    :param output_dir: Output folder of an Oktoberfest run
+    :return: Dictionary mapping each spectra file with search results to the digest of its search results and its
+        calibrated collision energy, i.e. of all inputs of its per-file results
+    """
+    digests = {}
+    for split_file in sorted((output_dir / 'msms').glob('*.rescore')):
+        if chunk_source(split_file) != split_file:
+            continue
+        sha = hashlib.sha256()
+        for path in [split_file, output_dir / 'results' / f'{split_file.stem}_ce.txt']:
+            if not path.is_file():
+                continue
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+        digests[split_file.stem] = sha.hexdigest()
+    return digests
+
+
+def save_split_digests(conf):
+    """
+    Record which search results and collision energies the per-file results of an Oktoberfest run were computed
+    from, unless an interrupted refresh_search_results() already did
+    :param conf: Oktoberfest Config object of the run
+    :return: None
+    """
+    previous_split_path = conf.output / PREVIOUS_SPLIT_FILE
+    if previous_split_path.is_file():
+        return
+    previous_split_path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(previous_split_path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(_split_digests(conf.output), f, indent=4)
+
+
+@report.step
+def refresh_search_results(conf, spectra_files, keep_ce_calibration=False):
+    """
+    Update a finished Oktoberfest run to changed search results, e.g. after raw files were added to the MaxQuant
+    search: the search results are split per spectra file again and only the results of spectra files whose search
+    results or collision energy changed are removed, together with the merged results of all files. Running the
+    Oktoberfest steps afterwards only processes the new and changed spectra files.
+    :param conf: Oktoberfest Config object of the run
+    :param spectra_files: List of spectra files, as passed to runner._preprocess
+    :param keep_ce_calibration: Keep the calibrated collision energies, e.g. because they were staged from the first
+        Oktoberfest run; call save_split_digests() before staging them
+    :return: Names of the spectra files whose results were removed
+    """
+    save_split_digests(conf)
+    previous_split_path = conf.output / PREVIOUS_SPLIT_FILE
+    with open(previous_split_path, 'r') as f:
+        previous = json.load(f)
+
+    fdr = conf.fdr_estimation_method
+    for step_name in ['preprocessing_search'] + GLOBAL_STEPS:
+        (conf.output / 'proc' / f'{step_name.format(fdr=fdr)}.done').unlink(missing_ok=True)
+    for split_file in (conf.output / 'msms').glob('*.rescore'):
+        split_file.unlink()
+    runner._preprocess(spectra_files, conf)
+    current = _split_digests(conf.output)
+
+    changed = sorted(stem for stem in set(previous) | set(current) if previous.get(stem) != current.get(stem))
+    patterns = SPECTRA_FILE_OUTPUTS + ([] if keep_ce_calibration else CE_CALIBRATION_OUTPUTS)
+    for stem in changed:
+        for pattern in patterns:
+            (conf.output / pattern.format(stem=stem, fdr=fdr)).unlink(missing_ok=True)
+        _remove_chunks(stem, conf)
+    previous_split_path.unlink()
+    logger.info(f'Search results of {len(changed)} of {len(current)} spectra files are new or changed; the results of '
+                f'the other spectra files are kept')
+    return changed
+
+
+def process_spectra_files(spectra_files, conf, prediction_cache=None, spectrum_store_dir=None, chunk_psms=0):
+    """
+    Annotate, set the calibrated collision energy and calculate features for all spectra files of the second
+    Oktoberfest run, moving each file through these steps independently of the others.
+    :param spectra_files: List of preprocessed spectra files
+    :param conf: Config object for Oktoberfest generated from prepare_second_oktoberfest_run()
+    :param prediction_cache: PredictionCache consulted before requesting predictions; None to disable caching
+    :param spectrum_store_dir: Directory of the spectrum stores built by the first run; None to decode the mzML files
+    :param chunk_psms: Maximum number of PSMs annotated in one task, see annotation_chunks()
+    :return: None
+    """
+    run_per_file(spectra_files, [
+        annotation_step(conf, spectrum_store_dir, chunk_psms),
+        FileStep('Collision energy', generate_pred_file, (conf,)),
+        FileStep('Feature calculation', calculate_features, (conf, prediction_cache)),
+    ], int(conf.num_threads))
+
+
+def annotate_library(spectra_files, conf, spectrum_store_dir=None, chunk_psms=0):
     """
     Wrapper to apply oktoberfest library annotation steps.
     :param spectra_files: List of preprocessed spectra files
     :param conf: Config object for Oktoberfest generated from prepare_second_oktoberfest_run()
+    :param spectrum_store_dir: Directory of the spectrum stores; None to decode the mzML files
+    :param chunk_psms: Maximum number of PSMs annotated in one task, see annotation_chunks()
     :return: None
     """
-    if conf.num_threads > 1:
-        processing_pool = JobPool(processes=conf.num_threads)
-        for spectra_file in spectra_files:
-            processing_pool.apply_async(runner._annotate_and_get_library, [spectra_file, conf])
-        processing_pool.check_pool()
-    else:
-        for spectra_file in spectra_files:
-            runner._annotate_and_get_library(spectra_file, conf)
+    run_per_file(spectra_files, [annotation_step(conf, spectrum_store_dir, chunk_psms)], int(conf.num_threads))
 
 
-def generate_pred_files(conf):
+def generate_pred_file(spectra_file, conf):
     """
-    Generate predictions for all hdf5 files prepared for Prosit.
+    Generate the prediction input of a single spectra file prepared for Prosit by setting its calibrated collision
+    energy in a copy of the annotated library, the .pred.hdf5 file Oktoberfest expects. The annotated library is only
+    removed once the prediction input is complete, so an interrupted call leaves it intact and is simply repeated.
+    :param spectra_file: Preprocessed spectra file
     :param conf: Config object for Oktoberfest generated from prepare_second_oktoberfest_run()
     :return: None
     """
-    spectra_files_str = [Path(f) for f in glob.iglob(str(conf.output / 'data' / '*'))]
-    for f in spectra_files_str:
-        library = Spectra.from_hdf5(f)
-        result_file = conf.output / 'results' / (f.with_suffix('').stem + '_ce.txt')
-        with open(result_file, 'r') as file:
-            content = file.read()
-            best_ce = int(content)
-        library.obs['COLLISION_ENERGY'] = best_ce
-        output_file = f.with_name(f.stem + '.pred.hdf5')
-        library.write_as_hdf5(output_file)
+    f = conf.output / 'data' / spectra_file.with_suffix('.mzml.hdf5').name
+    output_file = f.with_name(f.stem + '.pred.hdf5')
+    if output_file.is_file():
+        # the prediction input appears atomically, so only the removal of the annotated library can be missing
+        f.unlink(missing_ok=True)
+        return
+    result_file = conf.output / 'results' / (f.with_suffix('').stem + '_ce.txt')
+    with open(result_file, 'r') as file:
+        content = file.read()
+        best_ce = int(content)
+    set_collision_energy(f, best_ce, output_file)
+    f.unlink()
 
 
-def calculate_featuers(spectra_files, conf):
+def set_collision_energy(hdf5_file, collision_energy, output_file):
+    """
+    Write a copy of a Spectra hdf5 file with the given collision energy. The copy is a reflink where the filesystem
+    supports it and only its obs table is rewritten, so the spectra are neither loaded nor duplicated on disk. The copy
+    appears atomically and the source file is not modified.
+    :param hdf5_file: Path to a Spectra hdf5 (AnnData) file
+    :param collision_energy: Collision energy for all spectra in the file
+    :param output_file: Path of the copy
+    :return: None
+    """
+    try:
+        import h5py
+        try:
+            from anndata.io import read_elem, write_elem
+        except ImportError:
+            from anndata.experimental import read_elem, write_elem
+    except ImportError:
+        library = Spectra.from_hdf5(hdf5_file)
+        library.obs['COLLISION_ENERGY'] = collision_energy
+        # write_as_hdf5 needs the suffix, so the file is not written via atomic_path
+        tmp_path = output_file.with_name(f'.{output_file.stem}.{os.getpid()}.hdf5')
+        try:
+            library.write_as_hdf5(tmp_path)
+            os.replace(tmp_path, output_file)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return
+
+    with atomic_path(output_file) as tmp_path:
+        stage_file(hdf5_file, tmp_path, writable=True)
+        with h5py.File(tmp_path, 'r+') as h5:
+            obs = read_elem(h5['obs'])
+            obs['COLLISION_ENERGY'] = collision_energy
+            del h5['obs']
+            write_elem(h5, 'obs', obs)
+
+
+def generate_pred_files(spectra_files, conf):
+    """
+    Generate prediction inputs for all hdf5 files prepared for Prosit, in parallel.
+    :param spectra_files: List of preprocessed spectra files
+    :param conf: Config object for Oktoberfest generated from prepare_second_oktoberfest_run()
+    :return: None
+    """
+    run_per_file(spectra_files, [FileStep('Collision energy', generate_pred_file, (conf,))], int(conf.num_threads))
+
+
+def calculate_featuers(spectra_files, conf, prediction_cache=None):
     """
     Function to calculate Percolator features from Prosit predictions.
     :param spectra_files: List of preprocessed spectra files
     :param conf: Config object for Oktoberfest generated from prepare_second_oktoberfest_run()
+    :param prediction_cache: PredictionCache consulted before requesting predictions; None to disable caching
     :return: None
     """
-    if conf.num_threads > 1:
-        processing_pool = JobPool(processes=conf.num_threads)
-        for spectra_file in spectra_files:
-            processing_pool.apply_async(runner._calculate_features, [spectra_file, conf])
-        processing_pool.check_pool()
-    else:
-        for spectra_file in spectra_files:
-            runner._calculate_features(spectra_file, conf)
+    run_per_file(spectra_files, [FileStep('Feature calculation', calculate_features, (conf, prediction_cache))],
+                 int(conf.num_threads))
@@ -0,0 +1,209 @@
+import gc
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import collections
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+
+from prosimsit.stages import DigestCache
+import prosimsit.report as report
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+# part of the index key, so that indices written in an older layout are rebuilt
+INDEX_FORMAT_VERSION = 1
+# attributes of picked_group_fdr.digestion_params.DigestionParams that determine the digested peptides
+DIGESTION_ATTRIBUTES = ['enzyme', 'digestion', 'min_length', 'max_length', 'cleavages', 'special_aas',
+                        'methionine_cleavage', 'db']
+
+# concurrent stages of one process must not build the same index twice
+_lock = threading.Lock()
+
+
+class PeptideIndex:
+    """
+    Peptide-to-protein map of a digested proteome, stored as memory-mapped numpy arrays: the peptides as fixed-width
+    bytes in the order Picked Protein Group FDR digests them, a permutation sorting them for binary search and for
+    every peptide the range of its protein codes. Proteins of single peptides are looked up without loading the
+    index; to_map() builds the dictionary Picked Protein Group FDR works on.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.peptides = np.load(self.path / 'peptides.npy', mmap_mode='r')
+        self.order = np.load(self.path / 'order.npy', mmap_mode='r')
+        self.offsets = np.load(self.path / 'offsets.npy', mmap_mode='r')
+        self.protein_codes = np.load(self.path / 'protein_codes.npy', mmap_mode='r')
+        with open(self.path / 'proteins.json', 'r') as f:
+            self.protein_names = json.load(f)
+
+    def __len__(self):
+        return len(self.peptides)
+
+    def proteins(self, peptide):
+        """
+        :param peptide: Unmodified peptide sequence
+        :return: List of proteins the peptide is part of; empty if it is not a digestion product of the proteome
+        """
+        key = peptide.encode('ascii')
+        position = np.searchsorted(self.peptides, key, sorter=self.order)
+        if position == len(self.order) or self.peptides[self.order[position]] != key:
+            return []
+        i = self.order[position]
+        return [self.protein_names[code] for code in self.protein_codes[self.offsets[i]:self.offsets[i + 1]]]
+
+    def to_map(self):
+        """
+        :return: Peptide-to-protein map in the format of picked_group_fdr.digest, identical to the digested one
+        """
+        peptides = np.asarray(self.peptides).astype(str).tolist()
+        names = np.array(self.protein_names, dtype=object)[self.protein_codes].tolist()
+        offsets = self.offsets.tolist()
+        # millions of small lists would trigger the cyclic garbage collector over and over, although none of them can
+        # be part of a reference cycle
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            proteins = list(map(names.__getitem__, map(slice, offsets[:-1], offsets[1:])))
+            peptide_to_protein_map = collections.defaultdict(list, zip(peptides, proteins))
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return peptide_to_protein_map
+
+    @staticmethod
+    def write(peptide_to_protein_map, path: Path):
+        """
+        :param peptide_to_protein_map: Dictionary mapping peptides to lists of proteins
+        :param path: Directory to write the index to
+        :return: None
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        peptides = np.array(list(peptide_to_protein_map.keys()), dtype=bytes)
+        codes_by_name = {}
+        protein_codes = np.array([codes_by_name.setdefault(protein, len(codes_by_name))
+                                  for proteins in peptide_to_protein_map.values() for protein in proteins],
+                                 dtype=np.int32)
+        offsets = np.zeros(len(peptides) + 1, dtype=np.int64)
+        np.cumsum([len(proteins) for proteins in peptide_to_protein_map.values()], out=offsets[1:])
+        np.save(path / 'peptides.npy', peptides)
+        np.save(path / 'order.npy', np.argsort(peptides, kind='stable'))
+        np.save(path / 'offsets.npy', offsets)
+        np.save(path / 'protein_codes.npy', protein_codes)
+        with open(path / 'proteins.json', 'w') as f:
+            json.dump(list(codes_by_name), f)
+
+
+def index_path(index_dir: Path, fasta_files, digestion_params_list, digests: DigestCache):
+    """
+    :param index_dir: Directory holding the indices of all proteomes; can be shared between runs and projects
+    :param fasta_files: List of fasta files that are digested together
+    :param digestion_params_list: List of picked_group_fdr DigestionParams
+    :param digests: DigestCache used to hash the fasta files
+    :return: Path of the index of the fasta files, keyed by their content and the digestion parameters
+    """
+    from picked_group_fdr import __version__ as picked_group_fdr_version
+
+    fasta_digests = [digests.digest(Path(fasta_file)) for fasta_file in fasta_files]
+    if None in fasta_digests:
+        raise FileNotFoundError(f'Could not find {fasta_files[fasta_digests.index(None)]}')
+    params = [{name: getattr(p, name) for name in DIGESTION_ATTRIBUTES} for p in digestion_params_list]
+    key = hashlib.sha256(json.dumps([INDEX_FORMAT_VERSION, picked_group_fdr_version, fasta_digests, params],
+                                    sort_keys=True).encode()).hexdigest()
+    return Path(index_dir) / f'peptides-{key[:24]}'
+
+
+@report.step
+def _build(fasta_files, digestion_params_list, path: Path, digest_fasta):
+    logger.info(f'Digesting {", ".join(Path(f).name for f in fasta_files)} into peptide index {path}')
+    peptide_to_protein_map = digest_fasta(fasta_files, digestion_params_list)
+    report.record_rows('peptides indexed', len(peptide_to_protein_map))
+    staging_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    if staging_path.exists():
+        shutil.rmtree(staging_path)
+    PeptideIndex.write(peptide_to_protein_map, staging_path)
+    try:
+        os.replace(staging_path, path)
+    except OSError:
+        # another run sharing the index directory finished the same index first
+        if not path.is_dir():
+            raise
+        shutil.rmtree(staging_path)
+
+
+def get_index(index_dir: Path, fasta_files, digestion_params_list, digests: DigestCache, digest_fasta=None):
+    """
+    Open the index of the fasta files, digesting them first if no run built it before
+    :param index_dir: Directory holding the indices of all proteomes
+    :param fasta_files: List of fasta files that are digested together
+    :param digestion_params_list: List of picked_group_fdr DigestionParams
+    :param digests: DigestCache used to hash the fasta files
+    :param digest_fasta: Function digesting the fasta files as get_peptide_to_protein_map_from_params of
+        picked_group_fdr.digest; None for that function
+    :return: PeptideIndex
+    """
+    if digest_fasta is None:
+        from picked_group_fdr import digest
+        digest_fasta = digest.get_peptide_to_protein_map_from_params
+
+    path = index_path(index_dir, fasta_files, digestion_params_list, digests)
+    with _lock:
+        if not path.is_dir():
+            Path(index_dir).mkdir(parents=True, exist_ok=True)
+            _build(fasta_files, digestion_params_list, path, digest_fasta)
+            digests.save()
+    logger.info(f'Using peptide index {path}')
+    return PeptideIndex(path)
+
+
+def _is_indexable(digestion_params_list, kwargs):
+    from picked_group_fdr import digest
+
+    # hash keys of unspecific digestion and custom protein identifiers, e.g. gene names, are not indexed
+    return (not any(p.use_hash_key for p in digestion_params_list)
+            and set(kwargs) <= {'parse_id'} and kwargs.get('parse_id', digest.parse_until_first_space)
+            is digest.parse_until_first_space)
+
+
+@contextmanager
+def indexed_digestion(index_dir: Path = None, digests: DigestCache = None):
+    """
+    Make Picked Protein Group FDR load the peptide-to-protein maps of fasta files from their index within this
+    context instead of digesting the fasta files. Logs a warning if Picked Protein Group FDR did not get any map via
+    the patched function, e.g. because a newer version imports it by name, so that the index silently went unused.
+    :param index_dir: Directory holding the indices of all proteomes; None to digest the fasta files
+    :param digests: DigestCache used to hash the fasta files
+    :return: None
+    """
+    if index_dir is None:
+        yield
+        return
+
+    from picked_group_fdr import digest
+
+    original = digest.get_peptide_to_protein_map_from_params
+    calls = collections.Counter()
+
+    def get_peptide_to_protein_map_from_params(fasta_files, digestion_params_list, **kwargs):
+        if not _is_indexable(digestion_params_list, kwargs):
+            calls['digested'] += 1
+            logger.info(f'Digesting {", ".join(Path(f).name for f in fasta_files)} without peptide index, the '
+                        f'digestion parameters or protein identifiers are not indexed')
+            return original(fasta_files, digestion_params_list, **kwargs)
+        calls['indexed'] += 1
+        return get_index(index_dir, fasta_files, digestion_params_list, digests, original).to_map()
+
+    digest.get_peptide_to_protein_map_from_params = get_peptide_to_protein_map_from_params
+    try:
+        yield
+    finally:
+        digest.get_peptide_to_protein_map_from_params = original
+    if not calls:
+        logger.warning(f'Picked Protein Group FDR did not load any peptide-to-protein map via '
+                       f'digest.get_peptide_to_protein_map_from_params, the peptide index in {index_dir} was not used')
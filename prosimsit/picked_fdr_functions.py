@@ -1,55 +1,91 @@
 import logging
-
-import pandas as pd
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from picked_group_fdr import picked_group_fdr
+from picked_group_fdr.digestion_params import get_digestion_params_list
 from picked_group_fdr.pipeline import update_evidence_from_pout
 
+from prosimsit.io import read_table, write_table
+import prosimsit.peptide_index as peptide_index
+import prosimsit.report as report
+
 logger = logging.getLogger(__package__ + "." + __file__)
 
-def run_picked_protein_group_fdr(percolator_dir, picked_dir, fasta, enzyme):
+@report.step
+def add_extra_dash_for_percolator(path_to_file_in, path_to_file_out):
     """
-    Run the Picked Protein Group FDR pipeline
+    Add extra dashes to the PSMId column of the percolator input file
+    :param path_to_file_in: path to the percolator input file
+    :param path_to_file_out: path to the output file with extra dash
+    :return:
+    """
+    df = read_table(path_to_file_in)
+    df['PSMId'] += '-1'
+    write_table(df, path_to_file_out, schema={})
+    report.record_rows(f'{Path(path_to_file_out).name} written', len(df))
+
+
+@report.step
+def prepare_picked_fdr_input(percolator_dir, threads=1):
+    """
+    Write the target and decoy PSMs of Percolator with the PSMIds Picked Protein Group FDR expects; independent of the
+    evidence assembly, so both can run concurrently
+    :param percolator_dir: Path to the percolator output directory
+    :param threads: Number of files to convert concurrently
+    :return: None
+    """
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        futures = [executor.submit(add_extra_dash_for_percolator, f'{percolator_dir}/rescore_all.percolator.{psms}.txt',
+                                   f'{percolator_dir}/rescore_all.percolator.{psms}.dash.txt')
+                   for psms in ['psms', 'decoy.psms']]
+        for future in futures:
+            future.result()
+
+
+def _picked_fdr_arguments(picked_dir, fasta, enzyme):
+    return ['--mq_evidence', f'{picked_dir}/updated_evidence.txt',
+            '--protein_groups_out', f'{picked_dir}/group_results.txt',
+            '--fasta', *(fasta if type(fasta) == list else [fasta]),
+            '--methods', 'picked_protein_group_mq_input',
+            '--enzyme', enzyme]
+
+
+@report.step
+def build_peptide_index(fasta, enzyme, index_dir, digests):
+    """
+    Digest the fasta files into the peptide index used by run_picked_protein_group_fdr(), with the digestion
+    parameters Picked Protein Group FDR derives from its arguments; only depends on the config, so it can run before
+    the PSMs are rescored
+    :param fasta: Path or list of paths to the fasta files used for database search with MaxQuant
+    :param enzyme: Enzyme used for database search with MaxQuant
+    :param index_dir: Directory holding the peptide indices of all proteomes
+    :param digests: DigestCache used to hash the fasta files
+    :return: None
+    """
+    args = picked_group_fdr.parse_args(_picked_fdr_arguments('.', fasta, enzyme))
+    index = peptide_index.get_index(index_dir, args.fasta, get_digestion_params_list(args), digests)
+    report.record_rows('peptides in index', len(index))
+
+
+@report.step
+def run_picked_protein_group_fdr(percolator_dir, picked_dir, fasta, enzyme, index_dir=None, digests=None):
+    """
+    Run the Picked Protein Group FDR pipeline on the files written by prepare_picked_fdr_input()
     :param percolator_dir: Path to the percolator output directory
     :param picked_dir: Path to the picked protein group FDR output directory
     :param fasta: Path to the fasta file used for database search with MaxQuant
     :param enzyme: Enzyme used for database search with MaxQuant; usually 'trypsin' or 'trpysinp'
+    :param index_dir: Directory holding the peptide indices of all proteomes, see build_peptide_index(); None to
+        digest the fasta files in every run
+    :param digests: DigestCache used to hash the fasta files; required with index_dir
     :return: None
     """
-    def add_extra_dash_for_percolator(path_to_file_in, path_to_file_out):
-        """
-        Add extra dashes to the PSMId column of the percolator input file
-        :param path_to_file_in: path to the percolator input file
-        :param path_to_file_out: path to the output file with extra dash
-        :return:
-        """
-        df = pd.read_csv(path_to_file_in, sep='\t')
-        df['PSMId'] += '-1'
-        df.to_csv(path_to_file_out, sep='\t', index=False)
-
-    add_extra_dash_for_percolator(f'{percolator_dir}/rescore_all.percolator.psms.txt',
-                                    f'{percolator_dir}/rescore_all.percolator.psms.dash.txt')
-    add_extra_dash_for_percolator(f'{percolator_dir}/rescore_all.percolator.decoy.psms.txt',
-                                    f'{percolator_dir}/rescore_all.percolator.decoy.psms.dash.txt')
-
     update_evidence_from_pout.main([
         '--mq_evidence', f'{picked_dir}/evidence.txt',
         '--perc_results', f'{percolator_dir}/rescore_all.percolator.psms.dash.txt', f'{percolator_dir}/rescore_all.percolator.decoy.psms.dash.txt',
         '--mq_evidence_out', f'{picked_dir}/updated_evidence.txt',
         '--pout_input_type', 'prosit'])
 
-
-    if type(fasta) == list:
-        picked_group_fdr.main([
-            '--mq_evidence', f'{picked_dir}/updated_evidence.txt',
-            '--protein_groups_out', f'{picked_dir}/group_results.txt',
-            '--fasta', *fasta,
-            '--methods', 'picked_protein_group_mq_input',
-            '--enzyme', enzyme])
-    else:
-        picked_group_fdr.main([
-            '--mq_evidence', f'{picked_dir}/updated_evidence.txt',
-            '--protein_groups_out', f'{picked_dir}/group_results.txt',
-            '--fasta', fasta,
-            '--methods', 'picked_protein_group_mq_input',
-            '--enzyme', enzyme])
\ No newline at end of file
+    with peptide_index.indexed_digestion(index_dir, digests):
+        picked_group_fdr.main(_picked_fdr_arguments(picked_dir, fasta, enzyme))
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from prosimsit.constants import DEFAULT_PREDICTION_CACHE_MB
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+# Oktoberfest data columns holding the values of the Koina model inputs
+MODEL_INPUT_COLUMNS = {
+    'peptide_sequences': 'MODIFIED_SEQUENCE',
+    'precursor_charges': 'PRECURSOR_CHARGE',
+    'collision_energies': 'COLLISION_ENERGY',
+    'fragmentation_types': 'FRAGMENTATION',
+    'instrument_types': 'INSTRUMENT_TYPES',
+}
+NUMERIC_MODEL_INPUTS = {'precursor_charges', 'collision_energies'}
+KEY_SEPARATOR = '\x1f'
+SQLITE_MAX_VARIABLES = 900
+
+
+class PredictionCache:
+    """
+    On-disk cache of peptide-level predictions, keyed by model name and the model inputs of a peptide, i.e. modified
+    sequence, charge and collision energy for intensity models and the modified sequence for iRT models. Entries are
+    stored in a SQLite database that can be shared between runs, projects and worker processes; the least recently
+    used entries are evicted once the database grows beyond its size limit.
+    """
+    def __init__(self, path: Path, max_size_mb=DEFAULT_PREDICTION_CACHE_MB):
+        self.path = Path(path)
+        self.max_size = int(max_size_mb * 1024 ** 2)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        # connections cannot be shared with worker processes; every process opens its own
+        return {'path': self.path, 'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['max_size'] / 1024 ** 2)
+
+    def _connect(self):
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                               'key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL, '
+                               'value BLOB NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, keys):
+        """
+        Look up cached predictions and mark them as recently used
+        :param keys: List of unique cache keys, see cache_keys()
+        :return: Dictionary mapping the keys found in the cache to their encoded predictions
+        """
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                batch = keys[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ','.join('?' * len(batch))
+                found.update(connection.execute(
+                    f'SELECT key, value FROM predictions WHERE key IN ({placeholders})', batch).fetchall())
+            if found:
+                now = time.time()
+                connection.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                       [(now, key) for key in found])
+                connection.commit()
+        return found
+
+    def put(self, entries):
+        """
+        Store encoded predictions and evict the least recently used entries if the cache exceeds its size limit
+        :param entries: Dictionary mapping cache keys to encoded predictions
+        :return: None
+        """
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.executemany('INSERT OR REPLACE INTO predictions (key, size, last_used, value) '
+                                   'VALUES (?, ?, ?, ?)',
+                                   [(key, len(key) + len(value), now, value) for key, value in entries.items()])
+            total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+            if total_size > self.max_size:
+                # keep the most recently used entries up to 90% of the limit to avoid evicting on every insert
+                connection.execute('DELETE FROM predictions WHERE key IN ('
+                                   'SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS kept '
+                                   'FROM predictions) WHERE kept > ?)', (int(self.max_size * 0.9),))
+                logger.debug(f'Evicted prediction cache entries; cache exceeded {self.max_size} bytes')
+            connection.commit()
+
+
+def cache_keys(model_name, inputs: pd.DataFrame):
+    """
+    Build cache keys from the model inputs of every peptide
+    :param model_name: Name of the prediction model
+    :param inputs: Dataframe with one column per model input, e.g. peptide_sequences and precursor_charges
+    :return: Numpy array of keys, one per row of inputs
+    """
+    keys = pd.Series(model_name, index=inputs.index, dtype=object)
+    for input_name in sorted(inputs.columns):
+        values = inputs[input_name]
+        if input_name in NUMERIC_MODEL_INPUTS:
+            # 30 and 30.0 have to map to the same key
+            values = values.astype('float64')
+        keys = keys + KEY_SEPARATOR + values.astype(str)
+    return keys.to_numpy()
+
+
+def encode_prediction(outputs, i):
+    """
+    Encode the predictions of a single peptide
+    :param outputs: Dictionary of model outputs with one row per peptide; object arrays have to be converted already
+    :param i: Row of the peptide
+    :return: Bytes containing a json header with names, dtypes and shapes followed by the raw array data
+    """
+    header = json.dumps([(name, array.dtype.str, array.shape[1:]) for name, array in sorted(outputs.items())])
+    data = b''.join(np.ascontiguousarray(array[i]).tobytes() for _, array in sorted(outputs.items()))
+    return len(header).to_bytes(4, 'little') + header.encode() + data
+
+
+def decode_prediction(value):
+    """
+    Decode the predictions of a single peptide encoded by encode_prediction()
+    :param value: Encoded predictions
+    :return: Dictionary of model outputs of the peptide
+    """
+    header_length = int.from_bytes(value[:4], 'little')
+    offset = 4 + header_length
+    outputs = {}
+    for name, dtype, shape in json.loads(value[4:offset]):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        outputs[name] = np.frombuffer(value, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    return outputs
+
+
+def _to_fixed_width(array):
+    if array.dtype != object:
+        return array
+    if array.size > 0 and isinstance(array.flat[0], bytes):
+        return array.astype(bytes)
+    return array.astype(str)
+
+
+class CachedPredictionInterface:
+    """
+    Wraps an Oktoberfest prediction interface (e.g. Koina) so that predictions are served from a PredictionCache and
+    only peptides that are not cached are sent to the prediction server, each of them once per batch. Everything
+    except predict() is forwarded to the wrapped interface. Any object with model_inputs and predict(data) can be
+    wrapped, e.g. a Koina client pointing at a local stand-in server.
+    """
+    def __init__(self, predictor, model_name, cache: PredictionCache):
+        self._predictor = predictor
+        self.model_name = model_name
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # only called for attributes the wrapper lacks; copy and pickle create instances without calling __init__ and
+        # look up dunder methods before _predictor is set
+        if name.startswith('__') or '_predictor' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.__dict__['_predictor'], name)
+
+    def _model_inputs(self, data):
+        if isinstance(data, dict):
+            return pd.DataFrame({name: np.asarray(data[name]).ravel() for name in self._predictor.model_inputs})
+        obs = data if isinstance(data, pd.DataFrame) else data.obs
+        return pd.DataFrame({name: obs[MODEL_INPUT_COLUMNS[name]].to_numpy()
+                             for name in self._predictor.model_inputs})
+
+    def predict(self, data, **kwargs):
+        """
+        Predict with the wrapped interface, using cached predictions where available
+        :param data: Spectra, dataframe or dictionary of model inputs, as accepted by Koina.predict
+        :param kwargs: Additional arguments forwarded to the wrapped interface
+        :return: Dictionary of model outputs with one row per peptide in data
+        """
+        inputs = self._model_inputs(data)
+        keys = cache_keys(self.model_name, inputs)
+        unique_keys, first_rows, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        unique_keys = unique_keys.tolist()
+
+        encoded = self.cache.get(unique_keys)
+        missing = [i for i, key in enumerate(unique_keys) if key not in encoded]
+        logger.info(f'{self.model_name}: {len(keys)} predictions, {len(unique_keys)} unique, '
+                    f'{len(unique_keys) - len(missing)} cached')
+        if missing:
+            missing_rows = first_rows[missing]
+            missing_inputs = {name: inputs[name].to_numpy()[missing_rows].reshape(-1, 1) for name in inputs.columns}
+
+            def store(start, stop, predicted):
+                predicted = {name: _to_fixed_width(np.asarray(array)) for name, array in predicted.items()}
+                new_entries = {unique_keys[missing[start + j]]: encode_prediction(predicted, j)
+                               for j in range(stop - start)}
+                self.cache.put(new_entries)
+                encoded.update(new_entries)
+
+            if hasattr(self._predictor, 'predict_streaming'):
+                # batches are cached as they arrive, so a failed or interrupted prediction keeps the finished ones
+                self._predictor.predict_streaming(missing_inputs, store)
+            else:
+                store(0, len(missing), self._predictor.predict(missing_inputs, **kwargs))
+
+        unique_outputs = [decode_prediction(encoded[key]) for key in unique_keys]
+        names = unique_outputs[0].keys() if unique_outputs else []
+        return {name: np.stack([outputs[name] for outputs in unique_outputs])[inverse] for name in names}
+
+
+@contextmanager
+def cached_predictions(cache: PredictionCache = None):
+    """
+    Make all Oktoberfest predictors created via Predictor.from_config within this context use the prediction cache.
+    :param cache: PredictionCache to use; None to leave predictions uncached
+    :return: None
+    """
+    if cache is None:
+        yield
+        return
+
+    from oktoberfest.predict import Predictor
+
+    original = Predictor.__dict__['from_config']
+
+    def from_config(config, model_type, **kwargs):
+        predictor = original.__func__(Predictor, config, model_type, **kwargs)
+        if hasattr(predictor._predictor, 'model_inputs'):
+            predictor._predictor = CachedPredictionInterface(predictor._predictor, predictor.model_name, cache)
+        return predictor
+
+    Predictor.from_config = staticmethod(from_config)
+    try:
+        yield
+    finally:
+        Predictor.from_config = original
+
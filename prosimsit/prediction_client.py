@@ -0,0 +1,239 @@
+import time
+import random
+import asyncio
+import inspect
+import logging
+import functools
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from prosimsit.constants import DEFAULT_MAX_REQUESTS_IN_FLIGHT
+from prosimsit.prediction_cache import MODEL_INPUT_COLUMNS
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+# numpy types of the KServe v2 tensor datatypes used by Koina models
+DATATYPES = {'FP32': np.dtype('float32'), 'BYTES': np.dtype('O'), 'INT16': np.dtype('int16'),
+             'INT32': np.dtype('int32'), 'INT64': np.dtype('int64')}
+# gRPC status codes of errors that are worth retrying, e.g. an overloaded or restarting server
+RETRYABLE_STATUSES = {'StatusCode.UNAVAILABLE', 'StatusCode.DEADLINE_EXCEEDED', 'StatusCode.RESOURCE_EXHAUSTED',
+                      'StatusCode.ABORTED', 'StatusCode.UNKNOWN'}
+MIN_BATCH_SIZE = 16
+INITIAL_BATCH_SIZE = 256
+# batch sizes are adapted so that a request takes about this long, long enough to amortize the round-trip
+TARGET_REQUEST_SECONDS = 2.0
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+REQUEST_TIMEOUT_SECONDS = 600
+
+
+class AsyncKoina:
+    """
+    Prediction interface with the same predict() as Oktoberfest's Koina interface, but requests are sent with asyncio:
+    up to max_in_flight batches are outstanding at any time, spread over a pool of gRPC connections, so that the
+    server computes the next batches while the results of the previous ones are transferred and decoded. Batch sizes
+    adapt to the observed latency, failed requests are retried with exponential backoff and smaller batches.
+    """
+    def __init__(self, model_name, server_url='koina.wilhelmlab.org:443', ssl=True, targets=None,
+                 max_in_flight=DEFAULT_MAX_REQUESTS_IN_FLIGHT, connections=2, max_retries=MAX_RETRIES,
+                 backoff_seconds=BACKOFF_SECONDS, target_request_seconds=TARGET_REQUEST_SECONDS):
+        """
+        :param model_name: Name of the Koina model
+        :param server_url: Address of the Koina server, host:port
+        :param ssl: Use an encrypted connection
+        :param targets: Names of the model outputs to request; None for all outputs
+        :param max_in_flight: Maximum number of requests waiting for their response
+        :param connections: Number of gRPC connections the requests are spread over
+        :param max_retries: Number of retries of a failed request before giving up
+        :param backoff_seconds: Delay before the first retry; doubled for every further retry
+        :param target_request_seconds: Latency per request the batch size is adapted to
+        """
+        self.model_name = model_name
+        self.url = server_url
+        self.ssl = ssl
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.connections = max(int(connections), 1)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.target_request_seconds = target_request_seconds
+        self.model_inputs = {}
+        self.model_outputs = {}
+        self.max_batch_size = 0
+        asyncio.run(self._load_metadata(targets))
+        self.batch_size = min(INITIAL_BATCH_SIZE, self.max_batch_size)
+
+    def _client(self):
+        from tritonclient.grpc.aio import InferenceServerClient
+
+        return InferenceServerClient(url=self.url, ssl=self.ssl)
+
+    async def _load_metadata(self, targets):
+        async with self._client() as client:
+            metadata = await client.get_model_metadata(self.model_name)
+            config = await client.get_model_config(self.model_name)
+        self.model_inputs = {i.name: (list(i.shape), i.datatype) for i in metadata.inputs}
+        outputs = {o.name: o.datatype for o in metadata.outputs}
+        unknown = [target for target in targets or [] if target not in outputs]
+        if unknown:
+            raise ValueError(f'{", ".join(unknown)} are not outputs of {self.model_name}; valid outputs are '
+                             f'{", ".join(outputs)}')
+        self.model_outputs = {name: datatype for name, datatype in outputs.items() if not targets or name in targets}
+        # 0 means the model does not batch on the server; requests can still contain several peptides
+        self.max_batch_size = config.config.max_batch_size or INITIAL_BATCH_SIZE
+
+    def _input_arrays(self, data):
+        if isinstance(data, dict):
+            return {name: np.asarray(data[name]).reshape(-1, 1) for name in self.model_inputs}
+        obs = data if isinstance(data, pd.DataFrame) else data.obs
+        return {name: obs[MODEL_INPUT_COLUMNS[name]].to_numpy().reshape(-1, 1) for name in self.model_inputs}
+
+    def _adapt_batch_size(self, rows, seconds):
+        if rows < self.batch_size or seconds <= 0:
+            # the last batch of a call is shorter and says little about the throughput
+            return
+        desired = self.target_request_seconds * rows / seconds
+        self.batch_size = int(min(max((self.batch_size + desired) / 2, MIN_BATCH_SIZE), self.max_batch_size))
+
+    async def _infer(self, client, inputs, start, stop):
+        """
+        Request the predictions of the rows start:stop of inputs, retrying transient errors
+        :return: Dictionary of model outputs for these rows
+        """
+        from tritonclient.grpc import InferInput, InferRequestedOutput
+        from tritonclient.utils import InferenceServerException
+
+        for attempt in range(self.max_retries + 1):
+            infer_inputs = []
+            for name, (_, datatype) in self.model_inputs.items():
+                array = inputs[name][start:stop].astype(DATATYPES[datatype])
+                infer_inputs.append(InferInput(name, list(array.shape), datatype))
+                infer_inputs[-1].set_data_from_numpy(array)
+            requested = [InferRequestedOutput(name) for name in self.model_outputs]
+            started = time.monotonic()
+            try:
+                result = await client.infer(self.model_name, infer_inputs, outputs=requested,
+                                            client_timeout=REQUEST_TIMEOUT_SECONDS)
+            except InferenceServerException as e:
+                if attempt == self.max_retries or e.status() not in RETRYABLE_STATUSES:
+                    raise
+                self.batch_size = max(self.batch_size // 2, MIN_BATCH_SIZE)
+                delay = self.backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f'{self.model_name}: request of {stop - start} peptides failed with {e.status()}, '
+                               f'retrying in {delay:.1f} s')
+                await asyncio.sleep(delay)
+                continue
+            self._adapt_batch_size(stop - start, time.monotonic() - started)
+            return {name: result.as_numpy(name) for name in self.model_outputs}
+
+    async def _predict(self, inputs, on_batch):
+        n_rows = len(next(iter(inputs.values()))) if inputs else 0
+        clients = [self._client() for _ in range(self.connections)]
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks = []
+
+        async def request(client, start, stop):
+            try:
+                outputs = await self._infer(client, inputs, start, stop)
+            finally:
+                slots.release()
+            on_batch(start, stop, outputs)
+
+        try:
+            start = 0
+            while start < n_rows:
+                # the batch is only cut once a slot is free, so it gets the batch size adapted to the latest responses
+                await slots.acquire()
+                failed = [task for task in tasks if task.done() and task.exception() is not None]
+                if failed:
+                    slots.release()
+                    raise failed[0].exception()
+                stop = min(start + self.batch_size, n_rows)
+                tasks.append(asyncio.create_task(request(clients[len(tasks) % len(clients)], start, stop)))
+                start = stop
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for client in clients:
+                await client.close()
+        logger.debug(f'{self.model_name}: predicted {n_rows} peptides in {len(tasks)} requests, '
+                     f'batch size now {self.batch_size}')
+
+    def predict_streaming(self, data, on_batch):
+        """
+        Predict and hand over the predictions of every batch as soon as its response arrived
+        :param data: Spectra, dataframe or dictionary of model inputs, as accepted by predict()
+        :param on_batch: Function called as on_batch(start, stop, outputs) for the predictions of rows start:stop of
+            data, in the order the responses arrive
+        :return: None
+        """
+        asyncio.run(self._predict(self._input_arrays(data), on_batch))
+
+    def predict(self, data, **kwargs):
+        """
+        :param data: Spectra, dataframe with Oktoberfest columns or dictionary of model inputs with one row per peptide
+        :param kwargs: Arguments of Koina.predict, e.g. disable_progress_bar; ignored
+        :return: Dictionary of model outputs with one row per peptide in data
+        """
+        batches = {}
+
+        def collect(start, stop, outputs):
+            batches[start] = outputs
+
+        self.predict_streaming(data, collect)
+        starts = sorted(batches)
+        return {name: np.concatenate([batches[start][name] for start in starts]) if starts else np.empty(0)
+                for name in self.model_outputs}
+
+
+def _from_koina(cls, model_name, server_url='koina.wilhelmlab.org:443', ssl=True, targets=None,
+                max_in_flight=DEFAULT_MAX_REQUESTS_IN_FLIGHT):
+    return cls(AsyncKoina(model_name, server_url, ssl, targets, max_in_flight), model_name=model_name)
+
+
+def _fits_predictor(predictor_class):
+    """
+    :param predictor_class: Oktoberfest's Predictor class
+    :return: True if its constructor takes the prediction interface and the model name like in the Oktoberfest
+        versions AsyncKoina was written against, and its from_koina() has no arguments _from_koina() does not know
+    """
+    try:
+        inspect.signature(predictor_class).bind(None, model_name='')
+    except TypeError:
+        return False
+    known = inspect.signature(_from_koina).parameters
+    return all(name in known for name in inspect.signature(predictor_class.from_koina).parameters)
+
+
+@contextmanager
+def async_predictions(conf):
+    """
+    Make Oktoberfest predict via AsyncKoina within this context if the Oktoberfest config asks for it, see
+    oktoberfest_functions.generate_oktoberfest_config. Falls back to Oktoberfest's client with a warning if the
+    installed Oktoberfest creates its predictors differently.
+    :param conf: Oktoberfest Config object
+    :return: None
+    """
+    settings = conf.data.get('predictionClient', {})
+    if settings.get('type', 'koinapy') != 'async':
+        yield
+        return
+
+    from oktoberfest.predict import Predictor
+
+    if not _fits_predictor(Predictor):
+        logger.warning('The installed Oktoberfest creates its predictors differently than expected, requesting '
+                       'predictions with its own client instead of the asynchronous one')
+        yield
+        return
+
+    original = Predictor.__dict__['from_koina']
+    max_in_flight = settings.get('maxRequestsInFlight', DEFAULT_MAX_REQUESTS_IN_FLIGHT)
+    Predictor.from_koina = classmethod(functools.partial(_from_koina, max_in_flight=max_in_flight))
+    try:
+        yield
+    finally:
+        Predictor.from_koina = original
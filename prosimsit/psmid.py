@@ -0,0 +1,101 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+# Oktoberfest PSMIds have the shape <raw file>-<scan number>-<modified sequence>-<charge>[-<scan event number>].
+# Raw file names and modified sequences (e.g. '[UNIMOD:737]-PEPTIDE') can contain hyphens themselves; a lazy raw file
+# group is resolved against the known raw file names afterwards.
+PSMID_SUFFIX_PATTERN = r'(?P<scan>\d+)-(?P<sequence>.+?)-(?P<charge>\d+)(?:-\d+)?$'
+PSMID_PATTERN = r'^(?P<raw>.+?)-' + PSMID_SUFFIX_PATTERN
+
+# upper bound for scan numbers within a raw file; used to pack (raw file, scan number) into a single integer
+SCANS_PER_FILE = 10_000_000
+
+
+def parse_psmids(psmids: pd.Series, raw_files) -> pd.DataFrame:
+    """
+    Parse Oktoberfest PSMIds into typed columns in a single pass
+    :param psmids: Series containing PSMIds from Oktoberfest/Percolator
+    :param raw_files: All raw file names the PSMIds can refer to; used to resolve hyphens in raw file names exactly
+    :return: Dataframe with the index of psmids and the columns 'Raw file' (categorical with raw_files as categories),
+        'Scan number' (int), 'Modified sequence' (Oktoberfest format) and 'Charge' (int)
+    """
+    raw_files = sorted(set(raw_files))
+    parts = psmids.str.extract(PSMID_PATTERN)
+    if parts['raw'].isna().any():
+        raise ValueError(f'Could not parse PSMId {psmids[parts["raw"].isna()].iloc[0]}')
+
+    # raw file names that are a prefix of another raw file name can be matched by the lazy group by mistake
+    prefix_names = [a for a in raw_files if any(b.startswith(a + '-') for b in raw_files)]
+    raw_codes = pd.Categorical(parts['raw'], categories=raw_files).codes
+    unresolved = (raw_codes == -1) | parts['raw'].isin(prefix_names).to_numpy()
+    if unresolved.any():
+        # the raw file name itself contains -<digits>-; match these rows against the known names instead
+        parts.loc[unresolved] = _resolve_raw_files(psmids[unresolved], raw_files)
+        raw_codes = pd.Categorical(parts['raw'], categories=raw_files).codes
+        if (raw_codes == -1).any():
+            raise ValueError(f'Unknown raw file in PSMId {psmids[raw_codes == -1].iloc[0]}')
+
+    return pd.DataFrame({
+        'Raw file': pd.Categorical.from_codes(raw_codes, categories=raw_files),
+        'Scan number': parts['scan'].astype(np.int64),
+        'Modified sequence': parts['sequence'],
+        'Charge': parts['charge'].astype(np.int64),
+    }, index=psmids.index)
+
+
+def _resolve_raw_files(psmids: pd.Series, raw_files):
+    parts = pd.DataFrame(index=psmids.index, columns=['raw', 'scan', 'sequence', 'charge'], dtype=object)
+    remaining = pd.Series(True, index=psmids.index)
+    for raw_file in sorted(raw_files, key=len, reverse=True):
+        matches = remaining & psmids.str.startswith(raw_file + '-')
+        if not matches.any():
+            continue
+        rest = psmids[matches].str.slice(len(raw_file) + 1).str.extract('^' + PSMID_SUFFIX_PATTERN)
+        parts.loc[matches, ['scan', 'sequence', 'charge']] = rest.to_numpy()
+        parts.loc[matches, 'raw'] = raw_file
+        remaining &= ~matches
+    return parts
+
+
+def scan_keys(raw_file_names, scan_numbers, raw_files) -> np.ndarray:
+    """
+    Pack raw file and scan number into a single integer identifying a scan
+    :param raw_file_names: Raw file of each PSM
+    :param scan_numbers: Scan number of each PSM
+    :param raw_files: All raw file names; the position of a raw file in sorted(raw_files) is its code
+    :return: Array of int64 keys raw file code * SCANS_PER_FILE + scan number; -1 for unknown raw files
+    """
+    codes = pd.Categorical(raw_file_names, categories=sorted(set(raw_files))).codes.astype(np.int64)
+    scans = np.asarray(scan_numbers, dtype=np.int64)
+    if (scans >= SCANS_PER_FILE).any():
+        raise ValueError(f'Scan numbers of {SCANS_PER_FILE} or higher are not supported')
+    return np.where(codes >= 0, codes * SCANS_PER_FILE + scans, -1)
+
+
+def psm_keys(scan_key_arrays, sequence_arrays):
+    """
+    Pack scan keys and modified sequences of several tables into integer keys that are comparable between the tables.
+    Sequences are factorized over all tables together, so equal keys mean equal PSMs.
+    :param scan_key_arrays: List of scan key arrays, see scan_keys()
+    :param sequence_arrays: List of modified sequence arrays, one per scan key array
+    :return: List of int64 key arrays; -1 for unknown raw files or missing sequences
+    """
+    sequence_codes, sequences = pd.factorize(
+        pd.concat([pd.Series(np.asarray(s, dtype=object)) for s in sequence_arrays], ignore_index=True))
+    n_sequences = max(len(sequences), 1)
+    scan_key_arrays = [np.asarray(k, dtype=np.int64) for k in scan_key_arrays]
+    max_scan_key = max((k.max() for k in scan_key_arrays if len(k) > 0), default=0)
+    if max_scan_key >= np.iinfo(np.int64).max // n_sequences:
+        raise ValueError('Too many raw files and modified sequences to pack PSMs into 64-bit keys')
+
+    keys = []
+    offset = 0
+    for scan_key in scan_key_arrays:
+        codes = sequence_codes[offset:offset + len(scan_key)].astype(np.int64)
+        offset += len(scan_key)
+        keys.append(np.where((scan_key >= 0) & (codes >= 0), scan_key * n_sequences + codes, -1))
+    return keys
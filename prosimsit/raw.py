@@ -1,10 +1,159 @@
+import os
+import json
+import hashlib
+import functools
+import threading
 from pathlib import Path
+from contextlib import contextmanager
 from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from simsi_transfer.thermo_raw import convert_raw_mzml_batch
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
+import simsi_transfer.thermo_raw
+from simsi_transfer.thermo_raw import convert_raw_mzml
+
+from prosimsit.io import atomic_path
 from prosimsit.utils import logger
 
+MANIFEST_FILE = 'mzml_manifest.json'
+# the converter SIMSI-Transfer ships and calls in convert_raw_mzml
+THERMO_RAW_FILE_PARSER_DIR = Path(simsi_transfer.thermo_raw.__file__).parent / 'utils' / 'ThermoRawFileParser'
+
+_manifest_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def converter_version(converter_dir: Path = THERMO_RAW_FILE_PARSER_DIR):
+    """
+    :param converter_dir: Directory of the ThermoRawFileParser executable and its libraries
+    :return: Content hash of the raw file converter; a change invalidates all previously converted files
+    """
+    sha256 = hashlib.sha256()
+    files = sorted(f for f in Path(converter_dir).rglob('*') if f.is_file())
+    if not files:
+        raise FileNotFoundError(f'Could not find ThermoRawFileParser in {converter_dir}')
+    for f in files:
+        sha256.update(f.relative_to(converter_dir).as_posix().encode() + b'\0')
+        with open(f, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                sha256.update(block)
+    return f'ThermoRawFileParser sha256:{sha256.hexdigest()}'
+
+
+@contextmanager
+def locked_manifest(manifest_path: Path):
+    """
+    Lock the manifest against concurrent updates by other threads and by other processes, e.g. shard workers
+    converting the raw files of their shard into the same folder
+    :param manifest_path: Path to the manifest
+    :return: None
+    """
+    with _manifest_lock:
+        if fcntl is None:
+            yield
+            return
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path.with_name(manifest_path.name + '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_manifest(manifest_path: Path):
+    if not manifest_path.is_file():
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, manifest_path: Path):
+    with atomic_path(manifest_path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def conversion_record(raw_file: Path, mzml_file: Path, ms_level: str):
+    raw_stat = raw_file.stat()
+    return {
+        'source': str(raw_file.resolve()),
+        'source_size': raw_stat.st_size,
+        'source_mtime_ns': raw_stat.st_mtime_ns,
+        'converter': converter_version(),
+        'ms_level': ms_level,
+        'mzml_size': mzml_file.stat().st_size if mzml_file.is_file() else None,
+    }
+
+
+def is_converted(raw_file: Path, mzml_file: Path, record, ms_level: str):
+    """
+    Check if a raw file was already converted with the current converter and has not changed since
+    :param raw_file: Path to raw file
+    :param mzml_file: Path to the mzML file it is converted to
+    :param record: Manifest record of the previous conversion or None
+    :param ms_level: MS level to convert
+    :return: True if the mzML file is complete and up to date
+    """
+    if record is None or not mzml_file.is_file():
+        return False
+    return record == conversion_record(raw_file, mzml_file, ms_level)
+
+
+def convert_raw_file(raw_file: Path, output_folder: Path, ms_level: str = "2-"):
+    """
+    Converts a single raw file to mzML using ThermoRawFileParser, unless it was already converted from the same raw
+    file with the same converter version. The file is converted under a temporary name in a staging folder and renamed
+    into output_folder once complete; the conversion record is added to a manifest next to output_folder. Safe to
+    call from multiple threads.
+    :param raw_file: Path to raw file
+    :param output_folder: Path to output folder
+    :param ms_level: MS level to convert; keep at default if no specific MS level is needed for further processing
+    :return: Path to the mzML file
+    """
+    mzml_file = output_folder / raw_file.with_suffix('.mzML').name
+    manifest_path = output_folder.parent / MANIFEST_FILE
+    with locked_manifest(manifest_path):
+        record = read_manifest(manifest_path).get(mzml_file.name)
+    if is_converted(raw_file, mzml_file, record, ms_level):
+        logger.debug(f'Found up to date conversion of {raw_file} at {mzml_file}, skipping conversion')
+        return mzml_file
+    if mzml_file.is_file():
+        logger.info(f'Converted file {mzml_file} is outdated or unverified; converting again')
+        mzml_file.unlink()
+
+    # convert into a staging folder on the same file system so that output_folder only ever contains complete files
+    staging_folder = output_folder.parent / f'.{output_folder.name}.converting'
+    staging_folder.mkdir(parents=True, exist_ok=True)
+    staging_file = staging_folder / mzml_file.name
+    for leftover in [staging_file, staging_file.with_name(staging_file.name + '.tmp')]:
+        if leftover.exists():
+            leftover.unlink()
+
+    logger.info(f'Converting {raw_file} to mzML')
+    convert_raw_mzml(raw_file, staging_file, ms_level=ms_level)
+    os.replace(staging_file, mzml_file)
+
+    with locked_manifest(manifest_path):
+        manifest = read_manifest(manifest_path)
+        manifest[mzml_file.name] = conversion_record(raw_file, mzml_file, ms_level)
+        write_manifest(manifest, manifest_path)
+    return mzml_file
+
+
+def convert_for_spectra_file(mzml_file: Path, raw_dir: Path):
+    """
+    Convert the raw file belonging to an mzML file path; used as per-file step of the first Oktoberfest run
+    :param mzml_file: Path the mzML file should be converted to
+    :param raw_dir: Directory containing the raw files
+    :return: None
+    """
+    convert_raw_file(raw_dir / mzml_file.with_suffix('.raw').name, mzml_file.parent)
+
 
 def convert_raw_files(
         raw_file_paths: List[Path],
@@ -12,36 +161,37 @@ def convert_raw_files(
         num_threads=1,
         ms_level: str = "2-"):
     """
-    Converts raw files to mzML files using ThermoRawFileParser.
+    Converts raw files to mzML files using ThermoRawFileParser. Only raw files that are missing in the output folder,
+    changed since their last conversion or were converted with a different converter version are converted.
     :param raw_file_paths: List of paths to raw files
     :param output_folder: Path to output folder
     :param num_threads: Number of threads to use
     :param ms_level: MS level to convert; keep at default if no specific MS level is needed for further processing
     :return: None
     """
-    convert_raw_mzml_batch(raw_files=raw_file_paths, output_folder=output_folder, num_threads=num_threads,
-                           ms_level=ms_level)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        for future in as_completed([executor.submit(convert_raw_file, raw_file, output_folder, ms_level)
+                                    for raw_file in raw_file_paths]):
+            future.result()
 
 
-def convert_and_get_path(raw_type, threads, raw_dir, msms, output_dir):
+def get_spectra_files(raw_type, raw_dir: Path, raw_files, output_dir: Path):
     """
-    Convert raw files to mzML and return the path to the mzML directory
+    Get the mzML directory and the mzML files used by all later steps. For raw input, the mzML files do not need to
+    exist yet; they are converted as part of the first Oktoberfest run, see convert_for_spectra_file.
     :param raw_type: 'raw' or 'mzml'
-    :param threads: Number of threads to use
     :param raw_dir: Directory containing input files
-    :param msms: msms.txt file; used to get a list of all involved raw files
+    :param raw_files: Names of all raw files referenced in msms.txt
     :param output_dir: Directory to generate mzML folder in and save files after conversion
-    :return: Path to mzML directory
+    :return: Tuple of path to mzML directory and list of paths to mzML files
     """
     if raw_type == 'raw':
-        raw_file_paths = [raw_dir / f'{f}.raw' for f in list(set(msms['Raw file']))]
-        logger.info(f'Converting .raw files to mzML')
-        if output_dir / 'mzml' not in output_dir.iterdir():
-            (output_dir / 'mzml').mkdir()
-        convert_raw_files(raw_file_paths, output_dir / 'mzml', threads)
         mzml_dir = output_dir / 'mzml'
+        spectra_files = [mzml_dir / f'{f}.mzML' for f in raw_files]
     elif raw_type == 'mzml':
         mzml_dir = raw_dir
+        spectra_files = sorted(f for f in raw_dir.iterdir() if f.suffix.lower() == '.mzml')
     else:
         raise ValueError(f'Unknown raw type: {raw_type}')
-    return mzml_dir
+    return mzml_dir, spectra_files
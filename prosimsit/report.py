@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import cProfile
+import logging
+import functools
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from prosimsit.io import atomic_path
+from prosimsit.constants import PROFILERS
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+REPORT_FILE = 'run_report.json'
+
+# measurements that are currently running in any thread; their peaks are folded in before the peak is reset
+_open_measurements = []
+_measurement_lock = threading.RLock()
+# measurements opened by the current thread, outermost first; steps are nested in the stage they are called from
+_thread_measurements = threading.local()
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident set size of this process, supported by Linux 4.0 and later
+    :return: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """
+    :return: Peak resident set size of this process in MB since start or since the last _reset_peak_rss()
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def _children_peak_rss_mb():
+    """
+    :return: Peak resident set size in MB of the largest terminated and waited for child process so far, e.g.
+        Percolator or a worker of a process pool; the operating system only keeps this maximum over the lifetime of
+        the process
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _cpu_times():
+    """
+    :return: Tuple of CPU seconds spent by this process and by its terminated child processes
+    """
+    if resource is None:
+        return time.process_time(), 0.0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+def path_size(path):
+    """
+    :param path: Path to a file or directory
+    :return: Size of the file or of all files below the directory in bytes; None if the path does not exist
+    """
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    return None
+
+
+class _Measurement:
+    """
+    Resource usage of a stage or step. The peak RSS of the process is reset whenever a measurement starts or ends, so
+    the peak of each open measurement is folded in before every reset. CPU times and peaks are only measured per
+    process, so measurements overlapping with one of another thread, i.e. of a concurrent stage, are marked as shared.
+    Only the lifetime maximum of the peak RSS of child processes is known; a measurement reports it if it increased
+    while the measurement was open, i.e. if a child process of the measurement used more memory than all before.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self.peak_rss_mb = None
+        self.peak_rss_scope = 'measurement'
+        self.shared = False
+
+    def _fold_peak(self):
+        peak = _peak_rss_mb()
+        if peak is None:
+            return
+        for measurement in _open_measurements:
+            measurement.peak_rss_mb = max(measurement.peak_rss_mb or 0.0, peak)
+
+    def __enter__(self):
+        with _measurement_lock:
+            self._fold_peak()
+            if not _reset_peak_rss():
+                self.peak_rss_scope = 'process'
+            # measurements of this thread that are still open are the stage and steps this one is nested in
+            for measurement in _open_measurements:
+                if measurement not in _thread_stack():
+                    measurement.shared = self.shared = True
+            _open_measurements.append(self)
+        _thread_stack().append(self)
+        self.start_wall = time.perf_counter()
+        self.start_cpu, self.start_children_cpu = _cpu_times()
+        self.start_children_peak_rss_mb = _children_peak_rss_mb()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        cpu, children_cpu = _cpu_times()
+        children_peak_rss_mb = _children_peak_rss_mb()
+        _thread_stack().remove(self)
+        # the report may be saved by another thread at the same time
+        with _measurement_lock:
+            self._fold_peak()
+            _open_measurements.remove(self)
+            _reset_peak_rss()
+            if children_peak_rss_mb is not None and children_peak_rss_mb <= (self.start_children_peak_rss_mb or 0.0):
+                children_peak_rss_mb = None
+            if self.shared and self.peak_rss_scope == 'measurement':
+                self.peak_rss_scope = 'shared'
+            self.entry.update({
+                'wall_time_s': round(time.perf_counter() - self.start_wall, 3),
+                'cpu_time_s': round(cpu - self.start_cpu, 3),
+                'children_cpu_time_s': round(children_cpu - self.start_children_cpu, 3),
+                'cpu_time_scope': 'shared' if self.shared else 'measurement',
+                'peak_rss_mb': None if self.peak_rss_mb is None else round(self.peak_rss_mb, 1),
+                'peak_rss_scope': self.peak_rss_scope,
+                'children_peak_rss_mb': children_peak_rss_mb,
+            })
+            if exc_type is not None:
+                self.entry['status'] = 'failed'
+                self.entry['error'] = f'{exc_type.__name__}: {exc_value}'
+        return False
+
+
+class RunReport:
+    """
+    Machine-readable record of the resource usage of a ProSIMSIt run: wall and CPU time, peak RSS of the process and
+    its child processes, rows and file sizes read and written by each stage and each instrumented helper. The report
+    is rewritten after every change, so the report of a crashed or OOM-killed run shows the stage it stopped in.
+    CPU times and peak RSS of stages that run concurrently cover the whole process while they overlap; their
+    cpu_time_scope and peak_rss_scope are 'shared'. children_peak_rss_mb of a stage is only given if a child process
+    of the stage used more memory than all child processes before; the report of the run gives the overall maximum.
+    """
+    def __init__(self, path: Path = None, profiler=None, metadata=None):
+        """
+        :param path: Path of the json report; None to only collect the report in memory
+        :param profiler: One of PROFILERS to profile every executed stage, or None
+        :param metadata: Dictionary of additional information about the run, e.g. the ProSIMSIt version
+        """
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f'Unknown profiler: {profiler}. Use one of {", ".join(PROFILERS)}.')
+        self.path = None if path is None else Path(path)
+        self.profiler = profiler
+        self.report = {'started': datetime.now().isoformat(), 'pid': os.getpid(), **(metadata or {}), 'stages': []}
+        self._start_wall = time.perf_counter()
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with _measurement_lock, atomic_path(self.path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.report, f, indent=4, default=str)
+
+    def skip_stage(self, name):
+        with _measurement_lock:
+            self.report['stages'].append({'name': name, 'status': 'skipped'})
+        self.save()
+
+    @contextmanager
+    def stage(self, name, inputs=(), outputs=(), allocation=None):
+        """
+        Measure the execution of a stage
+        :param name: Name of the stage
+        :param inputs: Files or directories the stage reads
+        :param outputs: Files or directories the stage writes
+        :param allocation: Dictionary of the resources allocated to the stage, see scheduler.Allocation
+        :return: None
+        """
+        entry = {'name': name, 'status': 'running', 'started': datetime.now().isoformat(),
+                 'input_bytes': {str(p): path_size(p) for p in inputs}, 'rows': {}, 'steps': []}
+        if allocation is not None:
+            entry['allocation'] = allocation
+        with _measurement_lock:
+            self.report['stages'].append(entry)
+        self.save()
+        try:
+            with _Measurement(entry), self._profile(name):
+                yield
+            with _measurement_lock:
+                entry['status'] = 'done'
+        finally:
+            output_bytes = {str(p): path_size(p) for p in outputs}
+            with _measurement_lock:
+                entry['output_bytes'] = output_bytes
+            self.save()
+
+    @contextmanager
+    def _profile(self, name):
+        if self.profiler is None:
+            yield
+            return
+        profile_dir = (self.path.parent if self.path is not None else Path.cwd()) / 'profiles'
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        if self.profiler == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(profile_dir / f'{name}.prof')
+            return
+
+        if shutil.which('py-spy') is None:
+            logger.warning(f'py-spy was not found; stage {name} is not profiled')
+            yield
+            return
+        sampler = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses',
+                                    '--format', 'speedscope', '--output', str(profile_dir / f'{name}.speedscope.json')],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            yield
+        finally:
+            # py-spy writes its output when it is interrupted
+            sampler.send_signal(signal.SIGINT if hasattr(signal, 'SIGINT') else signal.SIGTERM)
+            try:
+                sampler.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                sampler.kill()
+
+    def finish(self):
+        self.report['finished'] = datetime.now().isoformat()
+        self.report['wall_time_s'] = round(time.perf_counter() - self._start_wall, 3)
+        cpu, children_cpu = _cpu_times()
+        self.report['cpu_time_s'] = round(cpu, 3)
+        self.report['children_cpu_time_s'] = round(children_cpu, 3)
+        self.report['children_peak_rss_mb'] = _children_peak_rss_mb()
+        self.save()
+
+
+def _thread_stack():
+    if not hasattr(_thread_measurements, 'stack'):
+        _thread_measurements.stack = []
+    return _thread_measurements.stack
+
+
+def _current_entry():
+    stack = _thread_stack()
+    return stack[-1].entry if stack else None
+
+
+def step(func):
+    """
+    Decorator recording the resource usage of a helper in the report of the stage it is called from. Calls outside of
+    a measured stage, e.g. in worker processes or in thread pools of a stage, are not recorded.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        parent = _current_entry()
+        if parent is None:
+            return func(*args, **kwargs)
+        entry = {'name': func.__qualname__, 'rows': {}, 'steps': []}
+        with _measurement_lock:
+            parent['steps'].append(entry)
+        with _Measurement(entry):
+            result = func(*args, **kwargs)
+        with _measurement_lock:
+            entry['status'] = 'done'
+        return result
+    return wrapper
+
+
+def record_rows(label, n):
+    """
+    Add to the row count of the running stage or step
+    :param label: Name of the counted table, e.g. 'merged_msms written'
+    :param n: Number of rows
+    :return: None
+    """
+    entry = _current_entry()
+    if entry is not None:
+        with _measurement_lock:
+            entry['rows'][label] = entry['rows'].get(label, 0) + int(n)
@@ -0,0 +1,187 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from prosimsit.io import iter_table, write_table
+from prosimsit.constants import DEFAULT_MEMORY_BUDGET_MB
+import prosimsit.report as report
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+BIAS = 'm0'
+
+
+def read_weights(path_to_weights):
+    """
+    Read the model of a Percolator run from its weights file, i.e. the normalized weights of the first
+    cross-validation fold, as Percolator does for --init-weights
+    :param path_to_weights: Path to a Percolator weights.csv file
+    :return: Series of weights indexed by feature name, including the bias m0
+    """
+    with open(path_to_weights, 'r') as f:
+        lines = [line.rstrip('\n').split('\t') for line in f if line.strip() and not line.startswith('#')]
+    names, values = lines[0], lines[1]
+    if len(names) != len(values) or names[-1] != BIAS:
+        raise ValueError(f'Could not read Percolator weights from {path_to_weights}')
+    return pd.Series([float(v) for v in values], index=names)
+
+
+def feature_statistics(path_to_tab, features, chunksize):
+    """
+    Mean and standard deviation of each feature over all PSMs, used by Percolator to normalize features
+    :param path_to_tab: Path to the Percolator input table
+    :param features: Names of the feature columns
+    :param chunksize: Number of rows to read at once
+    :return: Tuple of arrays containing the mean and standard deviation of each feature
+    """
+    n, mean, m2 = 0, np.zeros(len(features)), np.zeros(len(features))
+    for chunk in iter_table(path_to_tab, columns=features, chunksize=chunksize):
+        x = chunk[features].to_numpy(dtype=np.float64)
+        if len(x) == 0:
+            continue
+        # merge the moments of this chunk into the running moments (Chan et al.)
+        chunk_mean = x.mean(axis=0)
+        delta = chunk_mean - mean
+        total = n + len(x)
+        mean = mean + delta * len(x) / total
+        m2 = m2 + ((x - chunk_mean) ** 2).sum(axis=0) + delta ** 2 * n * len(x) / total
+        n = total
+    std = np.sqrt(m2 / n) if n > 0 else np.ones(len(features))
+    std[~(std > 0)] = 1.0
+    return mean, std
+
+
+def score_psms(path_to_tab, weights: pd.Series, chunksize):
+    """
+    Score all PSMs with a static linear model on normalized features
+    :param path_to_tab: Path to the Percolator input table
+    :param weights: Normalized weights as returned by read_weights()
+    :param chunksize: Number of rows to read at once
+    :return: Dataframe with 'SpecId', 'Label', 'ScanNr', 'ExpMass', 'filename', 'Peptide', 'Proteins' and 'score'
+        columns
+    """
+    features = [f for f in weights.index if f != BIAS]
+    mean, std = feature_statistics(path_to_tab, features, chunksize)
+    # fold the normalization into the weights so that each chunk is scored by a single matrix-vector product
+    raw_weights = weights[features].to_numpy() / std
+    bias = weights[BIAS] - mean @ raw_weights
+
+    id_columns = ['SpecId', 'Label', 'ScanNr', 'ExpMass', 'filename', 'Peptide', 'Proteins']
+    scored = []
+    for chunk in iter_table(path_to_tab, columns=id_columns + features, chunksize=chunksize):
+        psms = chunk[id_columns].copy()
+        psms['score'] = chunk[features].to_numpy(dtype=np.float64) @ raw_weights + bias
+        scored.append(psms)
+    return pd.concat(scored, ignore_index=True)
+
+
+def target_decoy_competition(psms: pd.DataFrame, keys):
+    """
+    Keep only the best scoring PSM per key. Targets and decoys compete unless the keys include the label; decoys win
+    ties
+    :param psms: Dataframe with 'score' and 'Label' columns
+    :param keys: Columns identifying the competing PSMs, e.g. the spectrum
+    :return: Dataframe of the winning PSMs sorted by descending score
+    """
+    psms = psms.sort_values(['score', 'Label'], ascending=[False, True], kind='stable')
+    return psms.drop_duplicates(keys, keep='first')
+
+
+def _pool_adjacent_violators(y, w):
+    """
+    Weighted non-decreasing isotonic regression
+    :param y: Values to fit
+    :param w: Weight of each value
+    :return: Fitted values
+    """
+    values, weights, counts = [], [], []
+    for value, weight in zip(y.tolist(), w.tolist()):
+        count = 1
+        while values and values[-1] > value:
+            previous_weight = weights.pop()
+            value = (values.pop() * previous_weight + value * weight) / (previous_weight + weight)
+            weight += previous_weight
+            count += counts.pop()
+        values.append(value)
+        weights.append(weight)
+        counts.append(count)
+    return np.repeat(values, counts)
+
+
+def qvalues_and_peps(scores, is_decoy):
+    """
+    Estimate q-values and posterior error probabilities from target-decoy competition winners. q-values are
+    (decoys + 1) / targets above each score threshold, made monotone. PEPs are the ratio of decoys to targets at each
+    score, estimated by isotonic regression of the decoy probability on the score.
+    :param scores: Array of scores sorted in descending order
+    :param is_decoy: Boolean array marking decoys
+    :return: Tuple of arrays of q-values and PEPs
+    """
+    # PSMs with equal scores cannot be separated and get the same estimates
+    _, groups, group_sizes = np.unique(-scores, return_inverse=True, return_counts=True)
+    decoys = np.bincount(groups, weights=is_decoy.astype(np.float64), minlength=len(group_sizes))
+    targets = group_sizes - decoys
+
+    qvalues = np.minimum((np.cumsum(decoys) + 1) / np.maximum(np.cumsum(targets), 1), 1.0)
+    qvalues = np.minimum.accumulate(qvalues[::-1])[::-1]
+
+    decoy_probability = _pool_adjacent_violators(decoys / group_sizes, group_sizes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peps = np.where(decoy_probability < 1, decoy_probability / (1 - decoy_probability), 1.0)
+    peps = np.minimum(peps, 1.0)
+    return qvalues[groups], peps[groups]
+
+
+def _write_results(winners: pd.DataFrame, path_to_targets, path_to_decoys):
+    qvalues, peps = qvalues_and_peps(winners['score'].to_numpy(), (winners['Label'] != 1).to_numpy())
+    results = pd.DataFrame({
+        'PSMId': winners['SpecId'].to_numpy(),
+        'filename': winners['filename'].to_numpy(),
+        'score': winners['score'].to_numpy(),
+        'q-value': qvalues,
+        'posterior_error_prob': peps,
+        'peptide': winners['Peptide'].to_numpy(),
+        'proteinIds': winners['Proteins'].to_numpy(),
+    })
+    is_target = (winners['Label'] == 1).to_numpy()
+    write_table(results.loc[is_target], path_to_targets, schema={})
+    write_table(results.loc[~is_target], path_to_decoys, schema={})
+    return results.loc[is_target]
+
+
+@report.step
+def rescore_static(path_to_tab, path_to_weights, target_psms, decoy_psms, target_peptides, decoy_peptides,
+                   test_fdr=0.01, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Apply the model of a previous Percolator run to new PSMs, replacing `percolator --init-weights --static
+    --post-processing-tdc`. Features are normalized by their mean and standard deviation over all PSMs, scored with
+    the normalized weights and q-values and PEPs are computed after target-decoy competition per spectrum and,
+    on the resulting PSMs, per peptide. Output files have the same format as the corresponding Percolator results.
+    The pipeline keeps calling Percolator until the results of both agree on reference data, see
+    tests/test_rescoring.py; the benchmark uses this function to produce the results without Percolator installed.
+    :param path_to_tab: Path to the Percolator input table, either a tab file or a columnar table
+    :param path_to_weights: Path to the weights.csv file of the previous Percolator run
+    :param target_psms: Path to save target PSMs
+    :param decoy_psms: Path to save decoy PSMs
+    :param target_peptides: Path to save target peptides
+    :param decoy_peptides: Path to save decoy peptides
+    :param test_fdr: FDR threshold used to report the number of identifications
+    :param memory_budget_mb: Memory budget in MB for a single chunk of the input table
+    :return: None
+    """
+    weights = read_weights(path_to_weights)
+    # features are processed as float64, and scoring needs several temporary copies of a chunk
+    chunksize = max(int(memory_budget_mb * 1024 ** 2 / (8 * len(weights) * 4)), 10_000)
+    psms = score_psms(Path(path_to_tab), weights, chunksize)
+    logger.info(f'Scored {len(psms)} PSMs with {len(weights) - 1} features')
+    report.record_rows('PSMs scored', len(psms))
+
+    psm_winners = target_decoy_competition(psms, ['ScanNr', 'ExpMass'])
+    targets = _write_results(psm_winners, target_psms, decoy_psms)
+    logger.info(f'Found {(targets["q-value"] <= test_fdr).sum()} target PSMs at {test_fdr} FDR')
+
+    peptide_winners = target_decoy_competition(psm_winners, ['Peptide', 'Label'])
+    targets = _write_results(peptide_winners, target_peptides, decoy_peptides)
+    logger.info(f'Found {(targets["q-value"] <= test_fdr).sum()} target peptides at {test_fdr} FDR')
@@ -0,0 +1,263 @@
+import os
+import heapq
+import logging
+import threading
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import prosimsit.report as report
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+
+@dataclass
+class FileStep:
+    """
+    A processing step that is applied to each spectra file individually.
+    :param name: Name of the step, used for logging
+    :param func: Top-level function called as func(spectra_file, *args); has to be picklable for process steps
+    :param args: Additional arguments passed to func
+    :param executor: 'process' for CPU-bound Python steps, 'thread' for steps that mostly wait on external programs
+    :param chunks: Top-level function called as chunks(spectra_file, *args) that splits the work of the step on a file
+        into independent units, e.g. ranges of PSMs; func is then called as func(unit, *args) for every unit and
+        assemble(spectra_file, *args) once all units of the file are done. None to call func on whole files.
+    :param assemble: Top-level function combining the results of the units of a file, see chunks; None if the units
+        need no combining
+    """
+    name: str
+    func: Callable
+    args: Tuple = ()
+    executor: str = 'process'
+    chunks: Optional[Callable] = None
+    assemble: Optional[Callable] = None
+
+
+@dataclass
+class Footprint:
+    """
+    Estimated resource usage of a single task of a stage, e.g. one spectra file in a worker process or one thread of
+    an external tool. The default is a stage consisting of one serial task with negligible memory.
+    :param cores: Cores kept busy by one task; 0 for tasks that mostly wait on I/O
+    :param memory_mb: Peak memory of one task in MB
+    :param max_tasks: Maximum number of tasks the stage can run in parallel; None if it is only limited by the budget
+    """
+    cores: int = 1
+    memory_mb: float = 0
+    max_tasks: Optional[int] = 1
+
+
+@dataclass
+class Allocation:
+    """
+    Share of the ResourceBudget granted to a stage for its whole execution.
+    :param tasks: Number of tasks the stage may run in parallel, i.e. its number of workers or threads
+    :param cores: Cores reserved for the stage
+    :param memory_mb: Memory reserved for the stage in MB
+    """
+    tasks: int
+    cores: int
+    memory_mb: float
+
+
+def available_memory_mb():
+    """
+    :return: Physical memory of the node in MB, limited by the memory limit of the cgroup this process runs in, e.g.
+        set by a cluster scheduler or a container; None if it cannot be determined
+    """
+    limits = []
+    try:
+        limits.append(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+    except (AttributeError, ValueError, OSError):
+        pass
+    for cgroup_limit in [Path('/sys/fs/cgroup/memory.max'), Path('/sys/fs/cgroup/memory/memory.limit_in_bytes')]:
+        try:
+            limits.append(int(cgroup_limit.read_text().strip()))
+        except (OSError, ValueError):
+            # 'max' if the cgroup is not limited
+            pass
+    return min(limits) / 1024 ** 2 if limits else None
+
+
+class ResourceBudget:
+    """
+    Cores and memory shared by all stages that run at the same time. A stage declares the Footprint of one of its
+    tasks and is allocated as many tasks as fit into the free part of the budget, so that a high core count cannot
+    multiply the memory of the workers beyond the memory of the node.
+    """
+    def __init__(self, cores=1, memory_mb=None):
+        """
+        :param cores: Number of cores, as general.threads
+        :param memory_mb: Memory in MB; None for no limit
+        """
+        self.cores = max(int(cores), 1)
+        self.memory_mb = memory_mb
+        self.free_cores = self.cores
+        self.free_memory_mb = memory_mb
+        self._lock = threading.Lock()
+
+    def _tasks_fitting(self, footprint: Footprint, cores, memory_mb):
+        limits = [self.cores if footprint.max_tasks is None else footprint.max_tasks]
+        if footprint.cores > 0:
+            limits.append(cores // footprint.cores)
+        if footprint.memory_mb > 0 and memory_mb is not None:
+            limits.append(int(memory_mb // footprint.memory_mb))
+        return max(min(limits), 0)
+
+    def _is_idle(self):
+        return self.free_cores == self.cores and self.free_memory_mb == self.memory_mb
+
+    def demand(self, footprint: Footprint):
+        """
+        :return: Number of cores a stage with this footprint would take from the idle budget
+        """
+        return footprint.cores * max(self._tasks_fitting(footprint, self.cores, self.memory_mb), 1)
+
+    def allocation(self, footprint: Footprint):
+        """
+        Allocation a stage with this footprint gets from the idle budget, without reserving it; used for stages that
+        run alone, e.g. in shard workers
+        :param footprint: Footprint of a single task of the stage
+        :return: Allocation
+        """
+        tasks = max(self._tasks_fitting(footprint, self.cores, self.memory_mb), 1)
+        memory_mb = tasks * footprint.memory_mb
+        if self.memory_mb is not None:
+            memory_mb = min(memory_mb, self.memory_mb)
+        return Allocation(tasks, min(tasks * footprint.cores, self.cores), memory_mb)
+
+    def try_allocate(self, footprint: Footprint):
+        """
+        Reserve as many tasks of a stage as fit into the free part of the budget. A stage whose single task does not
+        fit into the whole budget gets one task once nothing else is running.
+        :param footprint: Footprint of a single task of the stage
+        :return: Allocation, or None if not even one task fits until running stages release their allocations
+        """
+        with self._lock:
+            tasks = self._tasks_fitting(footprint, self.free_cores, self.free_memory_mb)
+            if tasks < 1:
+                if not self._is_idle():
+                    return None
+                logger.warning(f'A single task needing {footprint.cores} cores and {footprint.memory_mb} MB exceeds '
+                               f'the budget of {self.cores} cores and {self.memory_mb} MB; running it alone')
+                tasks = 1
+            cores = min(tasks * footprint.cores, self.free_cores)
+            memory_mb = tasks * footprint.memory_mb
+            if self.free_memory_mb is not None:
+                memory_mb = min(memory_mb, self.free_memory_mb)
+                self.free_memory_mb -= memory_mb
+            self.free_cores -= cores
+            return Allocation(tasks, cores, memory_mb)
+
+    def release(self, allocation: Allocation):
+        with self._lock:
+            self.free_cores += allocation.cores
+            if self.free_memory_mb is not None:
+                self.free_memory_mb += allocation.memory_mb
+
+
+def _run_step(step: FileStep, spectra_file):
+    """
+    Apply a step to a spectra file in this process, unit by unit if the step is split into chunks
+    """
+    if step.chunks is None:
+        step.func(spectra_file, *step.args)
+        return
+    for unit in step.chunks(spectra_file, *step.args):
+        step.func(unit, *step.args)
+    if step.assemble is not None:
+        step.assemble(spectra_file, *step.args)
+
+
+@report.step
+def run_per_file(spectra_files, steps: List[FileStep], num_workers=1):
+    """
+    Move every spectra file through all steps independently of the other files, so that e.g. one file is annotated
+    while the next one is still converting. Ready work of later steps is preferred, which finishes files early and
+    keeps the number of partially processed files small. Steps with chunks are split into units that all wait in the
+    same queue, so idle workers take over units of other files instead of waiting for the largest file to finish.
+    :param spectra_files: List of spectra files
+    :param steps: Steps to apply to every file, in order
+    :param num_workers: Maximum number of concurrent tasks of all steps together, i.e. of processes and threads
+    :return: None
+    """
+    if num_workers <= 1:
+        for spectra_file in spectra_files:
+            for step in steps:
+                logger.debug(f'{step.name}: {spectra_file}')
+                _run_step(step, spectra_file)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers) as processes, \
+            ThreadPoolExecutor(max_workers=num_workers) as threads:
+        executors = {'process': processes, 'thread': threads}
+        # tasks are (-step_index, file_index, unit_index, kind), kind being 'file' for a whole file, 'plan' for
+        # splitting a file into units, 'unit' for one of these units and 'assemble' for combining them
+        ready = []
+        in_flight = {}
+        units = {}
+        open_units = {}
+
+        def make_ready(file_index, step_index):
+            kind = 'file' if steps[step_index].chunks is None else 'plan'
+            heapq.heappush(ready, (-step_index, file_index, -1, kind))
+
+        def target(task):
+            priority, file_index, unit_index, kind = task
+            return units[(file_index, -priority)][unit_index] if kind == 'unit' else spectra_files[file_index]
+
+        def submit_ready():
+            # process and thread tasks share the allocation of the stage, so they are counted together
+            while ready and len(in_flight) < num_workers:
+                task = heapq.heappop(ready)
+                step = steps[-task[0]]
+                func = {'file': step.func, 'plan': step.chunks, 'unit': step.func, 'assemble': step.assemble}[task[3]]
+                future = executors[step.executor].submit(func, target(task), *step.args)
+                in_flight[future] = task
+
+        def finish_step(file_index, step_index):
+            if step_index + 1 < len(steps):
+                make_ready(file_index, step_index + 1)
+
+        def finish_units(file_index, step_index):
+            del units[(file_index, step_index)], open_units[(file_index, step_index)]
+            if steps[step_index].assemble is None:
+                finish_step(file_index, step_index)
+            else:
+                heapq.heappush(ready, (-step_index, file_index, 0, 'assemble'))
+
+        for file_index in range(len(spectra_files)):
+            make_ready(file_index, 0)
+        submit_ready()
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = in_flight.pop(future)
+                priority, file_index, unit_index, kind = task
+                step_index = -priority
+                step = steps[step_index]
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.error(f'{step.name} failed for {target(task)}')
+                    for other in in_flight:
+                        other.cancel()
+                    raise
+                logger.debug(f'{step.name} finished for {target(task)}')
+                key = (file_index, step_index)
+                if kind == 'plan':
+                    units[key] = list(result)
+                    open_units[key] = len(units[key])
+                    for i in range(len(units[key])):
+                        heapq.heappush(ready, (priority, file_index, i, 'unit'))
+                    if not units[key]:
+                        finish_units(file_index, step_index)
+                elif kind == 'unit':
+                    open_units[key] -= 1
+                    if open_units[key] == 0:
+                        finish_units(file_index, step_index)
+                else:
+                    finish_step(file_index, step_index)
+            submit_ready()
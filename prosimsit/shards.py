@@ -0,0 +1,159 @@
+import sys
+import json
+import logging
+import subprocess
+import dataclasses
+
+import pandas as pd
+
+from prosimsit.io import atomic_path
+from prosimsit.stages import Pipeline
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+SHARD_DIR = 'shards'
+
+
+def plan_shards(summary: pd.DataFrame, psm_counts: pd.Series, n_shards):
+    """
+    Split the raw files into shards of whole TMT batches, i.e. MaxQuant experiments, balanced by their number of PSMs.
+    The plan only depends on its inputs, so every worker that plans again gets the same shards.
+    :param summary: MaxQuant summary.txt with 'Raw file' and, optionally, 'Experiment' columns
+    :param psm_counts: Number of PSMs per raw file, indexed by raw file name
+    :param n_shards: Maximum number of shards; there are never more shards than TMT batches
+    :return: List of shards, each a dictionary with 'experiments', 'raw_files' and 'psms'
+    """
+    summary = summary[summary['Raw file'].isin(psm_counts.index)]
+    if 'Experiment' in summary.columns:
+        experiments = summary.set_index('Raw file')['Experiment'].astype(str)
+    else:
+        experiments = pd.Series(summary['Raw file'].to_numpy(), index=summary['Raw file'])
+    experiments = experiments.reindex(psm_counts.index).fillna(pd.Series(psm_counts.index, index=psm_counts.index))
+
+    batches = pd.DataFrame({'experiment': experiments, 'psms': psm_counts}).groupby('experiment')['psms'].sum()
+    n_shards = max(min(n_shards, len(batches)), 1)
+    shards = [{'experiments': [], 'raw_files': [], 'psms': 0} for _ in range(n_shards)]
+    # longest processing time first: the largest remaining batch goes to the currently smallest shard
+    for experiment, psms in sorted(batches.items(), key=lambda batch: (-batch[1], batch[0])):
+        shard = min(shards, key=lambda s: s['psms'])
+        shard['experiments'].append(experiment)
+        shard['psms'] += int(psms)
+    for shard in shards:
+        shard['experiments'].sort()
+        shard['raw_files'] = sorted(experiments.index[experiments.isin(shard['experiments'])])
+    return shards
+
+
+def plan_path(pipeline: Pipeline, stage_name):
+    return pipeline.state_dir.parent / SHARD_DIR / f'{stage_name}.json'
+
+
+def prepare_shards(pipeline: Pipeline, stage_name, maxquant_tables, n_shards):
+    """
+    Do the global work of a stage that has to precede its shard workers and write the shard plan
+    :param pipeline: Pipeline containing the stage
+    :param stage_name: Name of a stage with prepare_shards and run_shard
+    :param maxquant_tables: MaxQuantTables of the MaxQuant search
+    :param n_shards: Maximum number of shards
+    :return: Path to the shard plan
+    """
+    stage = _shardable_stage(pipeline, stage_name)
+    not_done = [name for name in stage.depends_on if not pipeline.is_up_to_date(pipeline.stages[name])]
+    if not_done:
+        raise RuntimeError(f'Stage {stage_name} cannot be sharded before {", ".join(not_done)} finished; '
+                           f'run ProSIMSIt with --until-stage {not_done[-1]} first')
+
+    psm_counts = maxquant_tables.read('msms', columns=['Raw file'])['Raw file'].value_counts()
+    shards = plan_shards(maxquant_tables.read('summary'), psm_counts, n_shards)
+    pipeline.start_stage(stage)
+    with pipeline.report.stage(f'{stage_name}.prepare_shards'):
+        stage.prepare_shards()
+    pipeline.digests.save()
+
+    path = plan_path(pipeline, stage_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump({'stage': stage_name, 'shards': shards}, f, indent=4)
+    logger.info(f'Planned {len(shards)} shards for stage {stage_name} in {path}')
+    return path
+
+
+def run_shard(pipeline: Pipeline, stage_name, shard_index):
+    """
+    Run the per-raw-file work of a stage for the raw files of one shard. Results are written to the shared output
+    folder; the stage itself skips them when it runs on all raw files afterwards.
+    :param pipeline: Pipeline containing the stage
+    :param stage_name: Name of a stage with prepare_shards and run_shard
+    :param shard_index: Index of the shard in the plan written by prepare_shards()
+    :return: None
+    """
+    stage = _shardable_stage(pipeline, stage_name)
+    path = plan_path(pipeline, stage_name)
+    if not path.is_file():
+        raise FileNotFoundError(f'No shard plan found at {path}; run ProSIMSIt with --plan-shards first')
+    with open(path, 'r') as f:
+        shards = json.load(f)['shards']
+    if not 0 <= shard_index < len(shards):
+        raise ValueError(f'Shard {shard_index} does not exist; the plan in {path} has {len(shards)} shards')
+
+    shard = shards[shard_index]
+    # a shard worker is the only stage running in its process
+    allocation = pipeline.resources.allocation(stage.footprint)
+    logger.info(f'Running shard {shard_index} of stage {stage_name} with {len(shard["raw_files"])} raw files of '
+                f'{", ".join(shard["experiments"])} and {allocation.tasks} tasks')
+    with pipeline.report.stage(f'{stage_name}.shard_{shard_index}', allocation=dataclasses.asdict(allocation)):
+        stage.run_shard(shard['raw_files'], allocation)
+
+
+def _shardable_stage(pipeline: Pipeline, stage_name):
+    if stage_name not in pipeline.stages:
+        raise ValueError(f'Unknown stage: {stage_name}')
+    stage = pipeline.stages[stage_name]
+    if stage_name not in shardable_stages(pipeline):
+        raise ValueError(f'Stage {stage_name} cannot be sharded. '
+                         f'Shardable stages: {", ".join(shardable_stages(pipeline))}')
+    return stage
+
+
+def shardable_stages(pipeline: Pipeline):
+    """
+    :return: Names of all stages with per-raw-file work that can be sharded, in workflow order
+    """
+    return [stage.name for stage in pipeline.order() if stage.prepare_shards is not None and stage.run_shard is not None]
+
+
+def launch_local(pipeline: Pipeline, config_path, n_shards, command=None):
+    """
+    Run the whole workflow with the per-raw-file work of each shardable stage split into shards that run as parallel
+    processes on this machine. This is the order of commands a cluster scheduler has to follow: run the global stages
+    up to the shardable stage, plan and prepare its shards, run all shard workers, continue with the next stage.
+    :param pipeline: Pipeline of the run
+    :param config_path: Path to the config.toml of the run
+    :param n_shards: Maximum number of shards per stage
+    :param command: Command line building the same pipeline, to which the stage and shard options are appended;
+        None for python -m prosimsit -c <config_path>
+    :return: None
+    """
+    if command is None:
+        command = [sys.executable, '-m', 'prosimsit', '-c', str(config_path)]
+    names = [stage.name for stage in pipeline.order()]
+    for stage_name in shardable_stages(pipeline):
+        previous = names.index(stage_name) - 1
+        if previous >= 0:
+            _run_commands([command + ['--until-stage', names[previous]]])
+        _run_commands([command + ['--plan-shards', str(n_shards), '--shard-stage', stage_name]])
+        with open(plan_path(pipeline, stage_name), 'r') as f:
+            planned = len(json.load(f)['shards'])
+        _run_commands([command + ['--shard', str(i), '--shard-stage', stage_name] for i in range(planned)])
+    _run_commands([command])
+
+
+def _run_commands(commands):
+    processes = []
+    for command in commands:
+        logger.info(f'Launching {" ".join(command)}')
+        processes.append(subprocess.Popen(command))
+    failed = [' '.join(command) for command, process in zip(commands, processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f'Failed: {"; ".join(failed)}')
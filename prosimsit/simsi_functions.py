@@ -1,55 +1,206 @@
 import shutil
 import logging
+import collections
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 
 from simsi_transfer import maxquant as mq
 from simsi_transfer import simsi_output
 from simsi_transfer import evidence
 
+from prosimsit.io import read_table, write_table
+from prosimsit.staging import stage_files
+import prosimsit.report as report
+
 logger = logging.getLogger(__package__ + "." + __file__)
 
-def prepare_simsi_files(maxquant_folder, output_folder):
+# MaxQuant tables SIMSI-Transfer reads unchanged
+SIMSI_INPUT_FILES = ['msmsScans.txt', 'allPeptides.txt', 'evidence.txt']
+# folders of the SIMSI-Transfer cache folder holding results per raw file, which SIMSI-Transfer does not compute again
+SIMSI_CACHE_DIRS = ['mzML', 'dat_files', 'extracted']
+# columns SIMSI-Transfer sorts the precursors of evidence.txt by to number them, see _evidence_ids()
+EVIDENCE_ORDER = ['Sequence', 'Modified sequence', 'Raw file', 'Calibrated retention time start']
+# columns SIMSI-Transfer matches PSMs to the precursors of evidence.txt on
+PRECURSOR_KEYS = ['Modified sequence', 'Raw file', 'Charge']
+# columns the evidence built by SIMSI-Transfer is sorted by
+EVIDENCE_SORT = ['Sequence', 'Modified sequence', 'Raw file', 'Charge']
+
+
+def refresh_simsi_output(output_folder: Path):
+    """
+    Remove all results of a previous SIMSI-Transfer run except for the per-raw-file results in its cache folder, so
+    that a run on added raw files only converts and extracts the reporter ions of the new raw files. Clustering and
+    the transfers are computed again for all raw files.
+    :param output_folder: SIMSI-Transfer output folder, also used as its cache folder
+    :return: None
+    """
+    for path in Path(output_folder).iterdir():
+        if path.name in SIMSI_CACHE_DIRS:
+            continue
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+
+@report.step
+def prepare_simsi_files(maxquant_folder, output_folder, threads=1, staging='auto'):
     """
-    Prepare the SIMSI input files by copying the necessary files from the MaxQuant output folder
+    Prepare the SIMSI input files by staging the necessary files from the MaxQuant output folder; SIMSI-Transfer only
+    reads them, so they are linked instead of copied where the filesystem allows it
     :param maxquant_folder: Directory containing MaxQuant output files
     :param output_folder: Directory where the SIMSI input files will be stored
+    :param threads: Number of files to stage concurrently
+    :param staging: Staging method, see staging.stage_file
     :return: None
     """
-    if (output_folder / 'simsi_input' / 'msmsScans.txt').is_file():
-        logger.info('msmsScans.txt already exists, reusing it')
-    else:
-        shutil.copy(maxquant_folder / 'msmsScans.txt', output_folder / 'simsi_input' / 'msmsScans.txt')
+    stage_files([maxquant_folder / f for f in SIMSI_INPUT_FILES], output_folder / 'simsi_input', staging, threads)
+
+
+def _evidence_ids(evidence_keys: pd.DataFrame):
+    """
+    :param evidence_keys: Columns EVIDENCE_ORDER and Type of the MaxQuant evidence.txt
+    :return: Numpy array with the evidence_ID SIMSI-Transfer assigns to every row of evidence.txt when it builds the
+        evidence of all raw files at once, -1 for MSMS rows, see simsi_transfer.evidence.build_evidence
+    """
+    ids = np.full(len(evidence_keys), -1, dtype=np.int64)
+    precursors = evidence_keys.reset_index(drop=True)
+    precursors = precursors[precursors['Type'] != 'MSMS'].sort_values(by=EVIDENCE_ORDER)
+    ids[precursors.index.to_numpy()] = np.arange(len(precursors))
+    return ids
+
+
+def _evidence_partitions(msms_simsi: pd.DataFrame, evidence_keys: pd.DataFrame, maxquant_tables):
+    """
+    Group the raw files by experiment and fraction. SIMSI-Transfer numbers the PSMs without precursor after the
+    largest evidence_ID of their PSMs with precursor, so raw files without any PSM matching a precursor are added to
+    the next partition that has one.
+    :return: Dictionary mapping every raw file to the number of its partition
+    """
+    summary = maxquant_tables.read('summary')
+    experiments = summary['Experiment'] if 'Experiment' in summary.columns else summary['Raw file']
+    fractions = summary['Fraction'] if 'Fraction' in summary.columns else pd.Series(1, index=summary.index)
+    keys = dict(zip(summary['Raw file'], zip(experiments.astype(str), fractions.astype(str))))
+    raw_files = sorted(msms_simsi['Raw file'].unique())
+    groups = collections.defaultdict(list)
+    for raw_file in raw_files:
+        groups[keys.get(raw_file, (str(raw_file), ''))].append(raw_file)
+
+    matched = set(pd.merge(msms_simsi[PRECURSOR_KEYS].drop_duplicates(),
+                           evidence_keys.loc[evidence_keys['Type'] != 'MSMS', PRECURSOR_KEYS].drop_duplicates(),
+                           on=PRECURSOR_KEYS)['Raw file'])
+    partitions, pending = [], []
+    for key in sorted(groups):
+        pending += groups[key]
+        if matched.intersection(groups[key]):
+            partitions.append(pending)
+            pending = []
+    if pending:
+        if partitions:
+            partitions[-1] += pending
+        else:
+            partitions.append(pending)
+    return {raw_file: i for i, partition in enumerate(partitions) for raw_file in partition}
+
+
+def _build_partial_evidence(msms_simsi: pd.DataFrame, raw_files, evidence_ids, maxquant_tables, plex):
+    """
+    Build the evidence of some raw files with SIMSI-Transfer, reading only their rows of evidence.txt and
+    allPeptides.txt
+    :param msms_simsi: Merged PSMs of the raw files
+    :param raw_files: List of raw files
+    :param evidence_ids: evidence_ID of every row of these raw files in evidence.txt, see _evidence_ids()
+    :param maxquant_tables: MaxQuantTables of the MaxQuant search
+    :param plex: Number of TMT channels
+    :return: Tuple of the evidence and a boolean numpy array marking the evidence of PSMs without precursor, whose
+        evidence_ID is only unique within these raw files
+    """
+    evidence_mq = maxquant_tables.read('evidence', raw_files=raw_files)
+    allpeptides_mq = maxquant_tables.read('allPeptides', raw_files=raw_files)
+    # same as simsi_transfer.evidence.build_evidence, but with the evidence_ID of the whole evidence.txt
+    evidence_mq['evidence_ID'] = evidence_ids
+    evidence_mq = evidence_mq[evidence_mq['Type'] != 'MSMS'].sort_values(by=EVIDENCE_ORDER)
+    summary = evidence.assign_evidence_feature(msms_simsi, evidence_mq, allpeptides_mq)
+    evidence_simsi = evidence.calculate_evidence_columns(summary, plex)
+    # PSMs without precursor are those whose precursor key is not in evidence.txt
+    precursors = pd.MultiIndex.from_frame(evidence_mq[PRECURSOR_KEYS])
+    return evidence_simsi, ~pd.MultiIndex.from_frame(evidence_simsi[PRECURSOR_KEYS]).isin(precursors)
 
-    if (output_folder / 'simsi_input' / 'allPeptides.txt').is_file():
-        logger.info('allPeptides.txt already exists, reusing it')
-    else:
-        shutil.copy(maxquant_folder / 'allPeptides.txt', output_folder / 'simsi_input' / 'allPeptides.txt')
-    if (output_folder / 'simsi_input' / 'evidence.txt').is_file():
-        logger.info('evidence.txt already exists, reusing it')
-    else:
-        shutil.copy(maxquant_folder / 'evidence.txt', output_folder / 'simsi_input' / 'evidence.txt')
+
+def _check_unique_summary_ids(msms_simsi: pd.DataFrame):
+    """
+    build_evidence() numbers the PSMs without precursor in the order of their summary_ID in the merged msms.txt, so
+    every PSM needs its own summary_ID; SIMSI-Transfer only checks this within the raw files of one partition
+    :param msms_simsi: Merged PSMs of all raw files
+    :return: None
+    :raise ValueError: If PSMs share a summary_ID
+    """
+    summary_ids = msms_simsi['summary_ID'].astype(str)
+    duplicated = summary_ids[summary_ids.duplicated()]
+    if len(duplicated) > 0:
+        raise ValueError(f'{duplicated.nunique()} summary_IDs occur in more than one PSM of the merged msms.txt, e.g. '
+                         f'{duplicated.iloc[0]}; every PSM needs its own summary_ID to build the evidence')
 
 
-def build_evidence(path_to_merged_msms, mq_txt_folder, output_folder):
+@report.step
+def build_evidence(path_to_merged_msms, maxquant_tables, output_folder, threads=1):
     """
-    Build the evidence.txt file from the second Oktoberfest results
+    Build the evidence.txt file from the second Oktoberfest results. The raw files are partitioned by experiment and
+    fraction and the evidence of each partition is built in its own worker process; the result is identical to
+    building the evidence of all raw files at once.
     :param path_to_merged_msms: Path to the merged msms.txt file containing the results from the second Oktoberfest run
-    :param mq_txt_folder: Path to the MaxQuant output folder
+    :param maxquant_tables: MaxQuantTables of the MaxQuant search
     :param output_folder: Path to the output folder where the evidence.txt file will be stored
+    :param threads: Number of partitions to process in parallel
     :return: None
     """
-    if (output_folder / 'evidence.txt').is_file():
-        logger.info('evidence.txt already exists, reusing it')
-        return
-    mq_txt_folders = [mq_txt_folder]
-    msms_simsi = pd.read_csv(path_to_merged_msms, sep='\t')
+    msms_simsi = read_table(path_to_merged_msms)
     logger.info(f'successfully read msms_simsi')
+    _check_unique_summary_ids(msms_simsi)
+
+    evidence_keys = maxquant_tables.read('evidence', columns=EVIDENCE_ORDER + ['Charge', 'Type'])
+    # builds the columnar cache of allPeptides.txt before the workers read their part of it
+    maxquant_tables.columns('allPeptides')
+    plex = mq.get_plex([maxquant_tables.txt_dir])
+
+    partition_of_raw_file = _evidence_partitions(msms_simsi, evidence_keys, maxquant_tables)
+    evidence_ids = _evidence_ids(evidence_keys)
+    msms_rows = msms_simsi.groupby(msms_simsi['Raw file'].map(partition_of_raw_file)).indices
+    evidence_rows = evidence_keys.groupby(evidence_keys['Raw file'].map(partition_of_raw_file)).indices
+    n_partitions = len(set(partition_of_raw_file.values()))
+    tasks = [(msms_simsi.iloc[msms_rows[i]],
+              sorted(raw_file for raw_file, partition in partition_of_raw_file.items() if partition == i),
+              evidence_ids[evidence_rows.get(i, [])], maxquant_tables, plex) for i in range(n_partitions)]
+    del evidence_keys
+
+    logger.info(f'Starting SIMSI-Transfer evidence.txt building for {n_partitions} partitions of raw files')
+    if threads > 1 and n_partitions > 1:
+        with ProcessPoolExecutor(max_workers=min(threads, n_partitions)) as executor:
+            futures = [executor.submit(_build_partial_evidence, *task) for task in tasks]
+            results = [future.result() for future in futures]
+    else:
+        results = [_build_partial_evidence(*task) for task in tasks]
 
-    evidence_mq = mq.read_evidence_txt(mq_txt_folder)
-    allpeptides_mq = mq.read_allpeptides_txt(mq_txt_folder)
-    plex = mq.get_plex(mq_txt_folders)
+    evidence_simsi = pd.concat([partial for partial, _ in results])
+    filled = np.concatenate([partial_filled for _, partial_filled in results])
+    ids = evidence_simsi['id'].to_numpy().copy()
+    if filled.any():
+        # the PSMs without precursor are numbered after all precursors, in the order of the PSMs
+        positions = pd.Series(np.arange(len(msms_simsi)), index=msms_simsi['summary_ID'].astype(str))
+        filled_positions = positions.reindex(evidence_simsi['summary_ID'].to_numpy()[filled])
+        if filled_positions.isna().any():
+            # each of these evidence rows stems from a single PSM, so it holds exactly one summary_ID of msms_simsi
+            raise ValueError(f'Evidence of PSMs without precursor has summary_IDs that are not those of a single PSM, '
+                             f'e.g. {filled_positions.index[filled_positions.isna()][0]}')
+        filled_rows = np.flatnonzero(filled)[np.argsort(filled_positions.to_numpy(), kind='stable')]
+        ids[filled_rows] = ids[~filled].max(initial=-1) + 1 + np.arange(len(filled_rows))
+    evidence_simsi['id'] = ids
+    evidence_simsi.index = pd.Index(ids, name='evidence_ID')
+    evidence_simsi = evidence_simsi.sort_index(kind='stable').sort_values(by=EVIDENCE_SORT, kind='stable')
 
-    logger.info(f'Starting SIMSI-Transfer evidence.txt building')
-    evidence_simsi = evidence.build_evidence(msms_simsi, evidence_mq, allpeptides_mq, plex)
-    evidence_simsi.to_csv(output_folder / 'evidence.txt', sep='\t', index=False, na_rep='NaN')
\ No newline at end of file
+    # Picked Protein Group FDR only reads tab-separated evidence files
+    write_table(evidence_simsi, output_folder / 'evidence.txt', schema={}, na_rep='NaN')
+    report.record_rows('evidence.txt written', len(evidence_simsi))
@@ -0,0 +1,235 @@
+import os
+import json
+import shutil
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+
+from prosimsit.io import read_table, write_table
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+STORE_VERSION = 1
+HEADER_FILE = 'store.json'
+SCANS_FILE = 'scans.feather'
+MZ_FILE = 'mz.bin'
+INTENSITY_FILE = 'intensity.bin'
+OFFSETS_FILE = 'offsets.npy'
+# columns of the spectra table returned by Oktoberfest's load_spectra that hold one value per spectrum
+SCAN_COLUMNS = ['SCAN_NUMBER', 'MZ_RANGE', 'RETENTION_TIME', 'MASS_ANALYZER', 'FRAGMENTATION', 'COLLISION_ENERGY',
+                'INSTRUMENT_TYPES']
+# a chunk file <stem>.chunk_<number>.mzML stands for a part of the PSMs of <stem>.mzML and reads its spectra from the
+# spectrum store of <stem>.mzML
+CHUNK_INFIX = '.chunk_'
+
+
+def store_path(store_dir: Path, mzml_file: Path):
+    """
+    :param store_dir: Directory containing the spectrum stores of all spectra files
+    :param mzml_file: Path to an mzML file
+    :return: Directory of the spectrum store of the mzML file
+    """
+    return Path(store_dir) / Path(mzml_file).stem
+
+
+def chunk_file(spectra_file: Path, number):
+    """
+    :param spectra_file: Path to an mzML file
+    :param number: Number of the chunk
+    :return: Path of the chunk file standing for a part of the PSMs of the mzML file; the file itself does not exist
+    """
+    spectra_file = Path(spectra_file)
+    return spectra_file.with_name(f'{spectra_file.stem}{CHUNK_INFIX}{number:04d}{spectra_file.suffix}')
+
+
+def chunk_source(spectra_file: Path):
+    """
+    :param spectra_file: Path to an mzML file or a chunk file
+    :return: Path to the mzML file a chunk file was derived from by chunk_file(); other files are returned as is
+    """
+    spectra_file = Path(spectra_file)
+    stem, infix, number = spectra_file.stem.rpartition(CHUNK_INFIX)
+    if not infix or not number.isdigit():
+        return spectra_file
+    return spectra_file.with_name(stem + spectra_file.suffix)
+
+
+def _source_record(mzml_file: Path):
+    stat = mzml_file.stat()
+    return {'source': str(mzml_file.resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_up_to_date(mzml_file: Path, path: Path):
+    """
+    :param mzml_file: Path to an mzML file
+    :param path: Directory of its spectrum store
+    :return: True if the store was built from the current version of the mzML file
+    """
+    header_path = path / HEADER_FILE
+    if not header_path.is_file() or not mzml_file.is_file():
+        return False
+    with open(header_path, 'r') as f:
+        header = json.load(f)
+    return header.get('version') == STORE_VERSION and header.get('mzml') == _source_record(mzml_file)
+
+
+def read_mzml(mzml_file: Path):
+    """
+    Decode the MS2 spectra of an mzML file exactly as Oktoberfest does
+    :param mzml_file: Path to an mzML file
+    :return: DataFrame with the MZML_DATA_COLUMNS of spectrum_fundamentals
+    """
+    from spectrum_io.raw import ThermoRaw
+
+    return ThermoRaw.read_mzml(source=mzml_file, package='pyteomics')
+
+
+def build_store(mzml_file: Path, store_dir: Path):
+    """
+    Decode an mzML file once and write its MS2 spectra to a binary spectrum store: the peaks of all spectra are
+    concatenated into an m/z and an intensity array that are memory-mapped when reading, an offsets array indexes the
+    peaks of each spectrum and a table holds the scan number and precursor metadata of each spectrum. The store appears
+    atomically; an up-to-date store is not built again.
+    :param mzml_file: Path to an mzML file
+    :param store_dir: Directory containing the spectrum stores of all spectra files
+    :return: Directory of the spectrum store
+    """
+    mzml_file = Path(mzml_file)
+    path = store_path(store_dir, mzml_file)
+    if is_up_to_date(mzml_file, path):
+        logger.debug(f'Found up to date spectrum store of {mzml_file} at {path}, skipping decoding')
+        return path
+
+    logger.info(f'Building spectrum store of {mzml_file}')
+    spectra = read_mzml(mzml_file).sort_values('SCAN_NUMBER', kind='stable')
+    building = path.with_name(f'.{path.name}.{os.getpid()}.building')
+    if building.exists():
+        shutil.rmtree(building)
+    building.mkdir(parents=True)
+    try:
+        lengths = np.fromiter((len(mz) for mz in spectra['MZ']), dtype=np.int64, count=len(spectra))
+        offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(building / OFFSETS_FILE, offsets)
+        dtypes = {}
+        for column, file_name in [('MZ', MZ_FILE), ('INTENSITIES', INTENSITY_FILE)]:
+            peaks = np.concatenate(spectra[column].tolist()) if len(spectra) else np.empty(0)
+            dtypes[column] = peaks.dtype.str
+            peaks.tofile(building / file_name)
+
+        scans = spectra[SCAN_COLUMNS].reset_index(drop=True)
+        scans['SCAN_NUMBER'] = scans['SCAN_NUMBER'].astype('int64')
+        write_table(scans, building / SCANS_FILE)
+        header = {'version': STORE_VERSION, 'mzml': _source_record(mzml_file), 'raw_file': mzml_file.stem,
+                  'n_spectra': len(spectra), 'n_peaks': int(offsets[-1]), 'dtypes': dtypes}
+        with open(building / HEADER_FILE, 'w') as f:
+            json.dump(header, f, indent=4)
+
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(building, path)
+    finally:
+        if building.exists():
+            shutil.rmtree(building)
+    return path
+
+
+def build_for_spectra_file(mzml_file: Path, store_dir: Path):
+    """
+    Build the spectrum store of a spectra file; used as per-file step of the first Oktoberfest run, right after the
+    conversion of the raw file
+    :param mzml_file: Path to an mzML file
+    :param store_dir: Directory containing the spectrum stores of all spectra files
+    :return: None
+    """
+    build_store(mzml_file, store_dir)
+
+
+class SpectrumStore:
+    """
+    Read-only view of a spectrum store written by build_store(). Peaks are memory-mapped, so opening a store does not
+    read them and processes reading the same store share its pages in the page cache.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path / HEADER_FILE, 'r') as f:
+            self.header = json.load(f)
+        self.scans = read_table(self.path / SCANS_FILE)
+        self.offsets = np.load(self.path / OFFSETS_FILE)
+        self.mz = self._map(MZ_FILE, self.header['dtypes']['MZ'])
+        self.intensities = self._map(INTENSITY_FILE, self.header['dtypes']['INTENSITIES'])
+        self._scan_numbers = self.scans['SCAN_NUMBER'].to_numpy()
+
+    def _map(self, file_name, dtype):
+        if self.header['n_peaks'] == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.path / file_name, dtype=dtype, mode='r', shape=(self.header['n_peaks'],))
+
+    def __len__(self):
+        return self.header['n_spectra']
+
+    def _peaks(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.mz[start:end], self.intensities[start:end]
+
+    def spectrum(self, scan_number):
+        """
+        :param scan_number: Scan number of an MS2 spectrum
+        :return: Tuple of the m/z and intensity arrays of the spectrum, both views of the memory-mapped peaks
+        :raise KeyError: If the store has no spectrum with this scan number
+        """
+        index = int(np.searchsorted(self._scan_numbers, scan_number))
+        if index == len(self._scan_numbers) or self._scan_numbers[index] != scan_number:
+            raise KeyError(f'Scan {scan_number} not found in {self.path}')
+        return self._peaks(index)
+
+    def to_dataframe(self):
+        """
+        :return: DataFrame in the format of Oktoberfest's load_spectra, whose peak arrays are views of the
+            memory-mapped peaks
+        """
+        from spectrum_fundamentals.constants import MZML_DATA_COLUMNS
+
+        spectra = self.scans.copy()
+        spectra['RAW_FILE'] = self.header['raw_file']
+        peaks = [self._peaks(i) for i in range(len(self))]
+        spectra['MZ'] = [mz for mz, _ in peaks]
+        spectra['INTENSITIES'] = [intensities for _, intensities in peaks]
+        # an unnamed index like read_mzml's; an index named SCAN_NUMBER makes merges on that column ambiguous
+        spectra.index = (self.header['raw_file'] + '_' + spectra['SCAN_NUMBER'].astype(str)).to_numpy()
+        return spectra[MZML_DATA_COLUMNS]
+
+
+@contextmanager
+def spectra_from_store(store_dir: Path = None):
+    """
+    Make Oktoberfest read mzML files from their spectrum stores within this context instead of decoding them again.
+    Chunk files read the spectrum store of the mzML file they were derived from, see chunk_file(). mzML files without
+    an up-to-date store are decoded as before.
+    :param store_dir: Directory containing the spectrum stores of all spectra files; None to always decode mzML files
+    :return: None
+    """
+    if store_dir is None:
+        yield
+        return
+
+    from oktoberfest import preprocessing as pp
+
+    original = pp.load_spectra
+
+    def load_spectra(filenames, *args, **kwargs):
+        if isinstance(filenames, (str, Path)) and Path(filenames).suffix.lower() == '.mzml':
+            mzml_file = chunk_source(filenames)
+            path = store_path(store_dir, mzml_file)
+            if is_up_to_date(mzml_file, path):
+                logger.info(f'Reading spectra of {filenames} from spectrum store {path}')
+                return SpectrumStore(path).to_dataframe()
+        return original(filenames, *args, **kwargs)
+
+    pp.load_spectra = load_spectra
+    try:
+        yield
+    finally:
+        pp.load_spectra = original
@@ -0,0 +1,345 @@
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import dataclasses
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from prosimsit.io import atomic_path
+from prosimsit.report import RunReport
+from prosimsit.scheduler import Allocation, Footprint, ResourceBudget
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+STATE_DIR = '.prosimsit'
+HASH_BLOCK_SIZE = 1 << 20
+
+
+@dataclass
+class Stage:
+    """
+    A single step of the ProSIMSIt workflow.
+    :param name: Unique name of the stage; used for --from-stage/--until-stage and the checkpoint record
+    :param run: Callable executing the stage with the Allocation it was granted; it must not run more than
+        allocation.tasks tasks in parallel
+    :param inputs: Files or directories the stage reads; their content hashes are part of the fingerprint
+    :param outputs: Files or directories the stage produces; verified by content hash before the stage is skipped
+    :param config: Slice of the configuration the results of this stage depend on
+    :param depends_on: Names of stages that have to run before this stage
+    :param workdir: Directory owned by the stage; removed if the stage is rerun because of changed inputs or config
+    :param refresh: Callable without arguments updating the results of a previous execution in the workdir to changed
+        inputs instead of removing them: it removes only the results that depend on what changed, so that run redoes
+        only that work. Used with --add-batches; None if the stage always starts from scratch.
+    :param prepare_shards: Callable without arguments doing the global work that has to finish before run_shard can be
+        called for any shard; None if the stage cannot be sharded
+    :param run_shard: Callable running the per-raw-file work of the stage for the given list of raw files only, with
+        the given Allocation. run has to skip the work of raw files that were already processed this way.
+    :param footprint: Estimated resource usage of a single task of the stage, see scheduler.Footprint
+    """
+    name: str
+    run: Callable[[Allocation], None]
+    inputs: List[Path] = field(default_factory=list)
+    outputs: List[Path] = field(default_factory=list)
+    config: Dict = field(default_factory=dict)
+    depends_on: List[str] = field(default_factory=list)
+    workdir: Optional[Path] = None
+    refresh: Optional[Callable[[], None]] = None
+    prepare_shards: Optional[Callable[[], None]] = None
+    run_shard: Optional[Callable[[List[str], Allocation], None]] = None
+    footprint: Footprint = field(default_factory=Footprint)
+
+
+def config_slice(config, *keys):
+    """
+    Extract the part of the configuration a stage depends on.
+    :param config: Dictionary of all config parameters generated from config.toml
+    :param keys: Dotted keys, e.g. 'simsi' for a whole section or 'general.tmt_ms_level' for a single value
+    :return: Dictionary mapping each key to its value; missing keys map to None
+    """
+    config_part = {}
+    for key in keys:
+        value = config
+        for part in key.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        config_part[key] = value
+    return config_part
+
+
+class DigestCache:
+    """
+    Content hashes of files, memoized by path, size and modification time so that unchanged multi-GB inputs are only
+    hashed once across runs. Hardlinks of a hashed file, e.g. staged inputs, share its entry through the inode.
+    """
+    def __init__(self, cache_file: Path):
+        self.cache_file = cache_file
+        self.entries = {}
+        # stages running concurrently share the cache
+        self._lock = threading.Lock()
+        if cache_file.is_file():
+            with open(cache_file, 'r') as f:
+                self.entries = json.load(f)
+        self._by_inode = {tuple(entry['inode']): entry for entry in self.entries.values() if 'inode' in entry}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def file_digest(self, path: Path):
+        stat = path.stat()
+        key = str(path.resolve())
+        inode = (stat.st_dev, stat.st_ino)
+        for entry in (self.entries.get(key), self._by_inode.get(inode)):
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                return entry['sha256']
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                sha.update(block)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha.hexdigest(), 'inode': list(inode)}
+        with self._lock:
+            self.entries[key] = entry
+            self._by_inode[inode] = entry
+        return entry['sha256']
+
+    def digest(self, path: Path):
+        """
+        Content hash of a file or, for directories, of all files below it including their relative names.
+        :param path: Path to a file or directory
+        :return: Hex digest or None if the path does not exist
+        """
+        path = Path(path)
+        if path.is_file():
+            return self.file_digest(path)
+        if not path.is_dir():
+            return None
+        sha = hashlib.sha256()
+        for member in sorted(p for p in path.rglob('*') if p.is_file()):
+            sha.update(str(member.relative_to(path)).encode())
+            sha.update(self.file_digest(member).encode())
+        return sha.hexdigest()
+
+    def save(self):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            with atomic_path(self.cache_file) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.entries, f)
+
+
+class Pipeline:
+    """
+    Stage DAG with content-addressed checkpoints. A stage is skipped only if its inputs, config slice and outputs
+    still match the fingerprints recorded after its last successful execution. Stages whose dependencies are done run
+    concurrently as long as their allocations fit into the resource budget. The resource usage of every executed
+    stage is recorded in the run report.
+    In incremental mode, stages with a refresh callable update the results of their previous execution to changed
+    inputs, e.g. raw files added to the MaxQuant search, instead of starting from scratch.
+    """
+    def __init__(self, output_dir: Path, report: RunReport = None, resources: ResourceBudget = None,
+                 incremental=False):
+        self.state_dir = output_dir / STATE_DIR
+        self.incremental = incremental
+        self.stages: Dict[str, Stage] = {}
+        self.digests = DigestCache(self.state_dir / 'digests.json')
+        self.report = report if report is not None else RunReport()
+        self.resources = resources if resources is not None else ResourceBudget()
+
+    def add(self, stage: Stage):
+        if stage.name in self.stages:
+            raise ValueError(f'Stage {stage.name} is defined twice')
+        self.stages[stage.name] = stage
+
+    def order(self):
+        """
+        :return: Stages in topological order, keeping the insertion order among independent stages
+        """
+        ordered, done, visiting = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f'Cyclic stage dependency involving {name}')
+            if name not in self.stages:
+                raise ValueError(f'Unknown stage dependency: {name}')
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            visiting.remove(name)
+            done.add(name)
+            ordered.append(self.stages[name])
+
+        for stage_name in self.stages:
+            visit(stage_name)
+        return ordered
+
+    def fingerprint(self, stage: Stage):
+        inputs = {str(p): self.digests.digest(p) for p in stage.inputs}
+        payload = json.dumps({'inputs': inputs, 'config': stage.config}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def config_digest(stage: Stage):
+        return hashlib.sha256(json.dumps(stage.config, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _record_path(self, stage: Stage):
+        return self.state_dir / 'stages' / f'{stage.name}.json'
+
+    def _read_record(self, stage: Stage):
+        record_path = self._record_path(stage)
+        if not record_path.is_file():
+            return None
+        with open(record_path, 'r') as f:
+            return json.load(f)
+
+    def _write_record(self, stage: Stage, record):
+        record_path = self._record_path(stage)
+        record_path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_path(record_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f, indent=4)
+
+    def is_up_to_date(self, stage: Stage, fingerprint=None):
+        record = self._read_record(stage)
+        if record is None or record['status'] != 'done':
+            return False
+        if fingerprint is not None and record['fingerprint'] != fingerprint:
+            return False
+        return all(self.digests.digest(p) == d for p, d in record['outputs'].items())
+
+    def start_stage(self, stage: Stage, fingerprint=None, force=False):
+        """
+        Remove the results of a previous execution of the stage with other inputs or config and record the stage as
+        running with the current fingerprint. Results written to the workdir from then on, e.g. by shard workers, are
+        kept when the stage is run. In incremental mode, results of a previous execution with the same config are
+        refreshed instead, see Stage.refresh.
+        :param stage: Stage to start
+        :param fingerprint: Fingerprint of the stage; computed if None
+        :param force: Remove the workdir even if the fingerprint did not change
+        :return: None
+        """
+        fingerprint = self.fingerprint(stage) if fingerprint is None else fingerprint
+        config_digest = self.config_digest(stage)
+        record = self._read_record(stage)
+        if stage.workdir is not None and stage.workdir.exists() and (
+                force or (record is not None and record['fingerprint'] != fingerprint)):
+            if not force and self._can_refresh(stage, record, config_digest):
+                logger.info(f'Updating previous results of stage {stage.name} in {stage.workdir} to changed inputs')
+                stage.refresh()
+            else:
+                logger.info(f'Removing previous results of stage {stage.name} in {stage.workdir}')
+                shutil.rmtree(stage.workdir)
+        # the new fingerprint is only recorded once the refresh is complete, so that an interrupted refresh is repeated
+        self._write_record(stage, {'status': 'running', 'fingerprint': fingerprint, 'config': config_digest,
+                                   'outputs': {}})
+
+    def _can_refresh(self, stage: Stage, record, config_digest):
+        if not self.incremental or stage.refresh is None:
+            return False
+        if record.get('config') != config_digest:
+            logger.info(f'Config of stage {stage.name} changed; it cannot be updated incrementally')
+            return False
+        return True
+
+    def run_stage(self, stage: Stage, force=False, allocation: Allocation = None):
+        """
+        Execute a stage unless it is up to date
+        :param stage: Stage to execute
+        :param force: Execute the stage even if it is up to date
+        :param allocation: Allocation reserved for the stage; None to grant what the idle budget would allow
+        :return: None
+        """
+        fingerprint = self.fingerprint(stage)
+        if not force and self.is_up_to_date(stage, fingerprint):
+            logger.info(f'Stage {stage.name} is up to date; skipping...')
+            self.report.skip_stage(stage.name)
+            return
+
+        allocation = self.resources.allocation(stage.footprint) if allocation is None else allocation
+        logger.info(f'Running stage {stage.name} with {allocation.tasks} tasks on {allocation.cores} cores and '
+                    f'{allocation.memory_mb:.0f} MB')
+        self.start_stage(stage, fingerprint, force)
+        with self.report.stage(stage.name, stage.inputs, stage.outputs, dataclasses.asdict(allocation)):
+            stage.run(allocation)
+
+        outputs = {str(p): self.digests.digest(p) for p in stage.outputs}
+        missing = [p for p, d in outputs.items() if d is None]
+        if missing:
+            raise FileNotFoundError(f'Stage {stage.name} did not produce expected outputs: {missing}')
+        self._write_record(stage, {'status': 'done', 'fingerprint': fingerprint, 'config': self.config_digest(stage),
+                                   'outputs': outputs, 'finished': datetime.now().isoformat()})
+        self.digests.save()
+
+    def run(self, from_stage=None, until_stage=None):
+        """
+        Execute all stages in dependency order.
+        :param from_stage: Name of the first stage to execute; it is rerun unconditionally, earlier stages are skipped
+        :param until_stage: Name of the last stage to execute
+        :return: None
+        """
+        ordered = self.order()
+        names = [stage.name for stage in ordered]
+        for stage_name in (from_stage, until_stage):
+            if stage_name is not None and stage_name not in names:
+                raise ValueError(f'Unknown stage: {stage_name}. Available stages: {", ".join(names)}')
+        first = names.index(from_stage) if from_stage is not None else 0
+        last = names.index(until_stage) if until_stage is not None else len(names) - 1
+
+        for stage in ordered[:first]:
+            if not self.is_up_to_date(stage):
+                logger.warning(f'Stage {stage.name} has no valid checkpoint but is skipped due to --from-stage')
+            self.report.skip_stage(stage.name)
+        try:
+            self._run_concurrently(ordered[first:last + 1], forced=from_stage)
+        finally:
+            self.digests.save()
+        if last < len(ordered) - 1:
+            logger.info(f'Stopped after stage {until_stage}')
+
+    def _run_concurrently(self, selected: List[Stage], forced=None):
+        """
+        Start every stage as soon as the stages it depends on are done and its allocation fits into the free budget.
+        Stages that take few cores are started first, so that short I/O-bound stages do not wait for a stage that
+        takes the whole budget. After a failure no further stages are started.
+        :param selected: Stages to execute in topological order; dependencies outside of them count as done
+        :param forced: Name of a stage that is executed even if it is up to date
+        :return: None
+        """
+        pending = list(selected)
+        done = set(self.stages) - {stage.name for stage in selected}
+        running = {}
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(len(selected), 1)) as executor:
+            while running or (pending and not errors):
+                ready = [stage for stage in pending if all(d in done for d in stage.depends_on)] if not errors else []
+                for stage in sorted(ready, key=lambda s: self.resources.demand(s.footprint)):
+                    allocation = self.resources.try_allocate(stage.footprint)
+                    if allocation is None:
+                        continue
+                    pending.remove(stage)
+                    future = executor.submit(self.run_stage, stage, stage.name == forced, allocation)
+                    running[future] = (stage, allocation)
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, allocation = running.pop(future)
+                    self.resources.release(allocation)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f'Stage {stage.name} failed: {e}')
+                        errors.append(e)
+                    else:
+                        done.add(stage.name)
+        if errors:
+            raise errors[0]
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import errno
+import shutil
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from prosimsit.io import atomic_path
+from prosimsit.constants import STAGING_METHODS
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+MANIFEST_FILE = '.staged.json'
+# ioctl cloning a whole file on copy-on-write filesystems like btrfs and XFS, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+_manifest_lock = threading.Lock()
+
+
+def _reflink(source: Path, destination: Path):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are only supported on Linux')
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(source, destination)
+
+
+def _hardlink(source: Path, destination: Path):
+    os.link(source, destination)
+
+
+def _symlink(source: Path, destination: Path):
+    os.symlink(source.resolve(), destination)
+
+
+def _copy(source: Path, destination: Path):
+    shutil.copy(source, destination)
+
+
+# methods that keep the staged file independent of its source
+WRITABLE_STAGING_METHODS = ['reflink', 'copy']
+_STAGERS = {'reflink': _reflink, 'hardlink': _hardlink, 'symlink': _symlink, 'copy': _copy}
+
+
+def staging_methods(method='auto', writable=False):
+    """
+    :param method: 'auto' or one of STAGING_METHODS
+    :param writable: True if the source or the staged file may be modified in place later
+    :return: Methods to try in order; copying is always the last resort
+    """
+    if method == 'auto':
+        methods = STAGING_METHODS
+    elif method not in STAGING_METHODS:
+        raise ValueError(f'Unknown staging method: {method}. Use auto or one of {", ".join(STAGING_METHODS)}.')
+    else:
+        methods = [method] if method == 'copy' else [method, 'copy']
+    if writable:
+        # through a hardlink or symlink, rewriting one file in place would silently change the other one as well
+        methods = [m for m in methods if m in WRITABLE_STAGING_METHODS]
+    return methods
+
+
+def stage_file(source: Path, destination: Path, method='auto', writable=False):
+    """
+    Make a file available at a second path without copying its content if the filesystem allows it: a reflink shares
+    the data copy-on-write, a hardlink shares the inode, a symlink points to the absolute source path. Hardlinks and
+    symlinks are only safe for files that are not modified in place afterwards, neither the source nor the staged
+    file; writable files are only reflinked or copied. The destination appears atomically.
+    :param source: Path to the file to stage
+    :param destination: Path the file is staged to
+    :param method: 'auto' to try all STAGING_METHODS in order, or the preferred method
+    :param writable: True if the source or the staged file may be modified in place later
+    :return: Name of the method that staged the file
+    """
+    source, destination = Path(source), Path(destination)
+    for candidate in staging_methods(method, writable):
+        try:
+            with atomic_path(destination) as tmp_path:
+                _STAGERS[candidate](source, tmp_path)
+        except OSError as e:
+            if candidate == 'copy':
+                raise
+            logger.debug(f'Could not {candidate} {source} to {destination}: {e}')
+            continue
+        return candidate
+
+
+def _record(source: Path, destination: Path, method):
+    source_stat = source.stat()
+    destination_stat = destination.stat()
+    return {'source': str(source.resolve()), 'method': method, 'size': source_stat.st_size,
+            'mtime_ns': source_stat.st_mtime_ns, 'staged_mtime_ns': destination_stat.st_mtime_ns,
+            'staged_inode': destination_stat.st_ino}
+
+
+def _is_staged(source: Path, destination: Path, record, methods):
+    """
+    :param methods: Staging methods allowed for the file
+    :return: True if destination was staged from source in its current version by an allowed method and was not
+        replaced since
+    """
+    if (record is None or not destination.is_file() or record['source'] != str(source.resolve())
+            or record['method'] not in methods):
+        return False
+    source_stat = source.stat()
+    destination_stat = destination.stat()
+    return (record['size'] == source_stat.st_size == destination_stat.st_size
+            and record['mtime_ns'] == source_stat.st_mtime_ns
+            and record['staged_mtime_ns'] == destination_stat.st_mtime_ns
+            and record['staged_inode'] == destination_stat.st_ino)
+
+
+def read_manifest(directory: Path):
+    """
+    :param directory: Directory files were staged to
+    :return: Dictionary mapping file names to the source and method they were staged with
+    """
+    manifest_path = Path(directory) / MANIFEST_FILE
+    if not manifest_path.is_file():
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def stage_files(sources, directory: Path, method='auto', threads=1, writable=False):
+    """
+    Stage files into a directory, see stage_file(). What was staged how is recorded in the directory, so that files
+    that are still staged from the current version of their source are not staged again, e.g. when a stage is resumed.
+    :param sources: Paths to the files to stage
+    :param directory: Directory the files are staged to, keeping their names
+    :param method: 'auto' to try all STAGING_METHODS in order, or the preferred method
+    :param threads: Number of files to stage concurrently
+    :param writable: True if the sources or the staged files may be modified in place later
+    :return: Dictionary mapping each file name to the method it is staged with
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    sources = [Path(s) for s in sources]
+    if not sources:
+        return {}
+    with _manifest_lock:
+        manifest = read_manifest(directory)
+
+    def stage(source):
+        destination = directory / source.name
+        record = manifest.get(source.name)
+        if _is_staged(source, destination, record, staging_methods(method, writable)):
+            return record
+        return _record(source, destination, stage_file(source, destination, method, writable))
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        records = dict(zip([s.name for s in sources], executor.map(stage, sources)))
+
+    with _manifest_lock:
+        manifest = read_manifest(directory)
+        manifest.update(records)
+        with atomic_path(directory / MANIFEST_FILE) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=4)
+    methods = {name: record['method'] for name, record in records.items()}
+    logger.info(f'Staged {len(methods)} files in {directory}: ' + ', '.join(
+        f'{sum(m == method for m in methods.values())} by {method}' for method in STAGING_METHODS
+        if method in methods.values()))
+    return methods
+
+
+def stage_matching_files(source_dir: Path, directory: Path, pattern, method='auto', threads=1, writable=False):
+    """
+    Stage all files of a directory matching a glob pattern, see stage_files()
+    :param source_dir: Directory containing the files
+    :param directory: Directory the files are staged to
+    :param pattern: Glob pattern, e.g. '*.txt'
+    :param method: 'auto' to try all STAGING_METHODS in order, or the preferred method
+    :param threads: Number of files to stage concurrently
+    :param writable: True if the sources or the staged files may be modified in place later
+    :return: Dictionary mapping each file name to the method it is staged with
+    """
+    return stage_files(sorted(p for p in Path(source_dir).glob(pattern) if p.is_file()), directory, method, threads,
+                       writable)
@@ -0,0 +1,314 @@
+import logging
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__package__ + "." + __file__)
+
+AMINO_ACIDS = np.array(list('ACDEFGHILMNPQSTVWY'))
+FEATURES = ['spectral_angle', 'pearson_corr', 'cos', 'abs_rt_diff', 'RT', 'pred_RT', 'collision_energy_aligned',
+            'ExpMass_feature', 'Charge2', 'Charge3', 'Charge4', 'Mass', 'KR', 'sequence_length', 'missedCleavages',
+            'Andromeda_score', 'log_intensity_sum', 'matched_fraction', 'unmatched_fraction', 'spearman_corr']
+SCAN_STRIDE = 3
+
+
+@dataclass
+class SyntheticDataset:
+    """
+    Paths of a synthetic ProSIMSIt project, laid out like the folders of a real run.
+    :param root: Root directory of the dataset
+    :param raw_files: Names of all raw files
+    :param n_psms: Number of PSMs in the MaxQuant msms.txt
+    """
+    root: Path
+    raw_files: List[str] = field(default_factory=list)
+    n_psms: int = 0
+
+    @property
+    def maxquant_dir(self):
+        return self.root / 'combined' / 'txt'
+
+    @property
+    def ok1_percolator(self):
+        return self.root / 'oktoberfest_1_out' / 'results' / 'percolator'
+
+    @property
+    def ok2_percolator(self):
+        return self.root / 'oktoberfest_2_out' / 'results' / 'percolator'
+
+    @property
+    def simsi_output(self):
+        return self.root / 'simsi_output'
+
+    @property
+    def percolator_dir(self):
+        return self.root / 'ProSIMSIt' / 'percolator'
+
+    @property
+    def picked_dir(self):
+        return self.root / 'ProSIMSIt' / 'PickedProteinGroupFDR'
+
+
+def raw_file_names(n_raw_files, hyphenated_fraction=0.25, raw_files_per_batch=10):
+    """
+    Names of raw files, grouped into TMT batches of fractions. Hyphenated names contain a '-<digits>-' part, which
+    looks like the scan number field of a PSMId.
+    :param n_raw_files: Number of raw files
+    :param hyphenated_fraction: Fraction of raw file names containing hyphens
+    :param raw_files_per_batch: Number of fractions per TMT batch
+    :return: List of raw file names
+    """
+    names = []
+    n_hyphenated = int(round(n_raw_files * hyphenated_fraction))
+    for i in range(n_raw_files):
+        batch, fraction = divmod(i, raw_files_per_batch)
+        if i < n_hyphenated:
+            names.append(f'TMT-B{batch + 1:02d}-{fraction + 1}-F{fraction + 1:02d}')
+        else:
+            names.append(f'TMT_B{batch + 1:02d}_F{fraction + 1:02d}')
+    return names
+
+
+def peptide_pool(rng, n_peptides, phospho_probability=0.1, oxidation_probability=0.3):
+    """
+    Random tryptic TMT peptides with carbamidomethylated cysteines and variable phosphorylation and oxidation
+    :param rng: Numpy random generator
+    :param n_peptides: Number of peptides
+    :param phospho_probability: Probability of each S, T and Y to be phosphorylated
+    :param oxidation_probability: Probability of each M to be oxidized
+    :return: Dataframe with 'Sequence', 'Modified sequence' (MaxQuant format), 'okt_sequence' (Oktoberfest format)
+        and 'Mass' columns
+    """
+    lengths = rng.integers(7, 26, n_peptides)
+    residues = rng.choice(AMINO_ACIDS, (n_peptides, 25))
+    c_terms = rng.choice(np.array(['K', 'R']), n_peptides)
+    modified = rng.random((n_peptides, 25))
+
+    sequences, maxquant_sequences, oktoberfest_sequences = [], [], []
+    for length, peptide, c_term, p in zip(lengths.tolist(), residues.tolist(), c_terms.tolist(), modified.tolist()):
+        peptide = peptide[:length - 1] + [c_term]
+        maxquant_sequence, oktoberfest_sequence = ['_'], ['[UNIMOD:737]-']
+        for aa, p_aa in zip(peptide, p):
+            maxquant_sequence.append(aa)
+            oktoberfest_sequence.append(aa)
+            if aa in 'STY' and p_aa < phospho_probability:
+                maxquant_sequence.append('(Phospho (STY))')
+                oktoberfest_sequence.append('[UNIMOD:21]')
+            elif aa == 'M' and p_aa < oxidation_probability:
+                maxquant_sequence.append('(Oxidation (M))')
+                oktoberfest_sequence.append('[UNIMOD:35]')
+            elif aa == 'C':
+                oktoberfest_sequence.append('[UNIMOD:4]')
+            elif aa == 'K':
+                oktoberfest_sequence.append('[UNIMOD:737]')
+        maxquant_sequence.append('_')
+        sequences.append(''.join(peptide))
+        maxquant_sequences.append(''.join(maxquant_sequence))
+        oktoberfest_sequences.append(''.join(oktoberfest_sequence))
+
+    return pd.DataFrame({
+        'Sequence': sequences,
+        'Modified sequence': maxquant_sequences,
+        'okt_sequence': oktoberfest_sequences,
+        'Mass': lengths * 110.0 + 229.163 * (1 + np.char.count(np.array(sequences), 'K')) + rng.random(n_peptides),
+    })
+
+
+def _append(df: pd.DataFrame, path: Path):
+    df.to_csv(path, sep='\t', index=False, mode='a', header=not path.is_file())
+
+
+def _psmids(raw_file, scans, sequences, charges):
+    scans = pd.Series(scans).astype(str)
+    return (raw_file + '-' + scans + '-' + pd.Series(np.asarray(sequences)) + '-' + pd.Series(charges).astype(str) +
+            '-' + scans).to_numpy()
+
+
+def _features(rng, n, shift):
+    features = rng.normal(size=(n, len(FEATURES)))
+    features[:, 0] += shift
+    return pd.DataFrame(features, columns=FEATURES)
+
+
+def _tab(rng, spec_ids, labels, scans, raw_file, peptides, proteins, shift):
+    tab = pd.DataFrame({'SpecId': spec_ids, 'Label': labels, 'ScanNr': scans, 'filename': raw_file})
+    tab = pd.concat([tab, _features(rng, len(tab), shift)], axis=1)
+    tab['Peptide'] = peptides
+    tab['Proteins'] = proteins
+    return tab
+
+
+def _weights(rng, path: Path):
+    header = '\t'.join(FEATURES + ['m0'])
+    with open(path, 'w') as f:
+        for _ in range(3):
+            # the spectral angle separates targets from decoys, as in real data
+            weights = np.append(rng.normal(scale=0.1, size=len(FEATURES)), rng.normal())
+            weights[0] = 2 + abs(weights[0])
+            f.write(header + '\n')
+            f.write('\t'.join(f'{w:.6f}' for w in weights) + '\n')
+            f.write('\t'.join(f'{w * 2:.6f}' for w in weights) + '\n')
+
+
+def generate_dataset(root, n_psms=100_000, n_raw_files=10, hyphenated_fraction=0.25, decoy_ratio=0.1,
+                     identified_fraction=0.5, transfer_fraction=0.3, raw_files_per_batch=10, n_peptides=None, seed=0):
+    """
+    Write a synthetic ProSIMSIt project: the MaxQuant msms.txt and summary.txt, the Percolator results, weights and
+    rescore.tab of the first Oktoberfest run, the SIMSI-Transfer p10_msms.txt and the per-file rescore.tab files of
+    the second Oktoberfest run. PSMs are generated and written one raw file at a time, so memory use does not grow with
+    the number of raw files.
+    :param root: Directory to write the dataset to; existing files are overwritten
+    :param n_psms: Number of PSMs in msms.txt, spread evenly over the raw files
+    :param n_raw_files: Number of raw files
+    :param hyphenated_fraction: Fraction of raw file names containing '-<digits>-'
+    :param decoy_ratio: Fraction of decoy PSMs in msms.txt; the second Oktoberfest run gets the same ratio of decoys
+    :param identified_fraction: Fraction of target PSMs below 1% FDR in the first Oktoberfest run
+    :param transfer_fraction: Fraction of the remaining scans that SIMSI-Transfer assigns a peptide to
+    :param raw_files_per_batch: Number of raw files per TMT batch, i.e. per MaxQuant experiment
+    :param n_peptides: Number of distinct target peptides; defaults to a quarter of n_psms, at most 200,000
+    :param seed: Seed of the random generator
+    :return: SyntheticDataset
+    """
+    raw_files = raw_file_names(n_raw_files, hyphenated_fraction, raw_files_per_batch)
+    dataset = SyntheticDataset(Path(root), raw_files, n_psms)
+    for directory in [dataset.maxquant_dir, dataset.ok1_percolator, dataset.ok2_percolator,
+                      dataset.simsi_output / 'summaries' / 'p10']:
+        directory.mkdir(parents=True, exist_ok=True)
+    msms_path = dataset.maxquant_dir / 'msms.txt'
+    target_psms_path = dataset.ok1_percolator / 'rescore.percolator.psms.txt'
+    decoy_psms_path = dataset.ok1_percolator / 'rescore.percolator.decoy.psms.txt'
+    ok1_tab_path = dataset.ok1_percolator / 'rescore.tab'
+    p10_path = dataset.simsi_output / 'summaries' / 'p10' / 'p10_msms.txt'
+    for path in [msms_path, target_psms_path, decoy_psms_path, ok1_tab_path, p10_path,
+                 *dataset.ok2_percolator.glob('*rescore.tab')]:
+        if path.is_file():
+            path.unlink()
+
+    rng = np.random.default_rng(seed)
+    if n_peptides is None:
+        n_peptides = min(max(n_psms // 4, 100), 200_000)
+    pool = peptide_pool(rng, 2 * n_peptides)
+    pool['Proteins'] = [f'P{i % 5000:05d}' for i in range(n_peptides)] * 2
+    pool.loc[n_peptides:, 'Proteins'] = 'REV__' + pool.loc[n_peptides:, 'Proteins']
+
+    _weights(rng, dataset.ok1_percolator / 'rescore.percolator.weights.csv')
+    pd.DataFrame({
+        'Raw file': raw_files,
+        'Experiment': [f'Batch{i // raw_files_per_batch + 1:02d}' for i in range(n_raw_files)],
+        'Fraction': [i % raw_files_per_batch + 1 for i in range(n_raw_files)],
+    }).to_csv(dataset.maxquant_dir / 'summary.txt', sep='\t', index=False)
+
+    psms_per_file = np.full(n_raw_files, n_psms // n_raw_files)
+    psms_per_file[:n_psms % n_raw_files] += 1
+    summary_id = 0
+    exp_mass_offset = 0
+    for file_index, (raw_file, n) in enumerate(zip(raw_files, psms_per_file.tolist())):
+        file_rng = np.random.default_rng([seed, file_index])
+        scans = np.arange(1, n + 1) * SCAN_STRIDE
+        is_decoy = file_rng.random(n) < decoy_ratio
+        peptides = pool.iloc[file_rng.integers(0, n_peptides, n) + n_peptides * is_decoy].reset_index(drop=True)
+        charges = file_rng.integers(2, 5, n)
+        identified = ~is_decoy & (file_rng.random(n) < identified_fraction)
+        scores = np.where(identified, file_rng.gamma(6, 20, n), file_rng.gamma(2, 15, n))
+        q_values = np.where(identified, file_rng.uniform(0, 0.01, n), file_rng.uniform(0.0100001, 1, n))
+        peps = np.where(identified, file_rng.uniform(0, 0.05, n), file_rng.uniform(0.05, 1, n))
+        psmids = _psmids(raw_file, scans, peptides['okt_sequence'], charges)
+
+        msms = pd.DataFrame({
+            'Raw file': raw_file,
+            'Scan number': scans,
+            'Scan index': scans // SCAN_STRIDE,
+            'Sequence': peptides['Sequence'],
+            'Length': peptides['Sequence'].str.len(),
+            'Modified sequence': peptides['Modified sequence'],
+            'Proteins': peptides['Proteins'],
+            'Charge': charges,
+            'Fragmentation': 'HCD',
+            'Mass analyzer': 'FTMS',
+            'm/z': (peptides['Mass'] + charges * 1.007276) / charges,
+            'Mass': peptides['Mass'],
+            'Retention time': scans / n * 120,
+            'PEP': peps,
+            'Score': scores,
+            'Reverse': np.where(is_decoy, '+', ''),
+        })
+        _append(msms, msms_path)
+
+        percolator = pd.DataFrame({
+            'PSMId': psmids,
+            'filename': raw_file,
+            'score': np.where(identified, file_rng.normal(2, 0.5, n), file_rng.normal(-1, 1, n)),
+            'q-value': q_values,
+            'posterior_error_prob': peps,
+            'peptide': peptides['okt_sequence'],
+            'proteinIds': peptides['Proteins'],
+        })
+        _append(percolator.loc[~is_decoy], target_psms_path)
+        _append(percolator.loc[is_decoy], decoy_psms_path)
+
+        ok1_tab = _tab(file_rng, psmids, np.where(is_decoy, -1, 1), scans, raw_file, peptides['okt_sequence'],
+                       peptides['Proteins'], np.where(identified, 2.0, 0.0))
+        ok1_tab.insert(4, 'ExpMass', exp_mass_offset + np.arange(n))
+        exp_mass_offset += n
+        _append(ok1_tab, ok1_tab_path)
+
+        # SIMSI-Transfer reports identified scans ('d') and scans a peptide was transferred to ('t')
+        transferred = ~identified & (file_rng.random(n) < transfer_fraction)
+        identified_rows = np.flatnonzero(identified)
+        transferred_rows = np.flatnonzero(transferred)
+        if len(identified_rows) == 0:
+            transferred_rows = transferred_rows[:0]
+        donors = file_rng.choice(identified_rows, len(transferred_rows)) if len(transferred_rows) else transferred_rows
+        p10_rows = np.concatenate([identified_rows, transferred_rows])
+        p10_peptides = peptides.iloc[np.concatenate([identified_rows, donors])].reset_index(drop=True)
+        p10_charges = charges[np.concatenate([identified_rows, donors])]
+        is_transfer = np.arange(len(p10_rows)) >= len(identified_rows)
+        p10 = pd.DataFrame({
+            'Raw file': raw_file,
+            'scanID': scans[p10_rows],
+            'Sequence': p10_peptides['Sequence'],
+            'Modified sequence': p10_peptides['Modified sequence'],
+            'Proteins': p10_peptides['Proteins'],
+            'Charge': p10_charges,
+            'Fragmentation': 'HCD',
+            'Mass analyzer': 'FTMS',
+            'm/z': (p10_peptides['Mass'] + p10_charges * 1.007276) / p10_charges,
+            'Mass': np.where(is_transfer, np.nan, p10_peptides['Mass']),
+            'PEP': np.where(is_transfer, np.nan, peps[p10_rows]),
+            'Score': np.where(is_transfer, np.nan, scores[p10_rows]),
+            'summary_ID': summary_id + np.arange(len(p10_rows)),
+            'Experiment': f'Batch{file_index // raw_files_per_batch + 1:02d}',
+            'Fraction': file_index % raw_files_per_batch + 1,
+            'MS scan number': scans[p10_rows] - 1,
+            'clusterID': file_rng.integers(0, max(len(p10_rows) // 2, 1), len(p10_rows)),
+            'mod_ambiguous': 0,
+            'raw_ambiguous': 0,
+            'identification': np.where(is_transfer, 't', 'd'),
+            'Phospho (STY) Probabilities': np.nan,
+        })
+        summary_id += len(p10_rows)
+        _append(p10, p10_path)
+
+        # the second Oktoberfest run rescores the transferred PSMs, together with a share of decoys for these scans
+        transfer_scans = scans[transferred_rows]
+        transfer_peptides = p10_peptides.loc[is_transfer].reset_index(drop=True)
+        transfer_charges = p10_charges[is_transfer]
+        ok2_decoys = file_rng.random(len(transfer_scans)) < decoy_ratio
+        decoy_peptides = pool.iloc[file_rng.integers(n_peptides, 2 * n_peptides, ok2_decoys.sum())]
+        ok2_tab = pd.concat([
+            _tab(file_rng, _psmids(raw_file, transfer_scans, transfer_peptides['okt_sequence'], transfer_charges),
+                 1, transfer_scans, raw_file, transfer_peptides['okt_sequence'].to_numpy(),
+                 transfer_peptides['Proteins'].to_numpy(), 1.0),
+            _tab(file_rng, _psmids(raw_file, transfer_scans[ok2_decoys], decoy_peptides['okt_sequence'].to_numpy(),
+                                   transfer_charges[ok2_decoys]),
+                 -1, transfer_scans[ok2_decoys], raw_file, decoy_peptides['okt_sequence'].to_numpy(),
+                 decoy_peptides['Proteins'].to_numpy(), 0.0),
+        ], ignore_index=True)
+        ok2_tab.to_csv(dataset.ok2_percolator / f'{raw_file}.rescore.tab', sep='\t', index=False)
+        logger.debug(f'Generated {n} PSMs for {raw_file}')
+
+    logger.info(f'Generated {n_psms} PSMs in {n_raw_files} raw files in {dataset.root}')
+    return dataset
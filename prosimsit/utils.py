@@ -1,57 +1,119 @@
 import logging
 import glob
+import itertools
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
 
+import prosimsit.psmid as psmid
+from prosimsit.io import atomic_path, estimate_chunksize, read_table, write_table, table_writer
+from prosimsit.constants import DEFAULT_MEMORY_BUDGET_MB
+from prosimsit.modifications import ModificationTable
+import prosimsit.report as report
+
 # hacky way to get the package logger instead of just __main__ when running as a module
 logger = logging.getLogger(__package__ + "." + __file__)
 
+PERCOLATOR_PSM_COLUMNS = ['PSMId', 'score', 'q-value', 'posterior_error_prob']
+
+SCANS_PER_FILE = psmid.SCANS_PER_FILE
+
+# non-feature columns of Percolator tab files; all other columns are features and stored as float64
+PERCOLATOR_TAB_COLUMNS = {'SpecId': 'object', 'Label': 'int64', 'ScanNr': 'int64', 'filename': 'object',
+                          'ExpMass': 'int64', 'Peptide': 'object', 'Proteins': 'object'}
+
+
+def read_percolator_psms(path_to_psms, raw_files, q_value_threshold=0.01, chunksize=None):
+    """
+    Read a Percolator PSM table, keeping only PSMs at or below the q-value threshold while reading
+    :param path_to_psms: Path to Percolator psms.txt file
+    :param raw_files: Names of all raw files; required to properly split PSMId information
+    :param q_value_threshold: Maximum q-value of PSMs to keep
+    :param chunksize: Number of rows to parse at once; None to read the whole file at once
+    :return: Dataframe with 'Raw file', 'Scan number', 'posterior_error_prob' and 'score' columns
+    """
+    reader = pd.read_csv(path_to_psms, sep='\t', usecols=PERCOLATOR_PSM_COLUMNS, chunksize=chunksize)
+    chunks = [reader] if chunksize is None else reader
+
+    filtered = []
+    for chunk in chunks:
+        chunk = chunk.loc[chunk['q-value'] <= q_value_threshold]
+        psms = psmid.parse_psmids(chunk['PSMId'], raw_files)[['Raw file', 'Scan number']]
+        psms[['posterior_error_prob', 'score']] = chunk[['posterior_error_prob', 'score']]
+        filtered.append(psms)
+    return pd.concat(filtered, ignore_index=True)
+
 
-def prosit_to_simsi(path_to_msms, path_to_percolator, path_out, raw_file_hyphens=0):
+@report.step
+def prosit_to_simsi(maxquant_tables, path_to_percolator, path_out, raw_files, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
     """
-    Prepare a file usable as input for SIMSI-Transfer from the results of MaxQuant and Oktoberfest
-    :param path_to_msms: Path to msms.txt file from MaxQuant
+    Prepare a file usable as input for SIMSI-Transfer from the results of MaxQuant and Oktoberfest. The small table of
+    Percolator PSMs at 1% FDR is used as lookup, while the 100% FDR msms.txt is streamed through it in chunks sized to
+    the memory budget and written to the output incrementally.
+    :param maxquant_tables: MaxQuantTables of the MaxQuant search
     :param path_to_percolator: Path to Oktoberfest output/results/percolator folder
     :param path_out: Path to save the output file
-    :param raw_file_hyphens: Number of hyphens in the raw file name; required to properly split PSMId information
+    :param raw_files: Names of all raw files; required to properly split PSMId information
+    :param memory_budget_mb: Memory budget in MB for processing a single chunk of the Percolator results
     :return: None
     """
-    if path_out.is_file():
-        logger.info(f'File {path_out} already exists; skipping new file generation')
-        return
+    prosit_all = pd.concat([
+        read_percolator_psms(path_to_percolator / f, raw_files,
+                             chunksize=estimate_chunksize(path_to_percolator / f, memory_budget_mb,
+                                                          usecols=PERCOLATOR_PSM_COLUMNS))
+        for f in ['rescore.percolator.psms.txt', 'rescore.percolator.decoy.psms.txt']], ignore_index=True)
+    if prosit_all.duplicated(['Raw file', 'Scan number']).any():
+        raise pd.errors.MergeError('Merge keys are not unique in left dataset; not a one-to-one merge')
+    prosit_all['lookup_index'] = np.arange(len(prosit_all))
+    matches = np.zeros(len(prosit_all), dtype=np.int64)
 
-    prosit_target = pd.read_csv(path_to_percolator / 'rescore.percolator.psms.txt', sep="\t")
-    prosit_decoy = pd.read_csv(path_to_percolator / 'rescore.percolator.decoy.psms.txt', sep="\t")
+    report.record_rows('Percolator PSMs read', len(prosit_all))
 
-    prosit_all = pd.concat([prosit_target, prosit_decoy])
-    prosit_all["Scan number"] = prosit_all['PSMId'].str.split('-').str[raw_file_hyphens + 1].astype(
-        int)
-    prosit_all["Raw file"] = prosit_all['PSMId'].str.split('-').str[0:raw_file_hyphens + 1]
-    prosit_all["Raw file"] = prosit_all["Raw file"].apply(lambda raw_file: '-'.join(raw_file))
-    prosit_all = prosit_all.loc[prosit_all["q-value"] <= 0.01]
-    prosit_all = prosit_all[["Raw file", "Scan number", "posterior_error_prob", "score"]]
+    header = None
+    with atomic_path(path_out) as tmp_path, open(tmp_path, 'w', newline='') as f:
+        for msms_chunk in maxquant_tables.iter_chunks('msms'):
+            report.record_rows('msms.txt read', len(msms_chunk))
+            merged_df = prosit_all.merge(msms_chunk, how='inner', on=['Raw file', 'Scan number'])
+            np.add.at(matches, merged_df['lookup_index'].to_numpy(), 1)
+            if header is None:
+                header = _simsi_msms_columns(merged_df)
+            merged_df[["PEP", "Score"]] = merged_df[["posterior_error_prob", "score"]].to_numpy()
+            merged_df[header].to_csv(f, sep='\t', index=False, header=(f.tell() == 0))
+            report.record_rows(f'{Path(path_out).name} written', len(merged_df))
 
-    msms100perc = pd.read_csv(path_to_msms, sep="\t")
+        if (matches > 1).any():
+            raise pd.errors.MergeError('Merge keys are not unique in right dataset; not a one-to-one merge')
 
-    merged_df = prosit_all.merge(msms100perc, how='left', on=['Raw file', 'Scan number'], validate='1:1')
-    merged_df["PEP"] = merged_df["posterior_error_prob"]
-    merged_df["Score"] = merged_df["score"]
-    merged_df = merged_df.drop("posterior_error_prob", axis=1)
-    merged_df = merged_df.drop("score", axis=1)
-
-    merged_df.to_csv(path_out, sep='\t', index=False)
+        # keep PSMs without a match in msms.txt, as the left merge this replaces did
+        unmatched = prosit_all.loc[matches == 0]
+        if len(unmatched) > 0:
+            logger.warning(f'{len(unmatched)} PSMs were not found in {maxquant_tables.path("msms")}')
+            unmatched = unmatched.rename(columns={'posterior_error_prob': 'PEP', 'score': 'Score'})
+            unmatched.reindex(columns=header).to_csv(f, sep='\t', index=False, header=(f.tell() == 0))
+            report.record_rows(f'{Path(path_out).name} written', len(unmatched))
     logger.info(f'Done preparing; saved SIMSI-ready file to {path_out}')
 
 
+def _simsi_msms_columns(merged_df):
+    columns = [c for c in merged_df.columns if c not in ['lookup_index', 'posterior_error_prob', 'score']]
+    for column in ['PEP', 'Score']:
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+
+@report.step
 def prepare_input_for_second_oktoberfest(simsi_output):
     """
     Prepare a file for the second Oktoberfest run
     :param simsi_output: Path to SIMSI-Transfer output directory
     :return: Path to the msms.txt file usable as Oktoberfest input
     """
-    msms_df = pd.read_csv(simsi_output / 'summaries/p10/p10_msms.txt', sep='\t')
+    msms_df = read_table(simsi_output / 'summaries/p10/p10_msms.txt')
+    report.record_rows('p10_msms.txt read', len(msms_df))
 
     msms_df = msms_df[msms_df['identification'] == 't']
     msms_df = msms_df.rename(columns={'scanID': 'Scan number'})
@@ -61,103 +123,158 @@ def prepare_input_for_second_oktoberfest(simsi_output):
     msms_df['Mass'] = msms_df['Mass'].fillna((msms_df['m/z'] - 1.0078 + 0.0005) * msms_df['Charge'])
 
     msms_for_oktoberfest = simsi_output / 'summaries/p10/msms.txt'
-    msms_df.to_csv(msms_for_oktoberfest, sep='\t', index=False)
+    write_table(msms_df, msms_for_oktoberfest)
+    report.record_rows(f'{msms_for_oktoberfest.name} written', len(msms_df))
     return msms_for_oktoberfest
 
 
-def merge_rescore_files(ok1_dir, ok2_dir: Path, output_dir: Path):
+@report.step
+def merge_rescore_files(ok1_dir, ok2_dir: Path, output_file: Path, threads=1,
+                        memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
     """
-    Merge rescore files from the first and second Oktoberfest runs
+    Merge rescore files from the first and second Oktoberfest runs. The per-file tabs of the second run are read in
+    parallel and, like the chunks of the first run's tab, appended to the merged table as soon as they are read.
+    ExpMass identifies a spectrum, i.e. a (filename, ScanNr) pair, and is packed from a filename code and ScanNr.
     :param ok1_dir: Output directory of the first Oktoberfest run
     :param ok2_dir: Output directory of the second Oktoberfest run
-    :param output_dir: Directory to save the merged file
+    :param output_file: Path of the merged table; a .tab or .txt suffix writes a Percolator tab file, other suffixes
+        a columnar table, see io.INTERMEDIATE_FORMATS
+    :param threads: Number of rescore files to read in parallel
+    :param memory_budget_mb: Memory budget in MB for a single chunk of the first run's rescore.tab
     :return: None
     """
-    rescoretab = pd.DataFrame()
-    if (output_dir / 'rescore_all.tab').is_file():
-        logger.info('rescore_all.tab already exists; reusing')
-        return
-    else:
-        for f in glob.iglob(str(ok2_dir / '*rescore.tab')):
-            temp = pd.read_csv(f, sep='\t')
-            rescoretab = pd.concat([rescoretab, temp])
-    temp = pd.read_csv(ok1_dir / 'rescore.tab', sep='\t').drop(columns=['ExpMass'])
-    rescoretab = pd.concat([rescoretab, temp])
-    rescoretab.insert(loc=4, column="ExpMass", value=rescoretab.groupby(["filename", "ScanNr"]).ngroup())
-    rescoretab.to_csv(output_dir / 'rescore_all.tab', sep='\t', index=False)
+    ok2_files = sorted(glob.glob(str(ok2_dir / '*rescore.tab')))
+    ok1_file = ok1_dir / 'rescore.tab'
+    _check_tab_columns(ok2_files + [ok1_file])
+    ok1_chunks = pd.read_csv(ok1_file, sep='\t', chunksize=estimate_chunksize(ok1_file, memory_budget_mb))
+
+    filename_codes = {}
+    header = None
+    schema = None
+    with table_writer(output_file, schema={}) as append:
+        for rescoretab in itertools.chain(_read_tabs_in_parallel(ok2_files, threads), ok1_chunks):
+            rescoretab = rescoretab.drop(columns=['ExpMass'], errors='ignore')
+            if header is None:
+                header = list(rescoretab.columns)
+                header.insert(4, 'ExpMass')
+                schema = {c: PERCOLATOR_TAB_COLUMNS.get(c, 'float64') for c in header}
+            if rescoretab['ScanNr'].max() >= SCANS_PER_FILE:
+                raise ValueError(f'Scan numbers of {SCANS_PER_FILE} or higher are not supported')
+            for filename in rescoretab['filename'].unique():
+                filename_codes.setdefault(filename, len(filename_codes))
+            rescoretab['ExpMass'] = (rescoretab['filename'].map(filename_codes).astype(np.int64) * SCANS_PER_FILE +
+                                     rescoretab['ScanNr'].astype(np.int64))
+            append(rescoretab[header].astype(schema))
+            report.record_rows(f'{Path(output_file).name} written', len(rescoretab))
 
 
-def translate_modified_sequences_in_psmid(inpseries):
+def _check_tab_columns(paths):
     """
-    Translate modified sequences from MaxQuant to SIMSI format to be used in PSMId columns
-    :param inpseries: Series containing PSMId's from Oktoberfest
-    :return: Series containing PSMId's with modifications translated into MaxQuant format
+    Check that all rescore files have the same features, since every chunk of the merged table is written with the
+    columns of the first one
+    :param paths: List of paths to Percolator tab files
+    :return: None
+    :raise ValueError: If the columns of a file differ from those of the first file
     """
-    split = inpseries.str.split('-')
-    return (split.str[0] + '-' + split.str[1] + '-_' + split.str[3]
-            .str.replace('[UNIMOD:737]', '', regex=False)
-            .str.replace('[UNIMOD:35]', '(Oxidation (M))', regex=False)
-            .str.replace('[UNIMOD:21]', '(Phospho (STY))', regex=False)
-            .str.replace('[UNIMOD:4]', '', regex=False) + '_')
+    columns = None
+    for path in paths:
+        # ExpMass is recomputed for the merged table
+        file_columns = set(pd.read_csv(path, sep='\t', nrows=0).columns) - {'ExpMass'}
+        if columns is None:
+            columns, first_path = file_columns, path
+        elif file_columns != columns:
+            missing, extra = sorted(columns - file_columns), sorted(file_columns - columns)
+            raise ValueError(f'Rescore files have different columns: {path} lacks {missing} and has additional '
+                             f'{extra} compared to {first_path}')
 
 
+def _read_tabs_in_parallel(paths, threads):
+    """
+    Read tab-separated files with up to threads files in flight, yielding them in the order of paths
+    :param paths: List of paths to tab-separated files
+    :param threads: Number of files to read concurrently
+    :return: Generator of dataframes
+    """
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        in_flight = deque()
+        for path in paths:
+            in_flight.append(executor.submit(pd.read_csv, path, sep='\t'))
+            if len(in_flight) >= max(threads, 1):
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def translate_modified_sequences(modified_sequences, modifications: ModificationTable = None):
+    """
+    Translate modified sequences from Oktoberfest to MaxQuant format, as used by SIMSI-Transfer
+    :param modified_sequences: Series containing modified sequences parsed from Oktoberfest PSMIds
+    :param modifications: ModificationTable to translate with; None for the default modifications
+    :return: Series containing modified sequences in MaxQuant format
+    """
+    if modifications is None:
+        modifications = ModificationTable()
+    return modifications.to_maxquant(modified_sequences)
+
+
+def read_percolator_results(path_to_percolator_result, raw_files, modifications: ModificationTable = None):
+    """
+    Read a Percolator result file with PSMIds parsed into packed scan keys and modified sequences in MaxQuant format
+    :param path_to_percolator_result: Path to a Percolator psms.txt file
+    :param raw_files: Names of all raw files; required to properly split PSMId information
+    :param modifications: ModificationTable to translate the modified sequences with; None for the default
+    :return: Dataframe with 'scan_key', 'Modified sequence' and 'posterior_error_prob' columns
+    """
+    percolator = pd.read_csv(path_to_percolator_result, usecols=['PSMId', 'posterior_error_prob'], sep='\t')
+    psms = psmid.parse_psmids(percolator['PSMId'], raw_files)
+    return pd.DataFrame({
+        'scan_key': psmid.scan_keys(psms['Raw file'], psms['Scan number'], raw_files),
+        'Modified sequence': translate_modified_sequences(psms['Modified sequence'], modifications),
+        'posterior_error_prob': percolator['posterior_error_prob']})
+
+
+@report.step
 def prepare_for_building_evidence(path_to_percolator_result, path_to_percolator_decoy, path_to_simsi_msms,
-                                  path_to_mq_msms100perc, path_to_mq_summary, path_to_output, number_of_hyphen=0):
+                                  maxquant_tables, path_to_output, raw_files, modifications: ModificationTable = None):
     """
-    Prepare a file in the shape of a simsi summary file, that includes all target and decoy PSMs generated during the workflow
+    Prepare a file in the shape of a simsi summary file, that includes all target and decoy PSMs generated during the workflow.
+    PSMs are matched on packed integer keys of (raw file, scan number) and (raw file, scan number, modified sequence).
     :param path_to_percolator_result: Path to the rescore.psms from the second Oktoberfest run
     :param path_to_percolator_decoy: Path to the rescore.decoy.psms from the second Oktoberfest run
     :param path_to_simsi_msms: Path to the msms.txt file generated by SIMSI-Transfer
-    :param path_to_mq_msms100perc: Path to the 100% FDR msms.txt file from MaxQuant
-    :param path_to_mq_summary: Path to the summary.txt file from MaxQuant
-    :param path_to_output: Path to save the merged file
-    :param number_of_hyphen: Number of hyphens in the raw file name; required to properly split PSMId information
+    :param maxquant_tables: MaxQuantTables of the MaxQuant search, providing the 100% FDR msms.txt and summary.txt
+    :param path_to_output: Path to save the merged file; the suffix determines the format, see io.INTERMEDIATE_FORMATS
+    :param raw_files: Names of all raw files; required to properly split PSMId information
+    :param modifications: ModificationTable translating the Oktoberfest sequences; None for the default modifications
     :return: None
     """
-    if Path(path_to_output).is_file():
-        logger.info(f'Merged msms.txt file found at {path_to_output}. Skipping file generation.')
-        return
-
-    all_PEPs = pd.DataFrame()
-    deduplicated_PSMs = set()
-    percolator = pd.read_csv(path_to_percolator_result, usecols=['PSMId', 'filename', 'posterior_error_prob'], sep='\t')
-    percolator["Scan number"] = percolator['PSMId'].str.split('-').str[number_of_hyphen + 1].astype(int)
-    percolator["ID"] = percolator['filename'] + '-' + percolator["Scan number"].astype(str)
-    percolator["PSMId"] = translate_modified_sequences_in_psmid(percolator["PSMId"])
-    deduplicated_PSMs = deduplicated_PSMs.union(set(percolator['PSMId']))
-    all_ids = set(percolator['ID'])
-    all_PEPs = pd.concat([all_PEPs, percolator[['ID', 'posterior_error_prob']]])
-    del percolator
-    percolator_decoys = pd.read_csv(path_to_percolator_decoy, usecols=['PSMId', 'filename', 'posterior_error_prob'],
-                                    sep='\t')
-    percolator_decoys["Scan number"] = percolator_decoys['PSMId'].str.split('-').str[number_of_hyphen + 1].astype(int)
-    percolator_decoys["ID"] = percolator_decoys['filename'] + '-' + percolator_decoys["Scan number"].astype(str)
-    percolator_decoys["PSMId"] = translate_modified_sequences_in_psmid(percolator_decoys["PSMId"])
-    deduplicated_PSMs = deduplicated_PSMs.union(set(percolator_decoys['PSMId']))
-    all_ids_decoys = set(percolator_decoys['ID'])
-    all_PEPs = pd.concat([all_PEPs, percolator_decoys[['ID', 'posterior_error_prob']]])
-    del percolator_decoys
-
-    msms_simsi = pd.read_csv(path_to_simsi_msms, sep='\t')
-    msms_simsi['ID'] = msms_simsi['Raw file'] + '-' + msms_simsi['scanID'].astype(str)
-    msms_simsi['PSMId'] = msms_simsi['Raw file'] + '-' + msms_simsi['scanID'].astype(str) + '-' + msms_simsi[
-        'Modified sequence']
-    msms_simsi = msms_simsi[msms_simsi['PSMId'].isin(deduplicated_PSMs)]
-    msms_simsi = msms_simsi.drop(columns=['PSMId'])
+    all_PEPs = pd.concat([read_percolator_results(path_to_percolator_result, raw_files, modifications),
+                          read_percolator_results(path_to_percolator_decoy, raw_files, modifications)],
+                         ignore_index=True)
+
+    msms_simsi = read_table(path_to_simsi_msms)
+    simsi_scan_keys = psmid.scan_keys(msms_simsi['Raw file'], msms_simsi['scanID'], raw_files)
+    percolator_psm_keys, simsi_psm_keys = psmid.psm_keys(
+        [all_PEPs['scan_key'], simsi_scan_keys], [all_PEPs['Modified sequence'], msms_simsi['Modified sequence']])
+    in_percolator = np.isin(simsi_psm_keys, percolator_psm_keys)
+    msms_simsi = msms_simsi[in_percolator]
+    simsi_scan_keys = simsi_scan_keys[in_percolator]
     keep_cols = set(msms_simsi.columns)
     keep_cols.add("Scan number")
-    keep_cols = keep_cols - {'Fraction', 'MS scan number', 'clusterID', 'Experiment', 'mod_ambiguous', 'ID', 'PEP',
+    keep_cols = keep_cols - {'Fraction', 'MS scan number', 'clusterID', 'Experiment', 'mod_ambiguous', 'PEP',
                              'summary_ID', 'identification', 'scanID', 'raw_ambiguous', 'Phospho (STY) Probabilities'}
 
-    ids_not_in_simsi = all_ids - set(msms_simsi['ID'])
-    decoys_not_in_simsi = all_ids_decoys - set(msms_simsi['ID'])
+    # scans of target and decoy PSMs that SIMSI-Transfer did not report are taken from the 100% FDR msms.txt
+    scan_keys_not_in_simsi = np.setdiff1d(all_PEPs['scan_key'].to_numpy(), simsi_scan_keys)
 
-    msms100 = pd.read_csv(path_to_mq_msms100perc, usecols=list(keep_cols), sep="\t")
-    msms100["ID"] = msms100["Raw file"] + '-' + msms100["Scan number"].astype(str)
-    msms100 = msms100[msms100['ID'].isin(ids_not_in_simsi.union(decoys_not_in_simsi))]
+    msms100 = maxquant_tables.read('msms', columns=keep_cols)
+    msms100_scan_keys = psmid.scan_keys(msms100['Raw file'], msms100['Scan number'], raw_files)
+    in_missing_scans = np.isin(msms100_scan_keys, scan_keys_not_in_simsi)
+    msms100 = msms100[in_missing_scans]
+    msms100_scan_keys = msms100_scan_keys[in_missing_scans]
     msms100 = msms100.rename(columns={"Scan number": "scanID"})
 
-    summary = pd.read_csv(path_to_mq_summary, sep='\t')
+    summary = maxquant_tables.read('summary')
     if 'Fraction' not in summary.columns:
         summary['Fraction'] = 1
     summary = summary[['Raw file', 'Experiment', 'Fraction']]
@@ -175,8 +292,10 @@ def prepare_for_building_evidence(path_to_percolator_result, path_to_percolator_
     msms100['clusterID'] = np.nan
     msms100['identification'] = 'd'
 
-    msms_simsi = pd.concat(
-        [msms_simsi[msms_simsi['ID'].isin(all_ids) | msms_simsi['ID'].isin(all_ids_decoys)], msms100],
-        ignore_index=True)
-    msms_simsi = msms_simsi.merge(all_PEPs, on='ID', how='left', validate='1:1')
-    msms_simsi.to_csv(path_to_output, sep='\t', index=False)
+    # all remaining SIMSI PSMs matched a Percolator PSM, so their scans are target or decoy scans
+    msms_simsi = pd.concat([msms_simsi, msms100], ignore_index=True)
+    msms_simsi['scan_key'] = np.concatenate([simsi_scan_keys, msms100_scan_keys])
+    msms_simsi = msms_simsi.merge(all_PEPs[['scan_key', 'posterior_error_prob']], on='scan_key', how='left',
+                                  validate='1:1')
+    write_table(msms_simsi.drop(columns=['scan_key']), path_to_output)
+    report.record_rows(f'{Path(path_to_output).name} written', len(msms_simsi))
@@ -0,0 +1,33 @@
+import asyncio
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def koina_standin():
+    """
+    Factory starting local Koina stand-in servers in a background event loop, see prosimsit.koina_standin
+    :return: Function called with the arguments of create_service(), returning the servicer and the server address
+    """
+    pytest.importorskip('grpc')
+    pytest.importorskip('tritonclient.grpc')
+    import prosimsit.koina_standin as koina_standin
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    servers = []
+
+    def start(**kwargs):
+        server, service, address = asyncio.run_coroutine_threadsafe(
+            koina_standin.start_server(0, **kwargs), loop).result()
+        servers.append(server)
+        return service, address
+
+    yield start
+    for server in servers:
+        asyncio.run_coroutine_threadsafe(server.stop(None), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
@@ -0,0 +1,181 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('oktoberfest.runner')
+
+import prosimsit.oktoberfest_functions as oktoberfest_functions
+import prosimsit.spectrum_store as spectrum_store
+from oktoberfest.data import Spectra
+from oktoberfest.utils import Config
+from prosimsit.oktoberfest_functions import annotate_library, annotation_step, generate_pred_file
+from prosimsit.scheduler import run_per_file
+
+PEPTIDES = ['LGEHNIDVLEGNEQFINAAK', 'VAPEEHPVLLTEAPLNPK', 'SGGLLWQLVR', 'ELISNASDALDK', 'AVFPSIVGRPR']
+
+
+def _spectra(raw_file, n_spectra, rng):
+    return pd.DataFrame({
+        'RAW_FILE': raw_file,
+        'SCAN_NUMBER': np.arange(1, n_spectra + 1),
+        # dense peaks so that every spectrum has annotated fragments at a tolerance of 0.5 Da
+        'INTENSITIES': [rng.random(400) for _ in range(n_spectra)],
+        'MZ': [np.sort(rng.uniform(100, 1500, 400)) for _ in range(n_spectra)],
+        'MZ_RANGE': '100.0-1500.0',
+        'RETENTION_TIME': np.linspace(10, 60, n_spectra),
+        'MASS_ANALYZER': 'FTMS',
+        'FRAGMENTATION': 'HCD',
+        'COLLISION_ENERGY': 30.0,
+        'INSTRUMENT_TYPES': 'Q Exactive Plus',
+    })
+
+
+def _search_results(raw_file, n_spectra, rng):
+    sequences = rng.choice(PEPTIDES, n_spectra)
+    return pd.DataFrame({
+        'RAW_FILE': raw_file,
+        'SCAN_NUMBER': rng.permutation(np.arange(1, n_spectra + 1)),
+        'MODIFIED_SEQUENCE': sequences,
+        'PRECURSOR_CHARGE': rng.integers(2, 4, n_spectra),
+        'SCAN_EVENT_NUMBER': np.arange(n_spectra),
+        'MASS': rng.uniform(1000, 2500, n_spectra),
+        'SCORE': rng.uniform(50, 150, n_spectra),
+        'REVERSE': rng.random(n_spectra) < 0.2,
+        'SEQUENCE': sequences,
+        'PEPTIDE_LENGTH': [len(sequence) for sequence in sequences],
+        'PROTEINS': rng.choice(['P1', 'P2;P3'], n_spectra),
+    })
+
+
+@pytest.fixture
+def spectra_files(tmp_path, monkeypatch):
+    """
+    Spectra files with a spectrum store each; the mzML files themselves are never decoded
+    """
+    rng = np.random.default_rng(0)
+    spectra = {'run_a': _spectra('run_a', 23, rng), 'run_b': _spectra('run_b', 5, rng)}
+    monkeypatch.setattr(spectrum_store, 'read_mzml', lambda mzml_file: spectra[mzml_file.stem])
+
+    mzml_dir = tmp_path / 'mzml'
+    mzml_dir.mkdir()
+    files = []
+    for raw_file, raw_spectra in spectra.items():
+        mzml_file = mzml_dir / f'{raw_file}.mzML'
+        mzml_file.write_text('')
+        spectrum_store.build_store(mzml_file, tmp_path / 'store')
+        files.append(mzml_file)
+    search_results = {raw_file: _search_results(raw_file, len(raw_spectra), rng)
+                      for raw_file, raw_spectra in spectra.items()}
+    return files, search_results
+
+
+def _config(output_dir, search_results):
+    (output_dir / 'msms').mkdir(parents=True)
+    for raw_file, search in search_results.items():
+        search.to_csv(output_dir / 'msms' / f'{raw_file}.rescore', index=False)
+    config_path = output_dir / 'config.json'
+    with open(config_path, 'w') as f:
+        json.dump({'type': 'Rescoring', 'output': '.', 'numThreads': 3, 'massTolerance': 0.5,
+                   'unitMassTolerance': 'da', 'models': {'intensity': 'Prosit_2020_intensity_HCD',
+                                                         'irt': 'Prosit_2019_irt'}}, f)
+    conf = Config()
+    conf.read(config_path)
+    return conf
+
+
+def _assert_same_library(expected_path, actual_path):
+    expected, actual = Spectra.from_hdf5(expected_path), Spectra.from_hdf5(actual_path)
+    pd.testing.assert_frame_equal(expected.obs, actual.obs)
+    pd.testing.assert_frame_equal(expected.var, actual.var)
+    assert sorted(expected.layers) == sorted(actual.layers)
+    for layer in expected.layers:
+        assert (expected.layers[layer] != actual.layers[layer]).nnz == 0, layer
+    assert list(expected.uns.get('ion_types', [])) == list(actual.uns.get('ion_types', []))
+
+
+def test_chunked_annotation_equals_whole_file_annotation(tmp_path, spectra_files):
+    files, search_results = spectra_files
+    store_dir = tmp_path / 'store'
+    whole = _config(tmp_path / 'whole', search_results)
+    annotate_library(files, whole, store_dir, chunk_psms=0)
+    chunked = _config(tmp_path / 'chunked', search_results)
+    annotate_library(files, chunked, store_dir, chunk_psms=4)
+    # chunks of several files annotated by concurrent workers, in any order
+    parallel = _config(tmp_path / 'parallel', search_results)
+    run_per_file(files, [annotation_step(parallel, store_dir, chunk_psms=7)], 3)
+
+    for conf in [chunked, parallel]:
+        assert sorted(path.name for path in (conf.output / 'data').iterdir()) == ['run_a.mzml.hdf5', 'run_b.mzml.hdf5']
+        assert sorted(path.name for path in (conf.output / 'msms').iterdir()) == ['run_a.rescore', 'run_b.rescore']
+        for spectra_file in files:
+            hdf5_name = spectra_file.with_suffix('.mzml.hdf5').name
+            _assert_same_library(whole.output / 'data' / hdf5_name, conf.output / 'data' / hdf5_name)
+
+
+def _anndata_io():
+    try:
+        import anndata.io as anndata_io
+        anndata_io.write_elem
+    except (ImportError, AttributeError):
+        import anndata.experimental as anndata_io
+    return anndata_io
+
+
+def test_prediction_input_sets_collision_energy_and_keeps_spectra(tmp_path, spectra_files, monkeypatch):
+    files, search_results = spectra_files
+    conf = _config(tmp_path / 'run', search_results)
+    annotate_library(files, conf, tmp_path / 'store')
+    (conf.output / 'results').mkdir()
+    (conf.output / 'results' / 'run_a_ce.txt').write_text('33')
+    data_dir = conf.output / 'data'
+    annotated = Spectra.from_hdf5(data_dir / 'run_a.mzml.hdf5')
+
+    def killed(*args, **kwargs):
+        raise KeyboardInterrupt
+    # the obs table of the copy is already deleted, but not yet written again
+    with monkeypatch.context() as patch:
+        patch.setattr(_anndata_io(), 'write_elem', killed)
+        with pytest.raises(KeyboardInterrupt):
+            generate_pred_file(files[0], conf)
+    # the interrupted call left the annotated library as it was and is simply repeated
+    assert sorted(path.name for path in data_dir.iterdir()) == ['run_a.mzml.hdf5', 'run_b.mzml.hdf5']
+    pd.testing.assert_frame_equal(annotated.obs, Spectra.from_hdf5(data_dir / 'run_a.mzml.hdf5').obs)
+
+    generate_pred_file(files[0], conf)
+    assert sorted(path.name for path in data_dir.iterdir()) == ['run_a.mzml.pred.hdf5', 'run_b.mzml.hdf5']
+    prediction_input = Spectra.from_hdf5(data_dir / 'run_a.mzml.pred.hdf5')
+    assert (prediction_input.obs['COLLISION_ENERGY'] == 33).all()
+    pd.testing.assert_frame_equal(annotated.obs.drop(columns='COLLISION_ENERGY'),
+                                  prediction_input.obs.drop(columns='COLLISION_ENERGY'))
+    pd.testing.assert_frame_equal(annotated.var, prediction_input.var)
+    assert sorted(annotated.layers) == sorted(prediction_input.layers)
+    for layer in annotated.layers:
+        assert (annotated.layers[layer] != prediction_input.layers[layer]).nnz == 0, layer
+
+
+def test_second_run_config_is_written_completely(tmp_path, monkeypatch):
+    # checking the models asks the Koina server
+    monkeypatch.setattr(Config, 'check', lambda self: None)
+    first_output = tmp_path / 'oktoberfest_1_out'
+    for folder, name in [('results', 'run_a_ce.txt'), ('proc', 'ce_calib.run_a.done')]:
+        (first_output / folder).mkdir(parents=True)
+        (first_output / folder / name).write_text('33')
+    config_path = tmp_path / 'config.json'
+    with open(config_path, 'w') as f:
+        json.dump({'type': 'Rescoring', 'output': str(first_output), 'numThreads': 3,
+                   'inputs': {'search_results': str(tmp_path / 'msms'), 'search_results_type': 'Maxquant',
+                              'spectra': str(tmp_path / 'raw'), 'spectra_type': 'raw'},
+                   'models': {'intensity': 'Prosit_2020_intensity_HCD', 'irt': 'Prosit_2019_irt'}}, f)
+
+    prepared = oktoberfest_functions.prepare_second_oktoberfest_run(tmp_path / 'mzml', config_path, tmp_path / 'p10',
+                                                                    tmp_path)
+    # shard workers load the config of the second run from the file instead of preparing it again
+    loaded = oktoberfest_functions.load_second_oktoberfest_run(config_path)
+    assert loaded.output == prepared.output == tmp_path / 'oktoberfest_2_out'
+    assert Path(loaded.inputs['spectra']) == tmp_path / 'mzml'
+    assert Path(loaded.inputs['search_results']) == tmp_path / 'p10'
+    assert loaded.inputs['spectra_type'] == 'mzml'
+    assert (loaded.output / 'results' / 'run_a_ce.txt').read_text() == '33'
@@ -0,0 +1,61 @@
+import random
+import logging
+
+import pytest
+
+pytest.importorskip('picked_group_fdr.digest')
+
+from picked_group_fdr import digest, peptide_protein_map
+from picked_group_fdr import picked_group_fdr
+from picked_group_fdr.digestion_params import get_digestion_params_list
+
+import prosimsit.peptide_index as peptide_index
+from prosimsit.stages import DigestCache
+
+
+@pytest.fixture
+def picked_args(tmp_path):
+    rng = random.Random(1)
+    fasta_file = tmp_path / 'proteome.fasta'
+    with open(fasta_file, 'w') as f:
+        for i in range(200):
+            f.write(f'>sp|P{i:05d}|PROT{i}_HUMAN Protein {i} GN=G{i}\n')
+            # shared stretches so that some peptides belong to several proteins
+            f.write(''.join(rng.choice('ACDEFGHIKLMNPQRSTVWY') for _ in range(300)) + 'SHAREDPEPTIDEK' * (i % 3) + '\n')
+    return picked_group_fdr.parse_args(['--mq_evidence', 'evidence.txt', '--fasta', str(fasta_file),
+                                        '--methods', 'picked_protein_group_mq_input', '--enzyme', 'trypsinp'])
+
+
+def test_index_equals_digested_map(tmp_path, picked_args):
+    params = get_digestion_params_list(picked_args)
+    digested = digest.get_peptide_to_protein_map_from_params(picked_args.fasta, params)
+    index = peptide_index.get_index(tmp_path / 'index', picked_args.fasta, params,
+                                    DigestCache(tmp_path / 'digests.json'))
+
+    assert list(index.to_map().items()) == list(digested.items())
+    assert len(index) == len(digested)
+    for peptide in ['SHAREDPEPTIDEK', *list(digested)[:50]]:
+        assert index.proteins(peptide) == digested[peptide]
+    assert index.proteins('NOTINTHEPROTEOME') == []
+
+
+def test_picked_protein_group_fdr_reads_maps_from_index(tmp_path, picked_args, caplog):
+    params = get_digestion_params_list(picked_args)
+    digested = digest.get_peptide_to_protein_map_from_params(picked_args.fasta, params)
+    original = digest.get_peptide_to_protein_map_from_params
+
+    with caplog.at_level(logging.WARNING):
+        with peptide_index.indexed_digestion(tmp_path / 'index', DigestCache(tmp_path / 'digests.json')):
+            maps = peptide_protein_map.get_peptide_to_protein_maps_from_args(picked_args, False)
+    assert list(maps[0].items()) == list(digested.items())
+    # the index is only built by the patched function
+    assert len(list((tmp_path / 'index').iterdir())) == 1
+    assert digest.get_peptide_to_protein_map_from_params is original
+    assert 'was not used' not in caplog.text
+
+
+def test_unused_index_is_reported(tmp_path, caplog):
+    with caplog.at_level(logging.WARNING):
+        with peptide_index.indexed_digestion(tmp_path / 'index', DigestCache(tmp_path / 'digests.json')):
+            pass
+    assert 'was not used' in caplog.text
@@ -0,0 +1,64 @@
+import copy
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from prosimsit.prediction_cache import CachedPredictionInterface, PredictionCache, cached_predictions
+
+MODEL = 'Prosit_2020_intensity_TMT'
+
+
+class _Predictor:
+    model_inputs = {'peptide_sequences': ([-1, 1], 'BYTES')}
+
+    def __init__(self):
+        self.batch_size = 100
+
+
+def _inputs(sequences):
+    return pd.DataFrame({'MODIFIED_SEQUENCE': sequences, 'PRECURSOR_CHARGE': 2, 'COLLISION_ENERGY': 30.0,
+                         'FRAGMENTATION': 'HCD'})
+
+
+def test_wrapper_can_be_copied_and_pickled(tmp_path):
+    wrapper = CachedPredictionInterface(_Predictor(), MODEL, PredictionCache(tmp_path / 'cache.sqlite'))
+    for clone in [copy.copy(wrapper), copy.deepcopy(wrapper), pickle.loads(pickle.dumps(wrapper))]:
+        assert clone.model_name == MODEL
+        assert clone.batch_size == 100
+    empty = CachedPredictionInterface.__new__(CachedPredictionInterface)
+    with pytest.raises(AttributeError):
+        empty.batch_size
+
+
+def test_cached_predictions_equal_uncached_and_only_request_missing_peptides(koina_standin, tmp_path):
+    from prosimsit.prediction_client import AsyncKoina
+
+    service, address = koina_standin()
+    first = _inputs(['PEPTIDEK', 'AAAK', 'PEPTIDEK', 'M[UNIMOD:35]K'])
+    second = _inputs(['AAAK', 'LLLLK', 'PEPTIDEK', 'LLLLK', 'CCK'])
+    uncached = AsyncKoina(MODEL, address, ssl=False).predict(pd.concat([first, second], ignore_index=True))
+
+    cached = CachedPredictionInterface(AsyncKoina(MODEL, address, ssl=False), MODEL,
+                                       PredictionCache(tmp_path / 'cache.sqlite'))
+    requested = service.peptides
+    first_outputs = cached.predict(first)
+    assert service.peptides - requested == 3
+    second_outputs = cached.predict(second)
+    assert service.peptides - requested == 5
+
+    for name, array in uncached.items():
+        assert np.array_equal(np.concatenate([first_outputs[name], second_outputs[name]]), array), name
+
+
+def test_cached_predictions_wraps_predictors_of_oktoberfest(koina_standin, tmp_path):
+    predict = pytest.importorskip('oktoberfest.predict')
+
+    _, address = koina_standin()
+    config = SimpleNamespace(models={'intensity': MODEL}, prediction_server=address, ssl=False)
+    with cached_predictions(PredictionCache(tmp_path / 'cache.sqlite')):
+        predictor = predict.Predictor.from_config(config, 'intensity')
+    assert isinstance(predictor._predictor, CachedPredictionInterface)
+    assert not isinstance(predict.Predictor.from_config(config, 'intensity')._predictor, CachedPredictionInterface)
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from prosimsit.prediction_client import DATATYPES, MIN_BATCH_SIZE, AsyncKoina, async_predictions
+
+MODEL = 'Prosit_2020_intensity_TMT'
+
+
+def _inputs(n_peptides):
+    return pd.DataFrame({'MODIFIED_SEQUENCE': [f'PEPTIDE{i}K' for i in range(n_peptides)],
+                         'PRECURSOR_CHARGE': np.arange(n_peptides) % 3 + 2,
+                         'COLLISION_ENERGY': 25.0 + np.arange(n_peptides) % 10,
+                         'FRAGMENTATION': 'HCD'})
+
+
+def _expected(client, data):
+    import prosimsit.koina_standin as koina_standin
+
+    inputs = {name: array.astype(DATATYPES[datatype])
+              for (name, (_, datatype)), array in zip(client.model_inputs.items(),
+                                                      client._input_arrays(data).values())}
+    return koina_standin.predict(MODEL, inputs)
+
+
+def _assert_outputs_equal(expected, actual):
+    assert sorted(expected) == sorted(actual)
+    for name, array in expected.items():
+        # BYTES outputs arrive as bytes, the stand-in predicts them as str
+        assert np.array_equal(array.astype(str), actual[name].astype(str)), name
+
+
+def test_predictions_keep_row_order_despite_latency_and_failures(koina_standin):
+    service, address = koina_standin(latency_seconds=0.02, failure_rate=0.3, max_batch_size=40, seed=1)
+    client = AsyncKoina(MODEL, address, ssl=False, max_in_flight=4, max_retries=20, backoff_seconds=0.001)
+    data = _inputs(500)
+    outputs = client.predict(data)
+
+    _assert_outputs_equal(_expected(client, data), outputs)
+    # failed requests are retried, and every peptide is predicted exactly once
+    assert service.peptides == len(data)
+    assert service.requests > len(data) / 40
+    assert 1 < service.max_in_flight <= 4
+    assert MIN_BATCH_SIZE <= client.batch_size <= 40
+
+
+def test_streamed_batches_cover_every_row_once(koina_standin):
+    service, address = koina_standin(latency_seconds=0.01, max_batch_size=32)
+    client = AsyncKoina(MODEL, address, ssl=False, max_in_flight=3)
+    data = _inputs(200)
+    batches = []
+    client.predict_streaming(data, lambda start, stop, outputs: batches.append((start, stop, outputs)))
+
+    batches.sort(key=lambda batch: batch[0])
+    assert [start for start, _, _ in batches] == [0] + [stop for _, stop, _ in batches[:-1]]
+    assert batches[-1][1] == len(data)
+    assert all(stop - start <= 32 for start, stop, _ in batches)
+    _assert_outputs_equal(_expected(client, data),
+                          {name: np.concatenate([outputs[name] for _, _, outputs in batches])
+                           for name in client.model_outputs})
+
+
+def test_batch_size_adapts_to_latency(koina_standin):
+    _, address = koina_standin(latency_seconds=0.02, max_batch_size=512)
+    slow = AsyncKoina(MODEL, address, ssl=False, max_in_flight=1, target_request_seconds=0.001)
+    slow.predict(_inputs(1000))
+    assert slow.batch_size == MIN_BATCH_SIZE
+
+    fast = AsyncKoina(MODEL, address, ssl=False, max_in_flight=1, target_request_seconds=60)
+    fast.predict(_inputs(1000))
+    assert fast.batch_size == 512
+
+
+def test_failures_raise_once_retries_are_exhausted(koina_standin):
+    from tritonclient.utils import InferenceServerException
+
+    service, address = koina_standin(failure_rate=1.0)
+    client = AsyncKoina(MODEL, address, ssl=False, max_in_flight=1, max_retries=2, backoff_seconds=0.001)
+    with pytest.raises(InferenceServerException):
+        client.predict(_inputs(10))
+    assert service.requests == 3
+
+
+def test_non_retryable_failures_raise_immediately(koina_standin):
+    from tritonclient.utils import InferenceServerException
+
+    service, address = koina_standin(max_batch_size=20)
+    client = AsyncKoina(MODEL, address, ssl=False, max_in_flight=1, backoff_seconds=0.001)
+    # the stand-in rejects batches beyond the maximum batch size as INVALID_ARGUMENT
+    client.batch_size = 50
+    with pytest.raises(InferenceServerException):
+        client.predict(_inputs(50))
+    assert service.requests == 1
+
+
+def test_predictions_equal_those_of_oktoberfest_client(koina_standin):
+    koina = pytest.importorskip('oktoberfest.predict.koina')
+
+    _, address = koina_standin(latency_seconds=0.01, max_batch_size=64)
+    data = _inputs(300)
+    expected = koina.Koina(MODEL, address, ssl=False).predict(data, disable_progress_bar=True)
+    actual = AsyncKoina(MODEL, address, ssl=False, max_in_flight=4).predict(data)
+    assert sorted(expected) == sorted(actual)
+    for name, array in expected.items():
+        assert array.dtype == actual[name].dtype, name
+        assert np.array_equal(array, actual[name]), name
+
+
+def test_async_predictions_replaces_oktoberfest_client_only_inside_context(koina_standin):
+    predict = pytest.importorskip('oktoberfest.predict')
+
+    _, address = koina_standin()
+    conf = pytest.importorskip('oktoberfest.utils').Config()
+    conf.data = {'predictionClient': {'type': 'async', 'maxRequestsInFlight': 3}}
+    with async_predictions(conf):
+        predictor = predict.Predictor.from_koina(MODEL, address, ssl=False)
+    assert isinstance(predictor._predictor, AsyncKoina)
+    assert predictor._predictor.max_in_flight == 3
+    assert predictor.model_name == MODEL
+    assert not isinstance(predict.Predictor.from_koina(MODEL, address, ssl=False)._predictor, AsyncKoina)
@@ -0,0 +1,39 @@
+import sys
+import subprocess
+
+import pytest
+
+import prosimsit.raw as raw
+
+
+def _converter(path, content):
+    path.mkdir(parents=True, exist_ok=True)
+    (path / 'ThermoRawFileParser.exe').write_bytes(content)
+    (path / 'ThermoFisher.CommonCore.RawFileReader.dll').write_bytes(b'reader')
+    return path
+
+
+def test_converter_version_follows_converter_binary(tmp_path):
+    old = _converter(tmp_path / 'old', b'1.4.2')
+    same = _converter(tmp_path / 'same', b'1.4.2')
+    new = _converter(tmp_path / 'new', b'1.4.3')
+    assert raw.converter_version(old) == raw.converter_version(same)
+    assert raw.converter_version(old) != raw.converter_version(new)
+
+
+def test_converter_version_of_shipped_converter():
+    assert raw.converter_version().startswith('ThermoRawFileParser sha256:')
+
+
+@pytest.mark.skipif(raw.fcntl is None, reason='requires fcntl')
+def test_manifest_is_locked_across_processes(tmp_path):
+    manifest_path = tmp_path / raw.MANIFEST_FILE
+    # another process, e.g. a shard worker converting the raw files of its shard into the same folder
+    worker = [sys.executable, '-c', 'import sys; from pathlib import Path; import prosimsit.raw as raw\n'
+              'with raw.locked_manifest(Path(sys.argv[1])): print("locked", flush=True)', str(manifest_path)]
+    with raw.locked_manifest(manifest_path):
+        other = subprocess.Popen(worker, stdout=subprocess.PIPE, text=True)
+        with pytest.raises(subprocess.TimeoutExpired):
+            other.wait(timeout=2)
+    assert other.communicate(timeout=60)[0] == 'locked\n'
+    assert other.returncode == 0
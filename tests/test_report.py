@@ -0,0 +1,70 @@
+import sys
+import threading
+import subprocess
+
+import pytest
+
+import prosimsit.report as report
+from prosimsit.report import RunReport
+
+
+def _stages(run_report):
+    return {stage['name']: stage for stage in run_report.report['stages']}
+
+
+@report.step
+def _helper():
+    pass
+
+
+def test_overlapping_stages_are_marked_as_shared():
+    run_report = RunReport()
+    both_running = threading.Barrier(2)
+
+    def run(name):
+        with run_report.stage(name):
+            both_running.wait(timeout=10)
+            _helper()
+            both_running.wait(timeout=10)
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ['first', 'second']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with run_report.stage('alone'):
+        _helper()
+
+    stages = _stages(run_report)
+    for name in ['first', 'second']:
+        assert stages[name]['cpu_time_scope'] == 'shared'
+        assert stages[name]['peak_rss_scope'] in ['shared', 'process']
+        assert stages[name]['steps'][0]['cpu_time_scope'] == 'shared'
+    # a step only overlaps with the stage it is called from
+    assert stages['alone']['cpu_time_scope'] == 'measurement'
+    assert stages['alone']['steps'][0]['cpu_time_scope'] == 'measurement'
+    assert stages['alone']['peak_rss_scope'] in ['measurement', 'process']
+
+
+def _run_child(size_mb):
+    subprocess.run([sys.executable, '-c', f'b = bytearray({int(size_mb)} * 1024 ** 2)'], check=True)
+
+
+@pytest.mark.skipif(report.resource is None, reason='requires the resource module')
+def test_children_peak_is_reported_by_stages_raising_it():
+    run_report = RunReport()
+    # child processes of earlier tests may have used any amount of memory
+    earlier_peak = report._children_peak_rss_mb()
+    with run_report.stage('large_child'):
+        _run_child(earlier_peak + 100)
+    with run_report.stage('small_child'):
+        _run_child(1)
+    with run_report.stage('no_child'):
+        pass
+    run_report.finish()
+
+    stages = _stages(run_report)
+    assert stages['large_child']['children_peak_rss_mb'] >= earlier_peak + 100
+    assert stages['small_child']['children_peak_rss_mb'] is None
+    assert stages['no_child']['children_peak_rss_mb'] is None
+    assert run_report.report['children_peak_rss_mb'] == stages['large_child']['children_peak_rss_mb']
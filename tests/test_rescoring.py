@@ -0,0 +1,122 @@
+import shutil
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import prosimsit.synthetic as synthetic
+from prosimsit.rescoring import qvalues_and_peps, read_weights, rescore_static
+
+FEATURES = ['spectral_angle', 'delta_score', 'abs_rt_diff']
+# both engines estimate q-values the same way, (decoys + 1) / targets after target-decoy competition, so they only
+# differ by the precision Percolator writes them with
+QVALUE_TOLERANCE = 1e-4
+# Percolator fits PEPs with a spline, rescore_static by isotonic regression of the decoy rate
+PEP_TOLERANCE = 0.05
+
+
+def _write_weights(path, folds):
+    with open(path, 'w') as f:
+        f.write('# first line contains normalized weights, second line the raw weights\n')
+        for weights in folds:
+            f.write('\t'.join(FEATURES + ['m0']) + '\n')
+            f.write('\t'.join(str(w) for w in weights) + '\n')
+            f.write('\t'.join(str(w * 2) for w in weights) + '\n')
+
+
+def test_read_weights_reads_normalized_weights_of_first_fold(tmp_path):
+    _write_weights(tmp_path / 'weights.csv', [[2.5, -0.25, 0.125, -1.0], [9.0, 9.0, 9.0, 9.0]])
+    weights = read_weights(tmp_path / 'weights.csv')
+    pd.testing.assert_series_equal(weights, pd.Series([2.5, -0.25, 0.125, -1.0], index=FEATURES + ['m0']))
+
+
+def test_read_weights_rejects_other_files(tmp_path):
+    (tmp_path / 'no_bias.csv').write_text('\t'.join(FEATURES) + '\n1\t2\t3\n')
+    (tmp_path / 'truncated.csv').write_text('\t'.join(FEATURES + ['m0']) + '\n1\t2\t3\n')
+    for name in ['no_bias.csv', 'truncated.csv']:
+        with pytest.raises(ValueError, match='Percolator weights'):
+            read_weights(tmp_path / name)
+
+
+def _naive_qvalues(scores, is_decoy):
+    # (decoys + 1) / targets at or above each score, made monotone by taking the minimum over all lower thresholds
+    fdr = np.array([min((np.sum(is_decoy & (scores >= s)) + 1) / max(np.sum(~is_decoy & (scores >= s)), 1), 1.0)
+                    for s in scores])
+    return np.array([fdr[scores <= s].min() for s in scores])
+
+
+def test_qvalues_and_peps():
+    scores = np.array([5.0, 4.0, 3.0, 2.0, 1.0])
+    is_decoy = np.array([False, False, True, False, True])
+    qvalues, peps = qvalues_and_peps(scores, is_decoy)
+    np.testing.assert_allclose(qvalues, [0.5, 0.5, 2 / 3, 2 / 3, 1.0])
+    assert (np.diff(peps) >= 0).all() and peps[0] == 0 and peps[-1] == 1
+
+
+def test_qvalues_and_peps_of_tied_scores():
+    rng = np.random.default_rng(0)
+    scores = -np.sort(-rng.integers(0, 20, 500).astype(np.float64))
+    is_decoy = rng.random(500) < 0.3 * (20 - scores) / 20
+    qvalues, peps = qvalues_and_peps(scores, is_decoy)
+    np.testing.assert_allclose(qvalues, _naive_qvalues(scores, is_decoy))
+    # PSMs with equal scores get equal estimates, whatever the order of targets and decoys among them
+    for score in np.unique(scores):
+        assert len(np.unique(qvalues[scores == score])) == 1
+        assert len(np.unique(peps[scores == score])) == 1
+    permuted = np.concatenate([rng.permutation(is_decoy[scores == score]) for score in -np.unique(-scores)])
+    for expected, actual in zip([qvalues, peps], qvalues_and_peps(scores, permuted)):
+        np.testing.assert_allclose(actual, expected)
+    assert (np.diff(peps) >= 0).all() and ((peps >= 0) & (peps <= 1)).all()
+
+
+def test_qvalues_and_peps_without_targets_or_psms():
+    qvalues, peps = qvalues_and_peps(np.array([3.0, 2.0, 2.0]), np.ones(3, dtype=bool))
+    np.testing.assert_array_equal(qvalues, [1.0, 1.0, 1.0])
+    np.testing.assert_array_equal(peps, [1.0, 1.0, 1.0])
+
+    qvalues, peps = qvalues_and_peps(np.array([3.0, 2.0, 2.0]), np.zeros(3, dtype=bool))
+    np.testing.assert_array_equal(peps, [0.0, 0.0, 0.0])
+
+    qvalues, peps = qvalues_and_peps(np.array([], dtype=np.float64), np.array([], dtype=bool))
+    assert len(qvalues) == 0 and len(peps) == 0
+
+
+def _read_results(path):
+    return pd.read_csv(path, sep='\t', usecols=['PSMId', 'q-value', 'posterior_error_prob', 'peptide'])
+
+
+@pytest.mark.skipif(shutil.which('percolator') is None, reason='requires Percolator')
+def test_rescore_static_agrees_with_percolator(tmp_path):
+    dataset = synthetic.generate_dataset(tmp_path / 'dataset', n_psms=20_000, n_raw_files=2)
+    tab = dataset.ok1_percolator / 'rescore.tab'
+    weights = dataset.ok1_percolator / 'rescore.percolator.weights.csv'
+    results = {}
+    for engine in ['percolator', 'prosimsit']:
+        output_dir = tmp_path / engine
+        output_dir.mkdir()
+        paths = [output_dir / f'rescore.{name}.txt' for name in ['psms', 'decoy.psms', 'peptides', 'decoy.peptides']]
+        if engine == 'percolator':
+            # the command of the percolator stage in main.build_pipeline
+            subprocess.run(['percolator', '--init-weights', str(weights), '--static', '--subset-max-train', '500000',
+                            '--post-processing-tdc', '--testFDR', '0.01', '--trainFDR', '0.01',
+                            '--results-psms', str(paths[0]), '--decoy-results-psms', str(paths[1]),
+                            '--results-peptides', str(paths[2]), '--decoy-results-peptides', str(paths[3]),
+                            str(tab)], check=True, stderr=subprocess.DEVNULL)
+        else:
+            rescore_static(tab, weights, *paths, test_fdr=0.01)
+        results[engine] = [_read_results(path) for path in paths]
+
+    for level, index in [('PSMs', 0), ('peptides', 2)]:
+        expected, actual = results['percolator'][index], results['prosimsit'][index]
+        assert (actual['q-value'] <= 0.01).sum() == (expected['q-value'] <= 0.01).sum(), level
+        assert (actual['q-value'] <= 0.01).sum() > 0, level
+        key = 'PSMId' if level == 'PSMs' else 'peptide'
+        merged = expected.merge(actual, on=key, suffixes=('_percolator', '_prosimsit'), validate='one_to_one')
+        assert len(merged) == len(expected) == len(actual), level
+        np.testing.assert_allclose(merged['q-value_prosimsit'], merged['q-value_percolator'], atol=QVALUE_TOLERANCE,
+                                   err_msg=level)
+        identified = merged['q-value_percolator'] <= 0.01
+        np.testing.assert_allclose(merged.loc[identified, 'posterior_error_prob_prosimsit'],
+                                   merged.loc[identified, 'posterior_error_prob_percolator'], atol=PEP_TOLERANCE,
+                                   err_msg=level)
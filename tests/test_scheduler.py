@@ -0,0 +1,73 @@
+import os
+import time
+from pathlib import Path
+
+from prosimsit.scheduler import Allocation, FileStep, Footprint, ResourceBudget, run_per_file
+
+
+def _record(target, log_dir, step_name):
+    start = time.time()
+    time.sleep(0.05)
+    (Path(log_dir) / f'{step_name}-{Path(str(target)).name}-{os.getpid()}-{start}').write_text(f'{start} {time.time()}')
+
+
+def _convert(spectra_file, log_dir):
+    _record(spectra_file, log_dir, 'convert')
+
+
+def _annotate(spectra_file, log_dir):
+    _record(spectra_file, log_dir, 'annotate')
+
+
+def _annotation_units(spectra_file, log_dir):
+    return [Path(f'{spectra_file}.chunk_{number}') for number in range(3)]
+
+
+def _assemble(spectra_file, log_dir):
+    _record(spectra_file, log_dir, 'assemble')
+
+
+def _intervals(log_dir):
+    return [tuple(map(float, f.read_text().split())) for f in Path(log_dir).iterdir()]
+
+
+def _max_overlap(intervals):
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+def test_run_per_file_caps_processes_and_threads_together(tmp_path):
+    spectra_files = [tmp_path / f'file{i}.mzML' for i in range(8)]
+    steps = [FileStep('Conversion', _convert, (str(tmp_path / 'log'),), executor='thread'),
+             FileStep('Annotation', _annotate, (str(tmp_path / 'log'),), executor='process')]
+    (tmp_path / 'log').mkdir()
+    run_per_file(spectra_files, steps, num_workers=2)
+
+    intervals = _intervals(tmp_path / 'log')
+    assert len(intervals) == 2 * len(spectra_files)
+    assert _max_overlap(intervals) <= 2
+
+
+def test_run_per_file_caps_chunk_units_with_whole_file_tasks(tmp_path):
+    spectra_files = [tmp_path / f'file{i}.mzML' for i in range(4)]
+    steps = [FileStep('Conversion', _convert, (str(tmp_path / 'log'),), executor='thread'),
+             FileStep('Annotation', _annotate, (str(tmp_path / 'log'),), chunks=_annotation_units, assemble=_assemble)]
+    (tmp_path / 'log').mkdir()
+    run_per_file(spectra_files, steps, num_workers=2)
+
+    intervals = _intervals(tmp_path / 'log')
+    assert len(intervals) == 5 * len(spectra_files)
+    assert _max_overlap(intervals) <= 2
+
+
+def test_allocation_fits_into_budget():
+    budget = ResourceBudget(cores=8, memory_mb=10000)
+    allocation = budget.try_allocate(Footprint(cores=1, memory_mb=4000, max_tasks=None))
+    assert allocation == Allocation(tasks=2, cores=2, memory_mb=8000)
+    assert budget.try_allocate(Footprint(cores=1, memory_mb=4000, max_tasks=None)) is None
+    budget.release(allocation)
+    assert budget.free_cores == 8 and budget.free_memory_mb == 10000
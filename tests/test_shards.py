@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+import prosimsit
+import prosimsit.shards as shards
+import prosimsit.stages as stages
+import prosimsit.synthetic as synthetic
+import prosimsit.utils as utils
+from prosimsit.io import atomic_path
+from prosimsit.maxquant import MaxQuantTables
+
+# The Oktoberfest runs need spectra, which the synthetic dataset does not have. These stand-ins follow the same
+# protocol: per-raw-file work that marks each file as done, so that the stage run after the shard workers only does
+# the global work, followed by the real merge of the rescore files of both runs.
+
+
+def _process_files(stage_name, raw_files, output_dir, write, processed_by):
+    for raw_file in raw_files:
+        done = output_dir / stage_name / 'proc' / f'{raw_file}.done'
+        if done.is_file():
+            continue
+        write(raw_file)
+        # fails if a raw file is processed twice, e.g. by a shard worker and again by the stage itself
+        with open(output_dir / 'processed' / stage_name / raw_file, 'x') as f:
+            f.write(processed_by)
+        done.touch()
+
+
+def build_pipeline(dataset_dir: Path, output_dir: Path):
+    dataset = synthetic.SyntheticDataset(dataset_dir, [], 0)
+    pipeline = stages.Pipeline(output_dir)
+    maxquant_tables = MaxQuantTables(dataset.maxquant_dir, pipeline.state_dir / 'maxquant', pipeline.digests)
+    raw_files = sorted(set(maxquant_tables.read('msms', columns=['Raw file'])['Raw file']))
+    ok1_out, ok2_out = output_dir / 'oktoberfest_1', output_dir / 'oktoberfest_2'
+
+    def prepare(stage_name):
+        for folder in [output_dir / stage_name / 'proc', output_dir / 'processed' / stage_name]:
+            folder.mkdir(parents=True, exist_ok=True)
+
+    def prepare_first():
+        prepare('oktoberfest_1')
+        (ok1_out / 'files').mkdir(exist_ok=True)
+
+    def write_first(raw_file):
+        tab = pd.read_csv(dataset.ok1_percolator / 'rescore.tab', sep='\t')
+        with atomic_path(ok1_out / 'files' / f'{raw_file}.tab') as tmp_path:
+            tab[tab['filename'] == raw_file].to_csv(tmp_path, sep='\t', index=False)
+
+    def run_first_shard(shard_raw_files, allocation):
+        _process_files('oktoberfest_1', shard_raw_files, output_dir, write_first, 'shard')
+
+    def run_first(allocation):
+        prepare_first()
+        _process_files('oktoberfest_1', raw_files, output_dir, write_first, 'stage')
+        tabs = [pd.read_csv(ok1_out / 'files' / f'{raw_file}.tab', sep='\t') for raw_file in raw_files]
+        pd.concat(tabs).to_csv(ok1_out / 'rescore.tab', sep='\t', index=False)
+
+    pipeline.add(stages.Stage(
+        name='oktoberfest_1',
+        run=run_first,
+        inputs=[dataset.ok1_percolator / 'rescore.tab'],
+        outputs=[ok1_out / 'rescore.tab'],
+        workdir=ok1_out,
+        prepare_shards=prepare_first,
+        run_shard=run_first_shard))
+
+    def write_second(raw_file):
+        tab = pd.read_csv(dataset.ok2_percolator / f'{raw_file}.rescore.tab', sep='\t')
+        with atomic_path(ok2_out / f'{raw_file}.rescore.tab') as tmp_path:
+            tab.sort_values('ScanNr', kind='stable').to_csv(tmp_path, sep='\t', index=False)
+
+    def run_second_shard(shard_raw_files, allocation):
+        _process_files('oktoberfest_2', shard_raw_files, output_dir, write_second, 'shard')
+
+    def run_second(allocation):
+        prepare('oktoberfest_2')
+        _process_files('oktoberfest_2', raw_files, output_dir, write_second, 'stage')
+
+    pipeline.add(stages.Stage(
+        name='oktoberfest_2',
+        run=run_second,
+        inputs=[ok1_out / 'rescore.tab', dataset.ok2_percolator],
+        outputs=[ok2_out],
+        depends_on=['oktoberfest_1'],
+        workdir=ok2_out,
+        prepare_shards=lambda: prepare('oktoberfest_2'),
+        run_shard=run_second_shard))
+
+    pipeline.add(stages.Stage(
+        name='merge_rescore',
+        run=lambda allocation: utils.merge_rescore_files(ok1_out, ok2_out, output_dir / 'rescore_all.tab'),
+        inputs=[ok1_out / 'rescore.tab', ok2_out],
+        outputs=[output_dir / 'rescore_all.tab'],
+        depends_on=['oktoberfest_2']))
+    return pipeline, maxquant_tables
+
+
+def main(argv):
+    """
+    Command line of the stand-in pipeline with the stage and shard options of ProSIMSIt, run by shards.launch_local
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset_dir', type=Path)
+    parser.add_argument('output_dir', type=Path)
+    parser.add_argument('--until-stage')
+    parser.add_argument('--plan-shards', type=int)
+    parser.add_argument('--shard', type=int)
+    parser.add_argument('--shard-stage')
+    args = parser.parse_args(argv)
+    pipeline, maxquant_tables = build_pipeline(args.dataset_dir, args.output_dir)
+    if args.plan_shards is not None:
+        shards.prepare_shards(pipeline, args.shard_stage, maxquant_tables, args.plan_shards)
+    elif args.shard is not None:
+        shards.run_shard(pipeline, args.shard_stage, args.shard)
+    else:
+        pipeline.run(until_stage=args.until_stage)
+
+
+def test_launch_local_equals_unsharded_run(tmp_path, monkeypatch):
+    # the launched commands run this file as a script
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(
+        [str(Path(prosimsit.__file__).parents[1])] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    # three TMT batches of two raw files, one of which has a hyphenated name
+    dataset = synthetic.generate_dataset(tmp_path / 'dataset', n_psms=3000, n_raw_files=6, raw_files_per_batch=2,
+                                         hyphenated_fraction=0.2)
+    unsharded, sharded = tmp_path / 'unsharded', tmp_path / 'sharded'
+    build_pipeline(dataset.root, unsharded)[0].run()
+    pipeline, _ = build_pipeline(dataset.root, sharded)
+    shards.launch_local(pipeline, None, 2, command=[sys.executable, __file__, str(dataset.root), str(sharded)])
+
+    for stage_name in ['oktoberfest_1', 'oktoberfest_2']:
+        with open(shards.plan_path(pipeline, stage_name), 'r') as f:
+            plan = json.load(f)['shards']
+        assert len(plan) == 2
+        assert sorted(raw_file for shard in plan for raw_file in shard['raw_files']) == sorted(dataset.raw_files)
+        # every raw file was processed exactly once in both runs, by the shard workers in the sharded run
+        for output_dir, processed_by in [(unsharded, 'stage'), (sharded, 'shard')]:
+            processed = {p.name: p.read_text() for p in (output_dir / 'processed' / stage_name).iterdir()}
+            assert processed == {raw_file: processed_by for raw_file in dataset.raw_files}
+
+    outputs = [Path('oktoberfest_1/rescore.tab'), Path('rescore_all.tab')] + [
+        Path('oktoberfest_2') / f'{raw_file}.rescore.tab' for raw_file in dataset.raw_files]
+    for output in outputs:
+        assert (sharded / output).read_bytes() == (unsharded / output).read_bytes(), output
+    for stage_name in ['oktoberfest_1', 'oktoberfest_2', 'merge_rescore']:
+        assert pipeline.is_up_to_date(pipeline.stages[stage_name])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
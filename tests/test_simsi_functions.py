@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('simsi_transfer.evidence')
+
+from simsi_transfer import evidence
+
+import prosimsit.simsi_functions as simsi_functions
+from prosimsit.io import read_table, write_table
+from prosimsit.maxquant import MaxQuantTables
+from prosimsit.stages import DigestCache
+
+PLEX = 6
+# raw files of several experiments and fractions, one without precursors in evidence.txt and one only in evidence.txt
+RAW_FILES = [f'exp{experiment}_f{fraction}' for experiment in range(3) for fraction in range(1, 4)] + [
+    'lonely', 'noevidence']
+
+
+def _experiment(raw_file):
+    return raw_file.split('_')[0]
+
+
+def _fraction(raw_file):
+    return int(raw_file.split('_f')[1]) if '_f' in raw_file else 1
+
+
+def _write_maxquant_tables(txt_dir, peptides, rng):
+    txt_dir.mkdir(parents=True)
+    raw_files = RAW_FILES + ['extra']
+    pd.DataFrame({'Raw file': raw_files + ['Total'], 'Experiment': [_experiment(r) for r in raw_files] + [''],
+                  'Fraction': [_fraction(r) for r in raw_files] + [np.nan]}).to_csv(
+        txt_dir / 'summary.txt', sep='\t', index=False)
+    pd.DataFrame(columns=['Raw file'] + [f'Reporter intensity {i}' for i in range(1, PLEX + 1)]).to_csv(
+        txt_dir / 'msms.txt', sep='\t', index=False)
+
+    rows = []
+    for raw_file in raw_files:
+        if raw_file in ['lonely', 'noevidence']:
+            continue
+        for peptide in rng.choice(peptides, 120, replace=False):
+            for charge in rng.choice([2, 3], rng.integers(1, 3), replace=False):
+                rt = rng.uniform(10, 100)
+                rows.append({'Sequence': peptide, 'Modified sequence': f'_{peptide}_', 'Leading proteins': 'P1',
+                             'Raw file': raw_file, 'Experiment': _experiment(raw_file),
+                             'Fraction': _fraction(raw_file), 'Charge': charge, 'Calibrated retention time': rt,
+                             'Retention time': rt, 'Retention length': 0.5,
+                             'Calibrated retention time start': rt - rng.uniform(0, 1),
+                             'Calibrated retention time finish': rt + rng.uniform(0, 1),
+                             'Retention time calibration': 0.0,
+                             'Type': rng.choice(['MULTI-MSMS', 'MULTI-MATCH', 'MSMS']),
+                             'Intensity': rng.uniform(1e5, 1e7), 'Reverse': rng.choice(['', '+'], p=[0.9, 0.1])})
+    pd.DataFrame(rows).sample(frac=1, random_state=1).to_csv(txt_dir / 'evidence.txt', sep='\t', index=False)
+
+    n = 4000
+    all_peptides = pd.DataFrame({'Raw file': rng.choice(RAW_FILES, n), 'Type': 'MULTI', 'Charge': rng.choice([2, 3], n),
+                                 'm/z': rng.uniform(400, 1200, n), 'Retention time': rng.uniform(10, 100, n),
+                                 'Retention length': 0.5, 'Min scan number': rng.integers(0, 10000, n),
+                                 'Intensity': rng.uniform(1e4, 1e6, n)})
+    all_peptides['Max scan number'] = all_peptides['Min scan number'] + rng.integers(0, 1000, n)
+    all_peptides.to_csv(txt_dir / 'allPeptides.txt', sep='\t', index=False)
+
+
+def _merged_msms(peptides, n, rng):
+    raw_files = rng.choice(RAW_FILES, n)
+    sequences = rng.choice(peptides, n)
+    msms = pd.DataFrame({
+        'Raw file': raw_files, 'scanID': rng.integers(1, 10000, n), 'Sequence': sequences,
+        'Length': [len(sequence) for sequence in sequences], 'Modifications': 'Unmodified',
+        'Modified sequence': [f'_{sequence}_' for sequence in sequences], 'Missed cleavages': rng.integers(0, 3, n),
+        'Proteins': rng.choice(['P1', 'P2;CON__X'], n), 'Gene Names': 'G', 'Protein Names': 'N',
+        'Charge': rng.choice([2, 3], n), 'm/z': rng.uniform(400, 1200, n), 'Mass': rng.uniform(800, 3000, n),
+        'Mass error [ppm]': rng.normal(0, 2, n), 'Retention time': rng.uniform(10, 100, n),
+        'PEP': rng.uniform(0, 0.1, n), 'Score': rng.uniform(50, 200, n), 'Delta score': rng.uniform(0, 50, n),
+        'Reverse': rng.choice([np.nan, '+'], n, p=[0.9, 0.1]), 'identification': rng.choice(['d', 't'], n),
+        'MS scan number': rng.integers(0, 11000, n).astype(float),
+        'Experiment': [_experiment(r) for r in raw_files], 'Fraction': [_fraction(r) for r in raw_files]})
+    for i in range(1, PLEX + 1):
+        msms[f'Reporter intensity corrected {i}'] = rng.uniform(0, 1e5, n)
+        msms[f'Reporter intensity {i}'] = np.where(rng.random(n) < 0.1, 0, rng.uniform(0, 1e5, n))
+    msms['summary_ID'] = rng.permutation(n)
+    msms['posterior_error_prob'] = rng.uniform(0, 1, n)
+    return msms
+
+
+@pytest.fixture
+def simsi_search(tmp_path):
+    rng = np.random.default_rng(0)
+    peptides = [''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), rng.integers(7, 15))) for _ in range(300)]
+    _write_maxquant_tables(tmp_path / 'txt', peptides, rng)
+    write_table(_merged_msms(peptides, 1500, rng), tmp_path / 'merged_msms.txt')
+    return tmp_path / 'merged_msms.txt', MaxQuantTables(tmp_path / 'txt', tmp_path / 'cache',
+                                                         DigestCache(tmp_path / 'digests.json'))
+
+
+def test_partitioned_evidence_equals_serial_simsi_transfer(tmp_path, simsi_search):
+    merged_msms, maxquant_tables = simsi_search
+    expected = evidence.build_evidence(read_table(merged_msms), maxquant_tables.read('evidence'),
+                                       maxquant_tables.read('allPeptides'), PLEX)
+    (tmp_path / 'reference').mkdir()
+    write_table(expected, tmp_path / 'reference' / 'evidence.txt', schema={}, na_rep='NaN')
+    assert len(expected) > 0
+
+    for threads in [1, 3]:
+        output_folder = tmp_path / f'threads{threads}'
+        output_folder.mkdir()
+        simsi_functions.build_evidence(merged_msms, maxquant_tables, output_folder, threads=threads)
+        assert (output_folder / 'evidence.txt').read_text() == (tmp_path / 'reference' / 'evidence.txt').read_text()
+
+
+def test_duplicate_summary_ids_are_rejected(tmp_path, simsi_search):
+    merged_msms, maxquant_tables = simsi_search
+    msms = read_table(merged_msms)
+    # a PSM of another raw file with the same summary_ID ends up in another partition
+    duplicate = msms.loc[msms['Raw file'] == 'exp0_f1', 'summary_ID'].iloc[0]
+    msms.loc[msms.index[msms['Raw file'] == 'exp2_f3'][0], 'summary_ID'] = duplicate
+    write_table(msms, merged_msms)
+    with pytest.raises(ValueError, match='summary_ID'):
+        simsi_functions.build_evidence(merged_msms, maxquant_tables, tmp_path, threads=1)
@@ -0,0 +1,187 @@
+import base64
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyteomics.mzml')
+pytest.importorskip('spectrum_io.raw')
+
+from prosimsit.spectrum_store import SpectrumStore, build_store, read_mzml
+
+MZML = """<?xml version="1.0" encoding="utf-8"?>
+<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">
+  <cvList count="1">
+    <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" version="4.1.0"
+        URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>
+  </cvList>
+  <fileDescription>
+    <fileContent>
+      <cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum" value=""/>
+    </fileContent>
+  </fileDescription>
+  <referenceableParamGroupList count="1">
+    <referenceableParamGroup id="commonInstrumentParams">
+      <cvParam cvRef="MS" accession="MS:1002634" name="Q Exactive Plus" value=""/>
+      <cvParam cvRef="MS" accession="MS:1000529" name="instrument serial number" value="Exactive0001"/>
+    </referenceableParamGroup>
+  </referenceableParamGroupList>
+  <softwareList count="1">
+    <software id="ThermoRawFileParser" version="1.4.2">
+      <cvParam cvRef="MS" accession="MS:1000799" name="custom unreleased software tool" value="ThermoRawFileParser"/>
+    </software>
+  </softwareList>
+  <instrumentConfigurationList count="2">
+    <instrumentConfiguration id="IC1">
+      <referenceableParamGroupRef ref="commonInstrumentParams"/>
+      <componentList count="3">
+        <source order="1">
+          <cvParam cvRef="MS" accession="MS:1000398" name="nanoelectrospray" value=""/>
+        </source>
+        <analyzer order="2">
+          <cvParam cvRef="MS" accession="MS:1000484" name="orbitrap" value=""/>
+        </analyzer>
+        <detector order="3">
+          <cvParam cvRef="MS" accession="MS:1000624" name="inductive detector" value=""/>
+        </detector>
+      </componentList>
+    </instrumentConfiguration>
+    <instrumentConfiguration id="IC2">
+      <referenceableParamGroupRef ref="commonInstrumentParams"/>
+      <componentList count="3">
+        <source order="1">
+          <cvParam cvRef="MS" accession="MS:1000398" name="nanoelectrospray" value=""/>
+        </source>
+        <analyzer order="2">
+          <cvParam cvRef="MS" accession="MS:1000264" name="ion trap" value=""/>
+        </analyzer>
+        <detector order="3">
+          <cvParam cvRef="MS" accession="MS:1000253" name="electron multiplier" value=""/>
+        </detector>
+      </componentList>
+    </instrumentConfiguration>
+  </instrumentConfigurationList>
+  <dataProcessingList count="1">
+    <dataProcessing id="ThermoRawFileParserProcessing">
+      <processingMethod order="0" softwareRef="ThermoRawFileParser">
+        <cvParam cvRef="MS" accession="MS:1000544" name="Conversion to mzML" value=""/>
+      </processingMethod>
+    </dataProcessing>
+  </dataProcessingList>
+  <run id="{raw_file}" defaultInstrumentConfigurationRef="IC1">
+    <spectrumList count="{count}" defaultDataProcessingRef="ThermoRawFileParserProcessing">
+{spectra}
+    </spectrumList>
+  </run>
+</mzML>
+"""
+
+SPECTRUM = """      <spectrum index="{index}" id="controllerType=0 controllerNumber=1 scan={scan}" defaultArrayLength="{n_peaks}">
+        <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>
+        <scanList count="1">
+          <cvParam cvRef="MS" accession="MS:1000795" name="no combination" value=""/>
+          <scan instrumentConfigurationRef="{configuration}">
+            <cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="{rt}" unitCvRef="UO"
+                     unitAccession="UO:0000031" unitName="minute"/>
+            <scanWindowList count="1">
+              <scanWindow>
+                <cvParam cvRef="MS" accession="MS:1000501" name="scan window lower limit" value="{lower}"
+                         unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+                <cvParam cvRef="MS" accession="MS:1000500" name="scan window upper limit" value="1500.0"
+                         unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+              </scanWindow>
+            </scanWindowList>
+          </scan>
+        </scanList>
+{precursor}
+        <binaryDataArrayList count="2">
+          <binaryDataArray encodedLength="{mz_length}">
+            <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000514" name="m/z array" value="" unitCvRef="MS"
+                     unitAccession="MS:1000040" unitName="m/z"/>
+            <binary>{mz}</binary>
+          </binaryDataArray>
+          <binaryDataArray encodedLength="{intensity_length}">
+            <cvParam cvRef="MS" accession="MS:1000521" name="32-bit float" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000515" name="intensity array" value="" unitCvRef="MS"
+                     unitAccession="MS:1000131" unitName="number of detector counts"/>
+            <binary>{intensity}</binary>
+          </binaryDataArray>
+        </binaryDataArrayList>
+      </spectrum>"""
+
+PRECURSOR = """        <precursorList count="1">
+          <precursor>
+            <selectedIonList count="1">
+              <selectedIon>
+                <cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="{precursor_mz}"
+                         unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+                <cvParam cvRef="MS" accession="MS:1000041" name="charge state" value="2"/>
+              </selectedIon>
+            </selectedIonList>
+            <activation>
+              <cvParam cvRef="MS" accession="{activation_accession}" name="{activation}" value=""/>
+              <cvParam cvRef="MS" accession="MS:1000045" name="collision energy" value="{collision_energy}"
+                       unitCvRef="UO" unitAccession="UO:0000266" unitName="electronvolt"/>
+            </activation>
+          </precursor>
+        </precursorList>"""
+
+ACTIVATIONS = {'beam-type collision-induced dissociation': 'MS:1000422',
+               'collision-induced dissociation': 'MS:1000133'}
+
+
+def _encode(array):
+    return base64.b64encode(array.tobytes()).decode('ascii')
+
+
+def _write_mzml(path, scans, rng):
+    """
+    Write an mzML file the way ThermoRawFileParser does; scans are (scan number, ms level, activation), written in the
+    given order
+    """
+    spectra = []
+    for index, (scan, ms_level, activation) in enumerate(scans):
+        n_peaks = int(rng.integers(0, 40)) if ms_level == 2 else 50
+        mz = np.sort(rng.uniform(100, 1500, n_peaks)).astype('<f8')
+        intensity = rng.uniform(0, 1e6, n_peaks).astype('<f4')
+        precursor = '' if ms_level == 1 else PRECURSOR.format(
+            precursor_mz=rng.uniform(400, 1200), activation=activation, activation_accession=ACTIVATIONS[activation],
+            collision_energy=float(rng.choice([28.0, 30.0, 35.0])))
+        spectra.append(SPECTRUM.format(
+            index=index, scan=scan, n_peaks=n_peaks, ms_level=ms_level, rt=round(scan / 100, 4),
+            configuration='IC1' if activation != 'collision-induced dissociation' else 'IC2',
+            lower=100.0 if ms_level == 2 else 350.0, precursor=precursor, mz=_encode(mz), mz_length=len(_encode(mz)),
+            intensity=_encode(intensity), intensity_length=len(_encode(intensity))))
+    path.write_text(MZML.format(raw_file=path.stem, count=len(scans), spectra='\n'.join(spectra)))
+
+
+def test_store_dataframe_equals_decoded_mzml(tmp_path):
+    rng = np.random.default_rng(0)
+    # MS1 scans in between and scan numbers of different widths, whose string order differs from their numeric order
+    scans = [(scan, 1, None) if scan % 5 == 1 else
+             (scan, 2, rng.choice(list(ACTIVATIONS))) for scan in range(1, 24)]
+    scans += [(100, 2, 'beam-type collision-induced dissociation'), (1000, 1, None),
+              (1001, 2, 'beam-type collision-induced dissociation')]
+    mzml_file = tmp_path / 'run_a.mzML'
+    _write_mzml(mzml_file, scans, rng)
+
+    expected = read_mzml(mzml_file)
+    actual = SpectrumStore(build_store(mzml_file, tmp_path / 'store')).to_dataframe()
+
+    assert len(expected) == sum(ms_level == 2 for _, ms_level, _ in scans)
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_index_equal(actual.index, expected.index)
+    scalar_columns = [column for column in expected.columns if column not in ['MZ', 'INTENSITIES']]
+    pd.testing.assert_frame_equal(actual[scalar_columns], expected[scalar_columns])
+    for column in ['MZ', 'INTENSITIES']:
+        for actual_peaks, expected_peaks in zip(actual[column], expected[column]):
+            assert actual_peaks.dtype == expected_peaks.dtype
+            np.testing.assert_array_equal(actual_peaks, expected_peaks)
+
+    # Oktoberfest merges the spectra with the PSMs on these columns, which must not be ambiguous with the index
+    psms = pd.DataFrame({'RAW_FILE': 'run_a', 'SCAN_NUMBER': [100, 7]})
+    pd.testing.assert_frame_equal(psms.merge(actual, on=['RAW_FILE', 'SCAN_NUMBER']),
+                                  psms.merge(expected, on=['RAW_FILE', 'SCAN_NUMBER']))
@@ -0,0 +1,36 @@
+import json
+
+from prosimsit.stages import Pipeline, Stage
+
+
+def _stage(tmp_path, refreshed):
+    return Stage('Second Oktoberfest run', run=lambda allocation: None, config={'simsi': {'tmt_ms_level': 'ms2'}},
+                 workdir=tmp_path / 'oktoberfest_2_out', refresh=lambda: refreshed.append(True))
+
+
+def _previous_run(pipeline, stage, **record):
+    (stage.workdir / 'results.txt').parent.mkdir(parents=True)
+    (stage.workdir / 'results.txt').write_text('previous results')
+    record_path = pipeline.state_dir / 'stages' / f'{stage.name}.json'
+    record_path.parent.mkdir(parents=True)
+    record_path.write_text(json.dumps({'status': 'done', 'fingerprint': 'previous inputs', 'outputs': {}, **record}))
+
+
+def test_changed_inputs_refresh_stage_with_unchanged_config(tmp_path):
+    refreshed = []
+    pipeline = Pipeline(tmp_path, incremental=True)
+    stage = _stage(tmp_path, refreshed)
+    _previous_run(pipeline, stage, config=pipeline.config_digest(stage))
+    pipeline.start_stage(stage)
+    assert refreshed == [True]
+    assert (stage.workdir / 'results.txt').is_file()
+
+
+def test_stage_without_recorded_config_is_rebuilt(tmp_path):
+    refreshed = []
+    pipeline = Pipeline(tmp_path, incremental=True)
+    stage = _stage(tmp_path, refreshed)
+    _previous_run(pipeline, stage)
+    pipeline.start_stage(stage)
+    assert refreshed == []
+    assert not stage.workdir.exists()
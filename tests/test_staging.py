@@ -0,0 +1,31 @@
+import os
+
+from prosimsit.staging import stage_files, staging_methods
+
+
+def test_writable_files_are_never_linked():
+    assert staging_methods('auto', writable=True) == ['reflink', 'copy']
+    assert staging_methods('hardlink', writable=True) == ['copy']
+    assert staging_methods('symlink', writable=True) == ['copy']
+    assert staging_methods('hardlink') == ['hardlink', 'copy']
+
+
+def test_rewriting_a_writable_staged_file_keeps_its_source(tmp_path):
+    source = tmp_path / 'run1' / 'raw1_ce.txt'
+    source.parent.mkdir()
+    source.write_text('30')
+    methods = stage_files([source], tmp_path / 'run2', 'hardlink', writable=True)
+    assert methods == {'raw1_ce.txt': 'copy'}
+
+    with open(tmp_path / 'run2' / 'raw1_ce.txt', 'w') as f:
+        f.write('35')
+    assert source.read_text() == '30'
+
+
+def test_linked_files_are_staged_again_once_writable(tmp_path):
+    source = tmp_path / 'run1' / 'raw1_ce.txt'
+    source.parent.mkdir()
+    source.write_text('30')
+    assert stage_files([source], tmp_path / 'run2', 'hardlink') == {'raw1_ce.txt': 'hardlink'}
+    assert stage_files([source], tmp_path / 'run2', 'hardlink', writable=True) == {'raw1_ce.txt': 'copy'}
+    assert not os.path.samefile(source, tmp_path / 'run2' / 'raw1_ce.txt')
@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+import prosimsit.utils as utils
+
+
+def _write_tab(path, features):
+    tab = pd.DataFrame({'SpecId': ['a', 'b'], 'Label': [1, -1], 'ScanNr': [1, 2], 'filename': ['raw1', 'raw1'],
+                        'ExpMass': [0, 0], **{f: [0.5, 0.25] for f in features},
+                        'Peptide': ['_.PEPTIDEK._', '_.KEDITPEP._'], 'Proteins': ['P1', 'DECOY_P1']})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tab.to_csv(path, sep='\t', index=False)
+
+
+def test_merge_rescore_files_keeps_all_rows(tmp_path):
+    _write_tab(tmp_path / 'ok1' / 'rescore.tab', ['spectral_angle', 'delta_score'])
+    _write_tab(tmp_path / 'ok2' / 'raw2.rescore.tab', ['delta_score', 'spectral_angle'])
+    utils.merge_rescore_files(tmp_path / 'ok1', tmp_path / 'ok2', tmp_path / 'rescore_all.tab')
+
+    merged = pd.read_csv(tmp_path / 'rescore_all.tab', sep='\t')
+    assert len(merged) == 4
+    assert {'spectral_angle', 'delta_score', 'ExpMass'} <= set(merged.columns)
+
+
+def test_merge_rescore_files_rejects_different_features(tmp_path):
+    _write_tab(tmp_path / 'ok1' / 'rescore.tab', ['spectral_angle', 'delta_score'])
+    _write_tab(tmp_path / 'ok2' / 'raw2.rescore.tab', ['spectral_angle'])
+    with pytest.raises(ValueError, match='delta_score'):
+        utils.merge_rescore_files(tmp_path / 'ok1', tmp_path / 'ok2', tmp_path / 'rescore_all.tab')
+    assert not (tmp_path / 'rescore_all.tab').exists()